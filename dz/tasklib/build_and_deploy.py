@@ -1,11 +1,17 @@
 from dz.tasklib import taskconfig
+import hashlib
+import json
 import os
 
 from dz.tasklib import (utils,
                         common_steps,
                         bundle,
-                        placement)
+                        bundle_peers,
+                        placement,
+                        userenv,
+                        vcs_handlers)
 from dz.tasklib import deploy as tasklib_deploy
+from dz.tasklib.database import DatabaseInfo
 from dz.tasks import database, deploy, nginx
 
 
@@ -15,17 +21,97 @@ def write_build_configuration(zoomdb, opts):
     zcfg.close()
 
 
+def _reuse_cached_build(zoomdb, opts, ue):
+    """
+    Look for an earlier bundle of this project built from identical inputs,
+    and if there is one, make the new bundle from a copy of it (see
+    bundle.restore_cached_bundle).
+
+    :returns: (build_key, code_revision, bundle_name); bundle_name is None
+        if no cached build could be used.
+    """
+    try:
+        build_key, code_revision = bundle.build_cache_key(
+            opts["APP_ID"], ue,
+            src_repo_type=opts["SRC_REPO_TYPE"],
+            post_build_hooks=opts["POST_BUILD_HOOKS"])
+    except Exception, e:
+        # a full build will report any real problem with the inputs.
+        zoomdb.log("Couldn't check for a previous identical build: %s" % e,
+                   zoomdb.LOG_WARN)
+        return None, None, None
+
+    try:
+        cached = zoomdb.find_bundle_by_build_key(
+            build_key, max_age=taskconfig.BUILD_CACHE_MAX_AGE)
+    except Exception, e:
+        # nor store the key with the new bundle, which would fail the same
+        # way.
+        zoomdb.log("Couldn't look for a previous identical build: %s" % e,
+                   zoomdb.LOG_WARN)
+        return None, None, None
+    if cached is None:
+        return build_key, code_revision, None
+
+    try:
+        bundle_name, stored = bundle.restore_cached_bundle(
+            opts["APP_ID"], cached.bundle_name,
+            bundle_storage_engine=opts["BUNDLE_STORAGE"])
+        if stored:
+            zoomdb.log("Copied bundle %s to %s in bundle storage." % (
+                    cached.bundle_name, bundle_name))
+    except Exception, e:
+        zoomdb.log("Couldn't reuse previous build %s, so building from "
+                   "scratch: %s" % (cached.bundle_name, e),
+                   zoomdb.LOG_WARN)
+        return build_key, code_revision, None
+
+    zoomdb.log("Your code, configuration and requirements are unchanged "
+               "since bundle %s was built, so we're reusing that build." %
+               cached.bundle_name)
+    return build_key, code_revision, bundle_name
+
+
+# Steps declared with utils.step may run concurrently with any other step
+# whose opts keys don't overlap (see utils.run_steps). Undeclared steps, such
+# as checkout_code and the post-deploy steps, run alone.
+
+@utils.step(reads=("APP_ID", "APP_DIR", "SRC_REPO_TYPE", "POST_BUILD_HOOKS",
+                   "BUNDLE_STORAGE"),
+            writes=("BUNDLE_NAME", "BUNDLE_INFO"))
 def build_project_bundle(zoomdb, opts):
     zoomdb.log("We're getting your project's dependencies and packaging "
                "everything up. This might take a couple of minutes.")
+
+    ue = None
+    build_key = None
+
+    if taskconfig.BUILD_CACHE_ENABLED:
+        ue = userenv.make_userenv(opts["APP_ID"])
+        build_key, code_revision, bundle_name = _reuse_cached_build(
+            zoomdb, opts, ue)
+
+        if bundle_name:
+            # nothing more will run in it.
+            ue.destroy()
+            opts["BUNDLE_NAME"] = bundle_name
+            opts["BUNDLE_INFO"] = zoomdb.add_bundle(bundle_name,
+                                                    code_revision,
+                                                    build_key=build_key)
+            # post-build hooks already ran in the cached build.
+            return
+
     bundle_name, code_revision, ue = bundle.bundle_app(
         opts["APP_ID"],
         src_repo_type=opts["SRC_REPO_TYPE"],
-        return_ue=True)
+        return_ue=True,
+        ue=ue,
+        zoomdb=zoomdb)
     zoomdb.log("Built project into bundle: %s" % bundle_name)
     opts["BUNDLE_NAME"] = bundle_name
     # and log this bundle into zoomdb
-    opts["BUNDLE_INFO"] = zoomdb.add_bundle(bundle_name, code_revision)
+    opts["BUNDLE_INFO"] = zoomdb.add_bundle(bundle_name, code_revision,
+                                            build_key=build_key)
 
     post_build_hooks = opts["POST_BUILD_HOOKS"]
 
@@ -37,8 +123,8 @@ def build_project_bundle(zoomdb, opts):
                              bundle_runner,
                              dbinfo=None,  # no database access yet
                              num_workers=0,
-                             env=ue)
-    ue.call(["chmod", "700", bundle_runner])
+                             env=ue,
+                             mode=0700)
 
     def run_buildtime_managepy_cmd(cmdlist, nonzero_exit_ok=False):
         stdout, stderr, p = ue.subproc([bundle_runner] + cmdlist,
@@ -88,6 +174,8 @@ def build_project_bundle(zoomdb, opts):
     ue.call(["rm", bundle_runner])
 
 
+@utils.step(reads=("USE_SUBTASKS", "APP_ID"),
+            writes=("database_setup_result",))
 def request_database_setup(zoomdb, opts):
     if opts["USE_SUBTASKS"]:
         async_result = database.setup_database_for_app.delay(opts["APP_ID"])
@@ -97,15 +185,37 @@ def request_database_setup(zoomdb, opts):
     # wait_for_database_setup_to_complete
 
 
+@utils.step(reads=("APP_ID", "BUNDLE_NAME", "BUNDLE_STORAGE",
+                   "ZOOMBUILD_CFG_CONTENT"),
+            writes=("BUNDLE_ARCHIVE",))
 def upload_project_bundle(zoomdb, opts):
+    app_dir, bundle_dir = utils.app_and_bundle_dirs(opts["APP_ID"],
+                                                    opts["BUNDLE_NAME"])
+    if not os.path.isdir(bundle_dir):
+        # a reused build, copied within bundle storage rather than
+        # relocated here (see bundle.restore_cached_bundle).
+        opts["BUNDLE_ARCHIVE"] = bundle.stored_archive_name(
+            opts["BUNDLE_NAME"], opts["BUNDLE_STORAGE"])
+        zoomdb.log("Bundle %s is already stored." % opts["BUNDLE_NAME"])
+        return
+
     zoomdb.log("Uploading application bundle %s." % opts["BUNDLE_NAME"])
-    bundle.zip_and_upload_bundle(
+    zcfg = utils.parse_zoombuild_string(opts["ZOOMBUILD_CFG_CONTENT"])
+    site_media_map = utils.parse_site_media_map(zcfg.get("site_media_map", ""))
+    # the previous bundle usually shares most of its files with this one.
+    base = zoomdb.get_latest_bundle(exclude_name=opts["BUNDLE_NAME"])
+    opts["BUNDLE_ARCHIVE"] = bundle.zip_and_upload_bundle(
         opts["APP_ID"], opts["BUNDLE_NAME"],
         bundle_storage_engine=opts["BUNDLE_STORAGE"],
-        delete_after_upload=True)
+        delete_after_upload=True,
+        site_media_map=site_media_map,
+        base_bundle=base and base.bundle_name)
     zoomdb.log("Bundle %s uploaded OK." % opts["BUNDLE_NAME"])
 
 
+@utils.step(reads=("USE_SUBTASKS", "APP_ID", "REQUIRES_POSTGIS",
+                   "database_setup_result"),
+            writes=("database_setup_result", "DB"))
 def wait_for_database_setup_to_complete(zoomdb, opts):
     zoomdb.log("Checking to see if database setup is complete...")
 
@@ -166,6 +276,8 @@ def wait_for_database_setup_to_complete(zoomdb, opts):
     opts["DB"] = dbinfo
 
 
+@utils.step(reads=("APP_ID",),
+            writes=("PLACEMENT",))
 def select_app_server_for_deployment(zoomdb, opts):
     opts["PLACEMENT"] = placement.placement(opts["APP_ID"])
     if not len(opts["PLACEMENT"]):
@@ -174,6 +286,32 @@ def select_app_server_for_deployment(zoomdb, opts):
             "your project.")
 
 
+@utils.step(reads=("APP_ID", "BUNDLE_NAME", "BUNDLE_ARCHIVE", "USE_SUBTASKS",
+                   "PLACEMENT"))
+def prefetch_bundle_to_appservers(zoomdb, opts):
+    """
+    Have the placed appservers get the uploaded bundle in the background,
+    while the database is being set up, so deploying it is quicker. This
+    doesn't wait for them: deploy_project_to_appserver gets the bundle
+    itself on any appserver which hasn't finished prefetching it.
+    """
+    if not opts["USE_SUBTASKS"]:
+        return
+
+    all_peers = bundle_peers.fanout_peers(opts["PLACEMENT"])
+    for appserver, peers in zip(opts["PLACEMENT"], all_peers):
+        deploy.prefetch_bundle.apply_async(
+            args=[opts["APP_ID"], opts["BUNDLE_NAME"]],
+            kwargs={"peers": peers},
+            queue="appserver:" + appserver,
+            priority=taskconfig.PREFETCH_TASK_PRIORITY)
+    zoomdb.log("Prefetching bundle %s to %s." % (
+            opts["BUNDLE_NAME"], ", ".join(opts["PLACEMENT"])))
+
+
+@utils.step(reads=("APP_ID", "BUNDLE_NAME", "BUNDLE_INFO", "BUNDLE_ARCHIVE",
+                   "DB", "NUM_WORKERS", "USE_SUBTASKS", "PLACEMENT"),
+            writes=("DEPLOYED_ADDRESSES", "DEPLOYED_WORKERS"))
 def deploy_project_to_appserver(zoomdb, opts):
     deployed_addresses = []  # in (hostname,port) format
 
@@ -186,10 +324,12 @@ def deploy_project_to_appserver(zoomdb, opts):
                 opts["NUM_WORKERS"]]
 
     if opts["USE_SUBTASKS"]:
-        # send concurrent deploy commands to all placed servers.
+        # send concurrent deploy commands to all placed servers, which get
+        # the bundle from each other where they can.
         deployment_tasks = []
+        all_peers = bundle_peers.fanout_peers(opts["PLACEMENT"])
 
-        for appserver in opts["PLACEMENT"]:
+        for appserver, peers in zip(opts["PLACEMENT"], all_peers):
             zoomdb.log("Deploying to %s..." % appserver)
 
             my_args = list(dep_args)
@@ -197,6 +337,7 @@ def deploy_project_to_appserver(zoomdb, opts):
 
             async_result = deploy.deploy_to_appserver.apply_async(
                 args=my_args,
+                kwargs={"peers": peers},
                 queue="appserver:" + appserver)
             deployment_tasks.append(async_result)
 
@@ -322,10 +463,18 @@ def update_front_end_proxy(zoomdb, opts):
     remove_other_bundles = taskconfig.NGINX_REMOVE_OLD_BUNDLES_ON_UPDATE
 
     if opts["USE_SUBTASKS"]:
+        # the appservers have just got the bundle, so the proxy can get it
+        # from them.
+        peers = []
+        if bundle_peers.is_enabled():
+            peers = [host_ip for (instance_id, node_name, host_ip, host_port)
+                     in appservers]
+
         res = nginx.update_proxy_conf.apply_async(args=args,
                                                   kwargs={
                                                       "remove_other_bundles":
-                                                      remove_other_bundles})
+                                                      remove_other_bundles,
+                                                      "peers": peers})
         res.wait()
     else:
         nginx.update_proxy_conf(*args,
@@ -367,6 +516,128 @@ def remove_previous_versions(zoomdb, opts):
         zoomdb.log("No old instances found.")
 
 
+# opts keys saved in build checkpoints.
+CHECKPOINT_KEYS = ("BUNDLE_NAME", "BUNDLE_INFO", "BUNDLE_ARCHIVE", "DB",
+                   "PLACEMENT", "DEPLOYED_ADDRESSES", "DEPLOYED_WORKERS")
+
+
+def _checkpoint_fingerprint(opts):
+    """
+    Identify the inputs of a build_and_deploy job, including the revision of
+    the code checked out for it; a job may only resume from a checkpoint
+    with the same fingerprint.
+    """
+    vcs_h = vcs_handlers.get_handler(opts["SRC_REPO_TYPE"])
+    inputs = [opts[k] for k in ("APP_ID", "SRC_REPO_TYPE", "SRC_URL",
+                                "ZOOMBUILD_CFG_CONTENT", "POST_BUILD_HOOKS",
+                                "POST_DEPLOY_HOOKS", "NUM_WORKERS",
+                                "REQUIRES_POSTGIS", "USE_SUBTASKS")]
+    inputs.append(opts["BUNDLE_STORAGE"].__name__)
+    inputs.append(vcs_h.get_revision_info(opts["CO_DIR"]))
+    return hashlib.sha1(json.dumps(inputs)).hexdigest()
+
+
+def _save_checkpoint(zoomdb, opts, fingerprint, input_keys, completed):
+    saved = {}
+    for key in CHECKPOINT_KEYS:
+        if key not in opts:
+            continue
+        value = opts[key]
+        if key == "BUNDLE_INFO":
+            value = value.id
+        elif key == "DEPLOYED_WORKERS":
+            value = [w.id for w in value]
+        saved[key] = value
+
+    # other values a step left in opts can't be saved; steps that wrote
+    # them can't be skipped when resuming.
+    unsaved = [k for k in opts
+               if k not in input_keys and k not in CHECKPOINT_KEYS]
+
+    zoomdb.save_build_checkpoint(fingerprint, dict(
+            completed=[stepfn.__name__ for stepfn in completed],
+            opts=saved,
+            unsaved=unsaved))
+
+
+def _restore_checkpoint_opts(zoomdb, opts, saved):
+    """
+    Convert values saved by _save_checkpoint back into opts values. Values
+    that are no longer valid are left out.
+    """
+    restored = {}
+
+    for key, value in saved.items():
+        if key == "BUNDLE_NAME":
+            # the built bundle only exists on the node that built it, until
+            # it has been uploaded.
+            if ("BUNDLE_ARCHIVE" not in saved and
+                not os.path.isdir(os.path.join(opts["APP_DIR"], value))):
+                continue
+        elif key == "BUNDLE_INFO":
+            value = zoomdb.get_bundle(value)
+            if value.deletion_date:
+                continue
+        elif key == "DB":
+            value = DatabaseInfo(**value)
+        elif key == "DEPLOYED_ADDRESSES":
+            value = [tuple(address) for address in value]
+        elif key == "DEPLOYED_WORKERS":
+            value = [zoomdb.get_project_worker_by_id(worker_id)
+                     for worker_id in value]
+            # workers undeployed since then can't be reused.
+            if [w for w in value if w.deactivation_date]:
+                continue
+        restored[key] = value
+
+    return restored
+
+
+def _resume_from_checkpoint(zoomdb, opts, fingerprint, steps):
+    """
+    If an earlier job with the same inputs saved a checkpoint, restore its
+    results into opts and skip the steps at the start of ``steps`` that it
+    completed.
+
+    :returns: (steps that still need to be run, steps skipped)
+    """
+    checkpoint = zoomdb.get_build_checkpoint(
+        fingerprint, max_age=taskconfig.BUILD_CHECKPOINT_MAX_AGE)
+    if checkpoint is None:
+        return steps, []
+
+    job_id, state = checkpoint
+    restored = _restore_checkpoint_opts(zoomdb, opts, state["opts"])
+
+    def can_skip(stepfn):
+        if stepfn.__name__ not in state["completed"]:
+            return False
+        for key in getattr(stepfn, "writes", ()):
+            if key in CHECKPOINT_KEYS and key not in restored:
+                return False
+            if key in state["unsaved"]:
+                return False
+        return True
+
+    skipped = []
+    for stepfn in steps:
+        if not can_skip(stepfn):
+            break
+        skipped.append(stepfn)
+
+    if not skipped:
+        return steps, []
+
+    for stepfn in skipped:
+        for key in getattr(stepfn, "writes", ()):
+            if key in restored:
+                opts[key] = restored[key]
+
+    zoomdb.log("Resuming where job %s left off: skipping %s." % (
+            job_id,
+            ", ".join(utils.step_nicename(s) for s in skipped)))
+    return steps[len(skipped):], skipped
+
 
 def build_and_deploy(zoomdb, app_id, src_repo_type, src_url,
                      zoombuild_cfg_content,
@@ -397,18 +668,43 @@ def build_and_deploy(zoomdb, app_id, src_repo_type, src_url,
         "REQUIRES_POSTGIS": requires_postgis,
         }
 
+    input_keys = set(opts)
+
+    # these always run, as the checkpoint fingerprint depends on the code.
     utils.run_steps(zoomdb, opts, (
             common_steps.checkout_code,
             write_build_configuration,
-            build_project_bundle,
-            request_database_setup,
-            upload_project_bundle,
-            wait_for_database_setup_to_complete,
-            select_app_server_for_deployment,
-            deploy_project_to_appserver,
-            run_post_deploy_hooks,
-            update_front_end_proxy,
-            remove_previous_versions,
             ))
 
+    steps = (
+        build_project_bundle,
+        request_database_setup,
+        upload_project_bundle,
+        wait_for_database_setup_to_complete,
+        select_app_server_for_deployment,
+        prefetch_bundle_to_appservers,
+        deploy_project_to_appserver,
+        run_post_deploy_hooks,
+        update_front_end_proxy,
+        remove_previous_versions,
+        )
+    step_done_callback = None
+
+    if taskconfig.BUILD_CHECKPOINTS_ENABLED:
+        fingerprint = _checkpoint_fingerprint(opts)
+        steps, completed = _resume_from_checkpoint(zoomdb, opts, fingerprint,
+                                                   steps)
+
+        def step_done_callback(stepfn):
+            completed.append(stepfn)
+            _save_checkpoint(zoomdb, opts, fingerprint, input_keys,
+                             completed)
+
+    utils.run_steps(zoomdb, opts, steps,
+                    max_parallel=taskconfig.BUILD_STEPS_MAX_PARALLEL,
+                    step_done_callback=step_done_callback)
+
+    if taskconfig.BUILD_CHECKPOINTS_ENABLED:
+        zoomdb.clear_build_checkpoint()
+
     return opts["DEPLOYED_ADDRESSES"]
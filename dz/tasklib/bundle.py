@@ -1,15 +1,25 @@
 import os
+import re
 import shutil
 import datetime
+import hashlib
 import tempfile
 import subprocess
+import time
 
 from dz.tasklib import (taskconfig,
+                        bundle_codecs,
+                        bundle_manifest,
                         bundle_storage,
                         bundle_storage_local,
+                        fastcopy,
+                        static_assets,
+                        timing,
                         utils,
                         userenv,
-                        vcs_handlers)
+                        vcs_handlers,
+                        venv_templates,
+                        reqs_layer)
 
 
 def _ignore_vcs_files(srcdir, names):
@@ -18,8 +28,185 @@ def _ignore_vcs_files(srcdir, names):
     return [n for n in names if n in (".git", ".svn", ".hg")]
 
 
+def _ignore_build_files(srcdir, names):
+    """Ignore function for copying a project's source into its bundle,
+    which also leaves out any bytecode, as it may be stale; the bundle's
+    own is compiled by _precompile_bundle."""
+    return _ignore_vcs_files(srcdir, names) + [
+        n for n in names if n.endswith((".pyc", ".pyo"))]
+
+
+# bump this whenever bundle_app changes what goes into a bundle, so that
+# bundles built by older code are no longer reused from the build cache.
+BUILD_CACHE_VERSION = "2"
+
+# a bundle's static bundle (see make_static_bundle) is stored under its name
+# plus this.
+STATIC_BUNDLE_SUFFIX = "-static"
+
+
+def _precompile_bundle(bundle_dir, ue, zoomdb=None):
+    """
+    Compile all the Python in a bundle, including its requirements, so that
+    its workers and management commands don't have to on every start. This
+    runs inside ``ue`` with the bundle's own python, so the bytecode belongs
+    to the project's user and suits the interpreter the bundle was built
+    for. Any files which don't compile (e.g. templates named .py) are left
+    as they are, and reported through ``zoomdb`` if given.
+    """
+    repo_link = os.path.join(bundle_dir, "user-repo")
+    stdout, stderr, p = ue.subproc(
+        [os.path.join(bundle_dir, "bin", "python"), "-m", "compileall", "-q",
+         # user-repo links to (part of) user-src: don't do it twice.
+         "-x", re.escape(repo_link + os.sep),
+         bundle_dir],
+        nonzero_exit_ok=True)
+    if p.returncode != 0:
+        message = ("Some of your project's Python files couldn't be "
+                   "compiled:\n%s" % (stdout + stderr))
+        if zoomdb:
+            zoomdb.log(message, zoomdb.LOG_WARN)
+        else:
+            print "Warning: " + message
+
+
+def _make_bundle_name(app_id):
+    return "bundle_%s_%s" % (
+        app_id,
+        datetime.datetime.utcnow().strftime("%Y-%m-%d-%H.%M.%S"))
+
+
+def _assemble_user_requirements(buildconfig_info, basedir, ue):
+    """Assemble the requirements listed in zoombuild.cfg, reading any
+    requirements files from ``basedir`` inside ``ue``."""
+    return utils.assemble_requirements(
+        files=[l.strip() for l in
+               buildconfig_info["requirements_files"].splitlines()],
+        lines=[l.strip() for l in
+               buildconfig_info["extra_requirements"].splitlines()],
+        basedir=basedir,
+        ignore_keys="django",
+        env=ue)
+
+
+def build_cache_key(app_id, ue, src_repo_type="git", post_build_hooks=None):
+    """
+    Compute the build cache key for the code currently checked out for
+    ``app_id``. Two builds with the same key produce equivalent bundles:
+    the key covers the code revision, zoombuild.cfg, the assembled
+    requirements, the Django version and the post-build hooks.
+
+    :param ue: UserEnv for the app, used to read requirements files.
+    :returns: (build_key, code_revision)
+    """
+    appdir = os.path.join(taskconfig.NR_CUSTOMER_DIR, app_id)
+    appsrcdir = os.path.join(appdir, "src")
+    buildconfig = os.path.join(appdir, "zoombuild.cfg")
+
+    buildconfig_content = open(buildconfig).read()
+    buildconfig_info = utils.parse_zoombuild_string(buildconfig_content)
+
+    vcs_h = vcs_handlers.get_handler(src_repo_type)
+    code_revision = unicode(vcs_h.get_revision_info(appsrcdir), "utf8")
+
+    # bundle_app reads these from the copy of appsrcdir in the bundle.
+    reqs = _assemble_user_requirements(buildconfig_info, appsrcdir, ue)
+    djver = taskconfig.DJANGO_VERSIONS[buildconfig_info["django_version"]]
+
+    key = hashlib.sha1()
+    for part in (BUILD_CACHE_VERSION,
+                 code_revision.encode("utf8"),
+                 buildconfig_content,
+                 "\n".join(reqs),
+                 djver["tarball"],
+                 djver["pip_line"],
+                 repr(post_build_hooks)):
+        key.update(part)
+        key.update("\0")
+
+    return key.hexdigest(), code_revision
+
+
+def _copy_stored_bundle(bundle_name, new_bundle_name, bundle_storage_engine):
+    """
+    Copy a bundle, and its static bundle if it has one, to a new name within
+    bundle storage.
+    """
+    names = [(bundle_name, new_bundle_name)]
+    if has_static_bundle(bundle_name, bundle_storage_engine):
+        names.append((static_bundle_name(bundle_name),
+                      static_bundle_name(new_bundle_name)))
+
+    for name, new_name in names:
+        if bundle_manifest.has_manifest(name, bundle_storage_engine):
+            bundle_manifest.copy_manifest(name, new_name,
+                                          bundle_storage_engine)
+        else:
+            bundle_storage_engine.copy(name + ".tgz", new_name + ".tgz")
+
+
+def stored_archive_name(bundle_name, bundle_storage_engine):
+    """
+    Get the name of a bundle's archive or manifest in bundle storage.
+
+    :raises KeyError: if it isn't stored.
+    """
+    if bundle_manifest.has_manifest(bundle_name, bundle_storage_engine):
+        return bundle_manifest.manifest_name(bundle_name)
+    if bundle_storage_engine.exists(bundle_name + ".tgz"):
+        return bundle_name + ".tgz"
+    raise KeyError("Bundle %s isn't stored" % bundle_name)
+
+
+def restore_cached_bundle(app_id, cached_bundle_name,
+                          bundle_storage_engine=None):
+    """
+    Make a new bundle for ``app_id`` from a copy of a previously built one,
+    fetched from bundle storage, instead of building it from scratch.
+
+    If the copy needn't be relocated to its new name, the stored bundle is
+    copied within bundle storage too, where the storage engine can, and the
+    new bundle isn't left in the app directory, as it needn't be uploaded.
+
+    :returns: (bundle_name, stored): the new bundle's name, and whether it
+        is already in bundle storage.
+    """
+    bundle_storage_engine = get_bundle_storage_engine(bundle_storage_engine)
+
+    appdir = os.path.join(taskconfig.NR_CUSTOMER_DIR, app_id)
+    bundle_name = _make_bundle_name(app_id)
+    bundle_dir = os.path.join(appdir, bundle_name)
+
+    extract_dir = tempfile.mkdtemp(prefix="cached-bundle-", dir=appdir)
+    try:
+        utils.get_and_extract_bundle(cached_bundle_name, extract_dir,
+                                     bundle_storage_engine)
+        os.rename(os.path.join(extract_dir, cached_bundle_name), bundle_dir)
+    finally:
+        shutil.rmtree(extract_dir)
+
+    try:
+        relocated = utils.relocate_tree(
+            bundle_dir, os.path.join(appdir, cached_bundle_name), bundle_dir)
+
+        if not relocated and hasattr(bundle_storage_engine, "copy"):
+            _copy_stored_bundle(cached_bundle_name, bundle_name,
+                                bundle_storage_engine)
+            shutil.rmtree(bundle_dir)
+            return bundle_name, True
+
+        # as in bundle_app, bundle contents belong to the app user.
+        utils.local_privileged(["project_chown", app_id, bundle_dir])
+    except:
+        utils.chown_to_me(bundle_dir)
+        shutil.rmtree(bundle_dir)
+        raise
+
+    return bundle_name, False
+
+
 def bundle_app(app_id, force_bundle_name=None, return_ue=False,
-               src_repo_type="git"):
+               src_repo_type="git", ue=None, zoomdb=None):
     """
     Task: Bundle an app with ``app_id`` found in ``custdir``
 
@@ -30,6 +217,8 @@ def bundle_app(app_id, force_bundle_name=None, return_ue=False,
         will be auto-generated based on the app name and current date/time.
     :param return_ue: If true, returns the UserEnv object used to build
         the bundle.
+    :param ue: Optional existing UserEnv for the app to build in.
+    :param zoomdb: Optional ZoomDB to log warnings to.
 
     :returns: (bundle_name, code_revision, userenv) if ``return_ue`` is True
         otherwise returns (bundle_name, code_revision)
@@ -61,14 +250,32 @@ def bundle_app(app_id, force_bundle_name=None, return_ue=False,
     if force_bundle_name:
         bundle_name = force_bundle_name
     else:
-        bundle_name = "bundle_%s_%s" % (
-            app_id,
-            datetime.datetime.utcnow().strftime("%Y-%m-%d-%H.%M.%S"))
+        bundle_name = _make_bundle_name(app_id)
 
     bundle_dir = os.path.join(appdir, bundle_name)
 
-    # make virtualenv
-    utils.make_virtualenv(bundle_dir)
+    # reuse the requirements installed for the project's previous bundle,
+    # if they're unchanged.
+    django_version = buildconfig_info["django_version"]
+    layer_key = None
+    if reqs_layer.is_enabled():
+        if ue is None:
+            ue = userenv.make_userenv(app_id)
+        layer_key = reqs_layer.layer_key(
+            django_version,
+            _assemble_user_requirements(buildconfig_info, appsrcdir, ue))
+    reused_layer = reqs_layer.restore(app_id, layer_key, bundle_dir)
+
+    # otherwise, make a virtualenv with the Django version selected in
+    # zoombuild.cfg
+    if not reused_layer:
+        if venv_templates.is_enabled():
+            venv_templates.clone_template(django_version, bundle_dir)
+        else:
+            utils.make_virtualenv(bundle_dir)
+            utils.install_requirements(
+                [venv_templates.django_requirement(django_version)],
+                bundle_dir, logsuffix="-django")
 
     # archive a copy of the build parameters
     shutil.copyfile(buildconfig,
@@ -99,14 +306,16 @@ def bundle_app(app_id, force_bundle_name=None, return_ue=False,
         repo_link_src = 'user-src'
     os.symlink(repo_link_src, repo_link)
 
-    # Do the shutil.copytree inside a try/except block so that we can
-    # identify bad symlinks. According to http://bugs.python.org/issue6547,
-    # bad symlinks will cause an shutil.Error to be raised only at the
-    # end of the copy process, so other files are copied correctly.
-    # Therefore it is OK to simply warn about any bad links but otherwise
-    # assume that things were copied over OK.
+    # Do the copytree inside a try/except block so that we can identify bad
+    # symlinks. As with shutil.copytree (see
+    # http://bugs.python.org/issue6547), bad symlinks will cause an
+    # shutil.Error to be raised only at the end of the copy process, so
+    # other files are copied correctly. Therefore it is OK to simply warn
+    # about any bad links but otherwise assume that things were copied over
+    # OK. Files aren't hard linked, as the bundle is chowned below.
     try:
-        shutil.copytree(appsrcdir, to_src, ignore=_ignore_vcs_files)
+        fastcopy.copytree(appsrcdir, to_src, ignore=_ignore_build_files,
+                          workers=taskconfig.SOURCE_COPY_WORKERS)
     except shutil.Error, e:
         for src, dst, error in e.args[0]:
             if not os.path.islink(src):
@@ -134,19 +343,6 @@ def bundle_app(app_id, force_bundle_name=None, return_ue=False,
         utils.add_to_pth([os.path.join('user-src', bpp_as_path)],
                          bundle_dir, relative=True)
 
-    # First install the selected Django version based on zoombuild.cfg,
-    # and use a local tarball if possible.
-    djver = taskconfig.DJANGO_VERSIONS[buildconfig_info['django_version']]
-    ver_tarball = os.path.join(taskconfig.DJANGO_TARBALLS_DIR,
-                               djver["tarball"])
-
-    if os.path.isfile(ver_tarball):
-        django_req = ver_tarball
-    else:
-        django_req = djver["pip_line"]
-    utils.install_requirements([django_req], bundle_dir,
-                               logsuffix="-django")
-
     # This is where we've finished running code we trust (virtualenv, django,
     # etc) and switch to running code provided or pointed to by the user. So
     # let's chown everything to the app user.
@@ -155,23 +351,15 @@ def bundle_app(app_id, force_bundle_name=None, return_ue=False,
                             bundle_dir])
 
     # and let's create the userenv!
-    ue = userenv.UserEnv(app_id)
+    if ue is None:
+        ue = userenv.make_userenv(app_id)
 
     # install user-provided requirements
-    reqs = utils.assemble_requirements(
-        files=[l.strip() for l in
-               buildconfig_info["requirements_files"].splitlines()],
-        lines=[l.strip() for l in
-               buildconfig_info["extra_requirements"].splitlines()],
-        basedir=repo_link,
-        ignore_keys="django",
-        env=ue)
-
-    utils.install_requirements(reqs, bundle_dir, env=ue)
-
-    # Remove the python executable, we don't use it
-    ue.remove(os.path.join(bundle_dir, "bin", "python"))
-    #os.remove(os.path.join(bundle_dir, "bin", "python"))
+    if not reused_layer:
+        reqs = _assemble_user_requirements(buildconfig_info, repo_link, ue)
+        utils.install_requirements(reqs, bundle_dir, env=ue)
+        if layer_key:
+            reqs_layer.save(app_id, layer_key, bundle_dir, zoomdb=zoomdb)
 
     # Add settings file
     utils.render_tpl_to_file(
@@ -182,6 +370,14 @@ def bundle_app(app_id, force_bundle_name=None, return_ue=False,
         admin_media_prefix=taskconfig.DZ_ADMIN_MEDIA["url_path"],
         database_type=buildconfig_info["database_type"])
 
+    # with the python executable, before it's removed.
+    if taskconfig.BUNDLE_PRECOMPILE_BYTECODE:
+        _precompile_bundle(bundle_dir, ue, zoomdb=zoomdb)
+
+    # Remove the python executable, we don't use it
+    ue.remove(os.path.join(bundle_dir, "bin", "python"))
+    #os.remove(os.path.join(bundle_dir, "bin", "python"))
+
     if return_ue:
         return bundle_name, code_revision, ue
     else:
@@ -201,53 +397,242 @@ def get_bundle_storage_engine(default=None):
     return default
 
 
+class _ProcessOutput(object):
+    """
+    File-like object for reading a subprocess' stdout, which raises an
+    InfrastructureException at the end of the output if the process failed,
+    so that a storage engine reading it never stores incomplete output.
+    """
+
+    def __init__(self, command, **kwargs):
+        self.command = command
+        self.started_at = datetime.datetime.utcnow()
+        self.start_time = time.time()
+        self.p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                  close_fds=True, **kwargs)
+
+    def read(self, size=-1):
+        data = self.p.stdout.read(size)
+        if not data or size < 0:
+            self.wait()
+        return data
+
+    def wait(self):
+        if self.p.returncode is None:
+            self.p.stdout.close()
+            timing.wait(self.p, self.command, self.started_at,
+                        self.start_time)
+            if self.p.returncode != 0:
+                raise utils.InfrastructureException(
+                    "%s exited with status %d" % (self.command[0],
+                                                  self.p.returncode))
+
+
+def _tar_bundle_to_storage(app_dir, bundle_name, bundle_storage_engine):
+    """Tar and compress the bundle straight into the storage engine."""
+    tar_output = _ProcessOutput(
+        bundle_codecs.tar_create_command(bundle_name),
+        env=dict(PWD=app_dir),
+        cwd=app_dir)
+    try:
+        bundle_storage_engine.put_stream(bundle_name + ".tgz", tar_output)
+    finally:
+        # stop tar if the upload failed before reading all of its output.
+        try:
+            tar_output.wait()
+        except utils.InfrastructureException:
+            pass
+
+
+def _tar_bundle_to_file(app_dir, bundle_name, bundle_storage_engine):
+    """Tar and compress the bundle into a temporary file, then store it;
+    for storage engines which can't store a stream."""
+    archive_file_path = tempfile.mktemp(suffix=".tgz")
+
+    try:
+        p = subprocess.Popen(
+            bundle_codecs.tar_create_command(bundle_name, archive_file_path),
+            env=dict(PWD=app_dir),
+            cwd=app_dir,
+            close_fds=True)
+        os.waitpid(p.pid, 0)
+
+        bundle_storage_engine.put(bundle_name + ".tgz",
+                                  archive_file_path)
+
+    finally:
+        if os.path.exists(archive_file_path):
+            os.remove(archive_file_path)
+
+
+def _upload_archive(app_dir, name, bundle_storage_engine):
+    """Upload the directory ``name`` in ``app_dir`` as ``name`` + .tgz."""
+    if hasattr(bundle_storage_engine, "put_stream"):
+        _tar_bundle_to_storage(app_dir, name, bundle_storage_engine)
+    else:
+        _tar_bundle_to_file(app_dir, name, bundle_storage_engine)
+
+
+def _upload_bundle(app_dir, bundle_name, bundle_storage_engine,
+                   base_bundle=None):
+    if bundle_manifest.is_enabled(bundle_storage_engine):
+        return bundle_manifest.upload_bundle(
+            app_dir, bundle_name, bundle_storage_engine,
+            lambda name: _upload_archive(app_dir, name,
+                                         bundle_storage_engine),
+            base_bundle=base_bundle)
+    _upload_archive(app_dir, bundle_name, bundle_storage_engine)
+    return bundle_name + ".tgz"
+
+
+def static_bundle_name(bundle_name):
+    return bundle_name + STATIC_BUNDLE_SUFFIX
+
+
+def has_static_bundle(bundle_name, bundle_storage_engine):
+    """Was a static bundle (see make_static_bundle) stored with this one?"""
+    if not hasattr(bundle_storage_engine, "exists"):
+        return False
+    static_name = static_bundle_name(bundle_name)
+    return (bundle_manifest.has_manifest(static_name, bundle_storage_engine)
+            or bundle_storage_engine.exists(static_name + ".tgz"))
+
+
+def _copy_media_dir(src, dest, real_bundle_dir, _parents=()):
+    """
+    Copy a media directory into a static bundle. Symlinks to files or
+    directories within the bundle, such as those collectstatic --link makes,
+    are replaced by copies of them; other symlinks are left out, as the rest
+    of the bundle won't be there to resolve them, as are symlinks to the
+    directories being copied, which would never end.
+    """
+    parents = _parents + (os.path.realpath(src),)
+    os.mkdir(dest)
+    for name in os.listdir(src):
+        srcname = os.path.join(src, name)
+        destname = os.path.join(dest, name)
+        if os.path.islink(srcname):
+            real = os.path.realpath(srcname)
+            if not real.startswith(real_bundle_dir + os.sep):
+                continue
+            if os.path.isfile(real):
+                shutil.copy2(real, destname)
+            elif os.path.isdir(real) and real not in parents:
+                _copy_media_dir(real, destname, real_bundle_dir, parents)
+        elif os.path.isdir(srcname):
+            _copy_media_dir(srcname, destname, real_bundle_dir, parents)
+        elif os.path.isfile(srcname):
+            shutil.copy2(srcname, destname)
+    shutil.copystat(src, dest)
+
+
+def make_static_bundle(app_id, bundle_name, site_media_map):
+    """
+    Make a static bundle beside a bundle, holding just the static media
+    nginx serves from it (see utils.site_media_entries) at the same paths,
+    so that frontend proxies needn't install the whole bundle. The media
+    are then precompressed and fingerprinted (see static_assets).
+
+    Media directories outside the bundle are left out, as are symlinks
+    leading out of it, so the static bundle holds nothing the bundle
+    doesn't.
+
+    :returns: the static bundle's name.
+    """
+    app_dir, bundle_dir = utils.app_and_bundle_dirs(app_id, bundle_name)
+    static_name = static_bundle_name(bundle_name)
+    static_dir = os.path.join(app_dir, static_name)
+    real_bundle_dir = os.path.realpath(bundle_dir)
+
+    if os.path.exists(static_dir):
+        shutil.rmtree(static_dir)
+    os.mkdir(static_dir)
+
+    media_dirs = []
+    for entry in utils.site_media_entries(bundle_dir, site_media_map):
+        real_dir = os.path.realpath(entry["alias_dest"])
+        if (os.path.isdir(real_dir) and
+            real_dir.startswith(real_bundle_dir + os.sep)):
+            media_dirs.append(
+                (os.path.relpath(real_dir, real_bundle_dir),
+                 os.path.relpath(entry["alias_dest"], bundle_dir)))
+
+    # parents before the media directories within them, which they include.
+    for real_path, path in sorted(media_dirs):
+        dest = os.path.join(static_dir, real_path)
+        if not os.path.exists(dest):
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            _copy_media_dir(os.path.join(real_bundle_dir, real_path), dest,
+                            real_bundle_dir)
+            static_assets.process(dest)
+
+        # the path nginx is given may go through symlinks in the bundle,
+        # such as user-repo.
+        alias = os.path.join(static_dir, path)
+        if not os.path.lexists(alias):
+            if not os.path.isdir(os.path.dirname(alias)):
+                os.makedirs(os.path.dirname(alias))
+            os.symlink(os.path.relpath(dest, os.path.dirname(alias)), alias)
+
+    return static_name
+
+
 def zip_and_upload_bundle(app_id, bundle_name,
                           bundle_storage_engine=None,
-                          delete_after_upload=False):
+                          delete_after_upload=False,
+                          site_media_map=None,
+                          base_bundle=None):
     """
-    Task: Zip up the bundle and upload it to S3
+    Task: Zip up the bundle and upload it to S3, or upload its manifest
+    and new file contents if the storage engine supports manifests (see
+    bundle_manifest).
     :param custdir: Absolute path to the base customer directory
     :param app_id: A path such that ``os.path.join(custdir, app_id)`` is a
                    valid directory.
     :param delete_after_upload: If true, delete the bundle directory after
                                 it is uploaded.
+    :param site_media_map: If given, also upload a static bundle of the
+                           bundle's static media, for frontend proxies.
+    :param base_bundle: An earlier bundle of the app, usually the latest,
+                        whose stored file contents the bundle should share
+                        when stored as a manifest.
     """
     bundle_storage_engine = get_bundle_storage_engine(bundle_storage_engine)
 
-    archive_file_path = tempfile.mktemp(suffix=".tgz")
-
     app_dir = os.path.join(taskconfig.NR_CUSTOMER_DIR, app_id)
     bundle_dir = os.path.join(app_dir, bundle_name)
 
-    try:
-        current_dir = os.getcwd()
-
-        # change ownership in app_dir before upload
-        # because it was built inside a container
-        utils.chown_to_me(bundle_dir)
-
-        os.chdir(app_dir)
+    # change ownership in app_dir before upload
+    # because it was built inside a container
+    utils.chown_to_me(bundle_dir)
 
+    if site_media_map is not None:
+        static_name = make_static_bundle(app_id, bundle_name, site_media_map)
         try:
-            p = subprocess.Popen(
-                ["tar", "czf", archive_file_path, bundle_name],
-                env=dict(PWD=app_dir),
-                close_fds=True)
-            os.waitpid(p.pid, 0)
+            _upload_bundle(app_dir, static_name, bundle_storage_engine,
+                           base_bundle=(base_bundle and
+                                        static_bundle_name(base_bundle)))
         finally:
-            os.chdir(current_dir)
+            shutil.rmtree(os.path.join(app_dir, static_name))
 
-        bundle_storage_engine.put(bundle_name + ".tgz",
-                                  archive_file_path)
+    archive_name = _upload_bundle(app_dir, bundle_name, bundle_storage_engine,
+                                  base_bundle=base_bundle)
 
-        if delete_after_upload:
-            shutil.rmtree(bundle_dir)
+    if delete_after_upload:
+        shutil.rmtree(bundle_dir)
 
-    finally:
-        if os.path.exists(archive_file_path):
-            os.remove(archive_file_path)
+    return archive_name
 
-    return bundle_name + ".tgz"
+
+def _delete_static_bundle(bundle_name, bundle_storage_engine):
+    if not has_static_bundle(bundle_name, bundle_storage_engine):
+        return
+    static_name = static_bundle_name(bundle_name)
+    if bundle_manifest.has_manifest(static_name, bundle_storage_engine):
+        bundle_manifest.delete_manifest(static_name, bundle_storage_engine)
+    else:
+        bundle_storage_engine.delete(static_name + ".tgz")
 
 
 def delete_bundles(zoomdb, app_id, bundle_ids, bundle_storage_engine=None):
@@ -260,7 +645,13 @@ def delete_bundles(zoomdb, app_id, bundle_ids, bundle_storage_engine=None):
     for bundle_id in bundle_ids:
         bundle = zoomdb.get_bundle(bundle_id)
         try:
-            bundle_storage_engine.delete(bundle.bundle_name + ".tgz")
+            if bundle_manifest.has_manifest(bundle.bundle_name,
+                                            bundle_storage_engine):
+                bundle_manifest.delete_manifest(bundle.bundle_name,
+                                                bundle_storage_engine)
+            else:
+                bundle_storage_engine.delete(bundle.bundle_name + ".tgz")
+            _delete_static_bundle(bundle.bundle_name, bundle_storage_engine)
             zoomdb.log("Successfully deleted version '%s'." %
                        bundle.bundle_name)
         except OSError:  # TODO: catch the s3 error too
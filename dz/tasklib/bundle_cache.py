@@ -0,0 +1,129 @@
+"""
+Node-local cache of bundle archives (and manifests and packs; see
+bundle_manifest), so that reinstalling a bundle which has been removed from
+this node, e.g. for a rollback or to refresh a proxy's static files, doesn't
+need to download it from bundle storage again.
+
+Bundles never change once uploaded, so cached copies never go stale.
+"""
+
+import os
+import shutil
+import tempfile
+
+import bundle_manifest
+import taskconfig
+from cachedir import CacheDir
+
+
+def is_enabled():
+    return bool(taskconfig.BUNDLE_ARCHIVE_CACHE_DIR)
+
+
+def get_cache():
+    cache = CacheDir(taskconfig.BUNDLE_ARCHIVE_CACHE_DIR,
+                     taskconfig.BUNDLE_ARCHIVE_CACHE_MAX_BYTES)
+    # bundles belong to all the node's projects.
+    os.chmod(cache.path, 0700)
+    return cache
+
+
+def _storage_name(bundle_name, bundle_storage_engine):
+    if bundle_manifest.has_manifest(bundle_name, bundle_storage_engine):
+        return bundle_manifest.manifest_name(bundle_name)
+    return bundle_name + ".tgz"
+
+
+def _link_cached(cache, name):
+    """
+    Hard link a cache entry to a temporary name, so it can be used after
+    releasing the cache lock even if the entry is evicted meanwhile.
+
+    :returns: the temporary filename, or None if the entry isn't cached.
+    """
+    lock = cache.lock()
+    try:
+        if not cache.has(name):
+            return None
+        cache.touch(name)
+
+        while True:
+            link = tempfile.mktemp(prefix=CacheDir.TEMP_PREFIX,
+                                   dir=cache.path)
+            try:
+                os.link(cache.entry_path(name), link)
+                return link
+            except OSError:
+                if not os.path.exists(link):
+                    raise
+    finally:
+        lock.close()
+
+
+def _add_to_cache(cache, name, filename):
+    fd, cache_tmp = cache.mkstemp()
+    os.close(fd)
+    try:
+        shutil.copyfile(filename, cache_tmp)
+
+        lock = cache.lock(exclusive=True)
+        try:
+            cache.add(name, cache_tmp)
+            cache.evict()
+        finally:
+            lock.close()
+    finally:
+        if os.path.exists(cache_tmp):
+            os.remove(cache_tmp)
+
+
+def get_file(name, bundle_storage_engine):
+    """
+    Get a file, such as a bundle's archive or one of its packs (see
+    bundle_manifest), from this node's cache, or else from bundle storage,
+    adding it to the cache. Files in storage engines which keep them on this
+    node (those with get_path) aren't cached.
+
+    :returns: a private copy of the file, which the caller must remove when
+        done.
+    """
+    if not is_enabled() or hasattr(bundle_storage_engine, "get_path"):
+        return bundle_storage_engine.get(name)
+
+    cache = get_cache()
+    link = _link_cached(cache, name)
+    if link:
+        return link
+
+    # so that peers asked for it wait for it (see bundle_peers).
+    marker = cache.mark_fetching(name)
+    try:
+        filename = bundle_storage_engine.get(name)
+        try:
+            _add_to_cache(cache, name, filename)
+        except (IOError, OSError), e:
+            print "Warning: couldn't add %s to bundle cache: %s" % (name, e)
+    finally:
+        marker.close()
+    return filename
+
+
+def get_bundle_file(bundle_name, bundle_storage_engine):
+    """
+    Get a bundle's archive or manifest through this node's cache, as
+    :func:`get_file`.
+
+    :returns: (name, filename): the name of the archive or manifest in
+        bundle storage, and a private copy of it, which the caller must
+        remove when done.
+    """
+    if is_enabled() and not hasattr(bundle_storage_engine, "get_path"):
+        cache = get_cache()
+        for name in (bundle_manifest.manifest_name(bundle_name),
+                     bundle_name + ".tgz"):
+            link = _link_cached(cache, name)
+            if link:
+                return name, link
+
+    name = _storage_name(bundle_name, bundle_storage_engine)
+    return name, get_file(name, bundle_storage_engine)
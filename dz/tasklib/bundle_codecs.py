@@ -0,0 +1,123 @@
+"""
+Compression of bundle archives.
+
+Bundles are tarred and compressed with the codec chosen by
+taskconfig.BUNDLE_CODEC. Each codec's output starts with its own magic
+number, so archives record which codec made them, and are extracted with
+the right decompressor whatever the extracting node's configuration.
+Bundles keep the ``.tgz`` suffix in storage whatever their codec.
+"""
+
+import os
+
+from dz.tasklib import taskconfig
+
+# name: (magic number, compressor, its default level, max level,
+#        decompressors in order of preference)
+# compressors are given "-<level>" and, if they support threads, their
+# option for that below; tar runs decompressors with "-d".
+CODECS = {
+    "gzip": ("\x1f\x8b", "gzip", 6, 9, ("pigz", "gzip")),
+    "pigz": ("\x1f\x8b", "pigz", 6, 9, ("pigz", "gzip")),
+    "zstd": ("\x28\xb5\x2f\xfd", "zstd", 3, 19, ("zstd",)),
+    "lz4": ("\x04\x22\x4d\x18", "lz4", 1, 12, ("lz4",)),
+}
+
+_THREADS_OPTIONS = {
+    "pigz": "-p %d",
+    "zstd": "-T%d",
+}
+
+
+def _find_program(name):
+    for dirname in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        filename = os.path.join(dirname, name)
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            return filename
+    return None
+
+
+def _threads(threads):
+    if threads:
+        return threads
+    try:
+        return os.sysconf("SC_NPROCESSORS_ONLN")
+    except (ValueError, OSError):
+        return 1
+
+
+def compress_program(codec=None, level=None, threads=None):
+    """
+    Get the compression program for tar's --use-compress-program option.
+    ``codec``, ``level`` and ``threads`` default to taskconfig's
+    BUNDLE_CODEC, BUNDLE_CODEC_LEVEL and BUNDLE_CODEC_THREADS. pigz falls
+    back to gzip if it isn't installed.
+    """
+    codec = codec or taskconfig.BUNDLE_CODEC
+    if codec not in CODECS:
+        raise ValueError("Unknown bundle codec: %r" % codec)
+
+    _magic, program, default_level, max_level, _decompressors = \
+        CODECS[codec]
+    if codec == "pigz" and not _find_program("pigz"):
+        program = "gzip"
+
+    if level is None:
+        level = taskconfig.BUNDLE_CODEC_LEVEL
+    if level is None:
+        level = default_level
+    level = max(1, min(int(level), max_level))
+
+    # tar may run with a minimal environment, so use the full path.
+    args = [_find_program(program) or program, "-%d" % level]
+    if program in _THREADS_OPTIONS:
+        args.append(_THREADS_OPTIONS[program] % _threads(
+                threads or taskconfig.BUNDLE_CODEC_THREADS))
+    return " ".join(args)
+
+
+def tar_create_command(bundle_name, archive="-", **kwargs):
+    """
+    Get the command to tar and compress ``bundle_name`` (a directory in
+    the current directory) into ``archive``, stdout by default. Keyword
+    arguments are passed to :func:`compress_program`.
+    """
+    return ["tar", "-c",
+            "--use-compress-program", compress_program(**kwargs),
+            "-f", archive, bundle_name]
+
+
+def detect(archive):
+    """
+    Get the name of the codec which compressed the file ``archive``.
+
+    :raises ValueError: if it wasn't made by any known codec.
+    """
+    f = open(archive, "rb")
+    try:
+        header = f.read(max(len(c[0]) for c in CODECS.values()))
+    finally:
+        f.close()
+
+    for codec in sorted(CODECS.keys()):
+        if header.startswith(CODECS[codec][0]):
+            return codec
+    raise ValueError("Unknown compression format for %s" % archive)
+
+
+def tar_extract_command(archive, strip_components=0):
+    """Get the command to extract the bundle archive ``archive`` into the
+    current directory, with the decompressor for its codec, leaving out the
+    first ``strip_components`` directories of each path."""
+    decompressors = CODECS[detect(archive)][4]
+    for program in decompressors:
+        path = _find_program(program)
+        if path:
+            break
+    else:
+        path = program
+
+    command = ["tar", "-x", "--use-compress-program", path, "-f", archive]
+    if strip_components:
+        command.append("--strip-components=%d" % strip_components)
+    return command
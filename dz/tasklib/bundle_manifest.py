@@ -0,0 +1,464 @@
+"""
+Bundles stored as a manifest plus packs of deduplicated file contents.
+
+Rather than one archive per bundle, bundle storage can hold each bundle as a
+manifest, listing its files, their metadata and content hashes, and the
+packs holding those contents: archives, compressed with the bundle codec, of
+distinct file contents named by their SHA-1. A bundle uploaded with a base
+bundle, usually the project's previous one, uses the base's packs for the
+contents they share, so that its own pack only holds what changed; a node
+downloading it only fetches the packs holding contents missing from its
+local object cache.
+
+A bundle stores a reference to each pack it uses, and a pack is deleted
+along with the last bundle referencing it (see :func:`delete_manifest`).
+Bundles whose base uses taskconfig.BUNDLE_MAX_PACKS packs or more don't use
+them, but put all their contents in their own pack, so that no bundle needs
+many packs and packs of contents since replaced are deleted eventually.
+
+Contents are verified against their hash when downloaded, so the node's
+object cache is safe to share between projects.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+
+import bundle_codecs
+import fastcopy
+import taskconfig
+from cachedir import CacheDir
+
+MANIFEST_SUFFIX = ".manifest"
+FORMAT_VERSION = 2
+
+# a bundle's pack is stored as an archive named after the bundle plus this
+# and ".tgz", and the references to it under its name plus REFS_SUFFIX.
+PACK_SUFFIX = ".pack"
+REFS_SUFFIX = ".refs/"
+
+# entry kinds
+DIRECTORY = "d"
+FILE = "f"
+SYMLINK = "l"
+
+# how many times to fetch packs for objects evicted by other processes
+# before the download gives up.
+DOWNLOAD_ATTEMPTS = 3
+
+_BUFFER_SIZE = 1024 * 1024
+
+
+def is_enabled(bundle_storage_engine):
+    """Should bundles be stored as manifests in this storage engine?"""
+    return (taskconfig.BUNDLE_MANIFESTS_ENABLED and
+            hasattr(bundle_storage_engine, "exists") and
+            hasattr(bundle_storage_engine, "list_names"))
+
+
+def manifest_name(bundle_name):
+    return bundle_name + MANIFEST_SUFFIX
+
+
+def has_manifest(bundle_name, bundle_storage_engine):
+    """Is the bundle stored as a manifest, rather than as an archive?"""
+    return (hasattr(bundle_storage_engine, "exists") and
+            bundle_storage_engine.exists(manifest_name(bundle_name)))
+
+
+def pack_name(bundle_name):
+    return bundle_name + PACK_SUFFIX
+
+
+def pack_archive_name(pack):
+    return pack + ".tgz"
+
+
+def _ref_name(pack, bundle_name):
+    return pack + REFS_SUFFIX + bundle_name
+
+
+def file_digest(filename):
+    h = hashlib.sha1()
+    f = open(filename, "rb")
+    try:
+        while True:
+            buf = f.read(_BUFFER_SIZE)
+            if not buf:
+                break
+            h.update(buf)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def make_manifest(bundle_dir):
+    """
+    Make the manifest of a bundle directory.
+
+    :returns: dict with the manifest's "version" and its "entries", a list
+        of [path, kind, mode, mtime, digest or symlink target or None] with
+        paths relative to ``bundle_dir`` ("" for ``bundle_dir`` itself),
+        parent directories before their contents.
+    """
+    entries = []
+
+    def add_entry(path, kind, st, value=None):
+        entries.append([path[len(bundle_dir) + 1:], kind,
+                        st.st_mode & 07777, int(st.st_mtime), value])
+
+    add_entry(bundle_dir, DIRECTORY, os.stat(bundle_dir))
+    for dirpath, dirnames, filenames in os.walk(bundle_dir):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                add_entry(path, SYMLINK, st, os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                add_entry(path, DIRECTORY, st)
+            elif stat.S_ISREG(st.st_mode):
+                add_entry(path, FILE, st, file_digest(path))
+
+    return {"version": FORMAT_VERSION, "entries": entries}
+
+
+def _file_digests(manifest):
+    return set(str(e[4]) for e in manifest["entries"] if e[1] == FILE)
+
+
+def _load_manifest(bundle_name, filename):
+    f = open(filename)
+    try:
+        manifest = json.load(f)
+    finally:
+        f.close()
+
+    if manifest["version"] != FORMAT_VERSION:
+        raise ValueError("Unsupported manifest version %r for bundle %s" % (
+                manifest["version"], bundle_name))
+    return manifest
+
+
+def _get_manifest(bundle_name, bundle_storage_engine):
+    filename = bundle_storage_engine.get(manifest_name(bundle_name))
+    try:
+        return _load_manifest(bundle_name, filename)
+    finally:
+        os.remove(filename)
+
+
+def _put_manifest(bundle_name, manifest, bundle_storage_engine):
+    (fd, manifest_file) = tempfile.mkstemp(suffix=MANIFEST_SUFFIX)
+    try:
+        f = os.fdopen(fd, "w")
+        try:
+            json.dump(manifest, f)
+        finally:
+            f.close()
+        bundle_storage_engine.put(manifest_name(bundle_name), manifest_file)
+    finally:
+        os.remove(manifest_file)
+
+
+def _add_ref(pack, bundle_name, bundle_storage_engine):
+    (fd, ref_file) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        bundle_storage_engine.put(_ref_name(pack, bundle_name), ref_file)
+    finally:
+        os.remove(ref_file)
+
+
+def _release_pack(pack, bundle_name, bundle_storage_engine):
+    """
+    Remove the bundle's reference to a pack, and delete the pack if no
+    other bundle references it.
+    """
+    ref = _ref_name(pack, bundle_name)
+    if bundle_storage_engine.exists(ref):
+        bundle_storage_engine.delete(ref)
+    if (not bundle_storage_engine.list_names(pack + REFS_SUFFIX) and
+        bundle_storage_engine.exists(pack_archive_name(pack))):
+        bundle_storage_engine.delete(pack_archive_name(pack))
+
+
+def _release_packs(packs, bundle_name, bundle_storage_engine):
+    for pack in packs:
+        try:
+            _release_pack(pack, bundle_name, bundle_storage_engine)
+        except Exception, e:
+            print "Warning: couldn't release bundle pack %s: %s" % (pack, e)
+
+
+def _base_packs(base_bundle, digests, bundle_storage_engine):
+    """
+    Get the packs of ``base_bundle`` holding any of ``digests``, unless it
+    uses too many packs (see the module's docstring).
+
+    :returns: a dict mapping pack names to the digests they're used for.
+    """
+    if base_bundle is None or not has_manifest(base_bundle,
+                                               bundle_storage_engine):
+        return {}
+
+    try:
+        base_packs = _get_manifest(base_bundle, bundle_storage_engine)["packs"]
+    except (KeyError, ValueError):
+        return {}  # deleted meanwhile, or an older format
+    if len(base_packs) >= taskconfig.BUNDLE_MAX_PACKS:
+        return {}
+
+    packs = {}
+    for pack, pack_digests in base_packs.items():
+        used = digests.intersection(pack_digests)
+        if used:
+            packs[str(pack)] = sorted(used)
+    return packs
+
+
+def _upload_pack(app_dir, bundle_name, manifest, digests, upload_archive):
+    """Upload a pack of the bundle's files with these digests."""
+    bundle_dir = os.path.join(app_dir, bundle_name)
+    pack = pack_name(bundle_name)
+    pack_dir = os.path.join(app_dir, pack)
+    os.mkdir(pack_dir)
+    try:
+        for path, kind, mode, mtime, digest in manifest["entries"]:
+            if kind != FILE or digest not in digests:
+                continue
+            dest = os.path.join(pack_dir, digest)
+            if not os.path.exists(dest):
+                fastcopy.copyfile(os.path.join(bundle_dir, path), dest,
+                                  hardlink=True)
+        upload_archive(pack)
+    finally:
+        shutil.rmtree(pack_dir)
+
+
+def upload_bundle(app_dir, bundle_name, bundle_storage_engine,
+                  upload_archive, base_bundle=None):
+    """
+    Upload the bundle ``bundle_name`` in ``app_dir``: a pack of the file
+    contents which the packs of ``base_bundle`` (an earlier bundle, if
+    given) don't hold, then its manifest.
+
+    :param upload_archive: function to upload a directory in ``app_dir``,
+        given its name, as an archive named after it plus ".tgz".
+    :returns: the name of the bundle's manifest in storage.
+    """
+    bundle_dir = os.path.join(app_dir, bundle_name)
+    manifest = make_manifest(bundle_dir)
+    digests = _file_digests(manifest)
+
+    packs = _base_packs(base_bundle, digests, bundle_storage_engine)
+    try:
+        # the base's packs aren't deleted while it references them, and
+        # stay as long as we do once we reference them too; so they're safe
+        # to use if the base is still there after that.
+        for pack in packs:
+            _add_ref(pack, bundle_name, bundle_storage_engine)
+        if packs and not has_manifest(base_bundle, bundle_storage_engine):
+            _release_packs(packs, bundle_name, bundle_storage_engine)
+            packs = {}
+
+        new_digests = digests.difference(*packs.values())
+        if new_digests:
+            pack = pack_name(bundle_name)
+            packs[pack] = sorted(new_digests)
+            _add_ref(pack, bundle_name, bundle_storage_engine)
+            _upload_pack(app_dir, bundle_name, manifest, new_digests,
+                         upload_archive)
+
+        # the manifest goes last, so a bundle's packs are all there before
+        # it can be downloaded.
+        manifest["packs"] = packs
+        _put_manifest(bundle_name, manifest, bundle_storage_engine)
+    except:
+        exc_info = sys.exc_info()
+        _release_packs(packs, bundle_name, bundle_storage_engine)
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    return manifest_name(bundle_name)
+
+
+def copy_manifest(bundle_name, new_bundle_name, bundle_storage_engine):
+    """
+    Store a bundle's manifest again under a new bundle name, referencing
+    the same packs, so the new bundle needs no uploads of its own.
+
+    :returns: the name of the new bundle's manifest in storage.
+    """
+    manifest = _get_manifest(bundle_name, bundle_storage_engine)
+    packs = manifest["packs"]
+    try:
+        # as for upload_bundle's base.
+        for pack in packs:
+            _add_ref(pack, new_bundle_name, bundle_storage_engine)
+        if not has_manifest(bundle_name, bundle_storage_engine):
+            raise KeyError("Bundle %s was deleted while copying it" %
+                           bundle_name)
+        _put_manifest(new_bundle_name, manifest, bundle_storage_engine)
+    except:
+        exc_info = sys.exc_info()
+        _release_packs(packs, new_bundle_name, bundle_storage_engine)
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    return manifest_name(new_bundle_name)
+
+
+def get_object_cache():
+    cache = CacheDir(taskconfig.BUNDLE_OBJECT_CACHE_DIR,
+                     taskconfig.BUNDLE_OBJECT_CACHE_MAX_BYTES)
+    # objects come from all projects' bundles.
+    os.chmod(cache.path, 0700)
+    return cache
+
+
+def _add_pack_to_cache(cache, pack, pack_file, digests):
+    """
+    Extract the objects with these digests from a pack into the cache,
+    checking them against their hashes.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix=CacheDir.TEMP_PREFIX, dir=cache.path)
+    try:
+        p = subprocess.Popen(bundle_codecs.tar_extract_command(pack_file),
+                             cwd=tmp_dir, close_fds=True)
+        if p.wait() != 0:
+            raise IOError("Couldn't extract bundle storage pack %s" % pack)
+
+        pack_dir = os.path.join(tmp_dir, pack)
+        for digest in digests:
+            filename = os.path.join(pack_dir, digest)
+            if (not os.path.exists(filename) or
+                not stat.S_ISREG(os.lstat(filename).st_mode) or
+                file_digest(filename) != digest):
+                raise IOError("Bundle storage pack %s has no valid object "
+                              "%s" % (pack, digest))
+
+        lock = cache.lock(exclusive=True)
+        try:
+            for digest in digests:
+                cache.add(digest, os.path.join(pack_dir, digest))
+                # the object has its archive's mtime, which would make it
+                # the first to be evicted.
+                cache.touch(digest)
+        finally:
+            lock.close()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _write_bundle(manifest, bundle_dir, object_path):
+    """
+    Recreate a bundle from its manifest, copying file contents from
+    ``object_path(digest)``.
+    """
+    dirs = []
+    for path, kind, mode, mtime, value in manifest["entries"]:
+        # json gives us unicode; file names were utf-8 encoded to make it.
+        path = path.encode("utf-8")
+        dest = os.path.join(bundle_dir, path) if path else bundle_dir
+        if kind == DIRECTORY:
+            os.mkdir(dest)
+            dirs.append((dest, mode, mtime))
+        elif kind == SYMLINK:
+            os.symlink(value.encode("utf-8"), dest)
+        else:
+            shutil.copyfile(object_path(str(value)), dest)
+            os.chmod(dest, mode)
+            os.utime(dest, (mtime, mtime))
+
+    # after their contents, which could change them.
+    for dest, mode, mtime in reversed(dirs):
+        os.chmod(dest, mode)
+        os.utime(dest, (mtime, mtime))
+
+
+def download_bundle(bundle_name, app_dir, bundle_storage_engine,
+                    manifest_file=None, get_file=None):
+    """
+    Download a bundle stored as a manifest into ``app_dir``, fetching the
+    packs holding objects missing from the node's object cache.
+
+    :param manifest_file: a copy of the bundle's manifest, if the caller
+        already has one; otherwise it's fetched from storage.
+    :param get_file: function to get a private copy of a file in storage,
+        given its name, which the caller removes; by default the storage
+        engine's get, but e.g. bundle_cache.get_file.
+    :raises KeyError: if the bundle has no manifest in storage.
+    :raises IOError: if its packs don't hold all its objects, or they keep
+        being evicted before the bundle can be written.
+    """
+    if manifest_file is None:
+        manifest = _get_manifest(bundle_name, bundle_storage_engine)
+    else:
+        manifest = _load_manifest(bundle_name, manifest_file)
+
+    if get_file is None:
+        get_file = bundle_storage_engine.get
+
+    digests = _file_digests(manifest)
+    uncovered = digests.difference(*manifest["packs"].values())
+    if uncovered:
+        raise IOError("Manifest of bundle %s lists objects in no pack: %s" %
+                      (bundle_name, ", ".join(sorted(uncovered))))
+    cache = get_object_cache()
+
+    # other processes may evict objects until we hold a shared lock, so
+    # check for them again once we have it.
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        missing = set(d for d in digests if not cache.has(d))
+        for pack, pack_digests in manifest["packs"].items():
+            pack = str(pack)
+            needed = missing.intersection(pack_digests)
+            if not needed:
+                continue
+            pack_file = get_file(pack_archive_name(pack))
+            try:
+                _add_pack_to_cache(cache, pack, pack_file, needed)
+            finally:
+                os.remove(pack_file)
+
+        lock = cache.lock()
+        try:
+            if [d for d in digests if not cache.has(d)]:
+                continue
+            for digest in digests:
+                cache.touch(digest)
+            _write_bundle(manifest, os.path.join(app_dir, bundle_name),
+                          cache.entry_path)
+            break
+        finally:
+            lock.close()
+    else:
+        raise IOError("Objects of bundle %s were evicted from the object "
+                      "cache %d times while downloading it." % (
+                          bundle_name, DOWNLOAD_ATTEMPTS))
+
+    lock = cache.lock(exclusive=True)
+    try:
+        cache.evict()
+    finally:
+        lock.close()
+
+
+def delete_manifest(bundle_name, bundle_storage_engine):
+    """
+    Delete a bundle's manifest, if it has one, and then the packs no other
+    bundle references.
+    """
+    if not has_manifest(bundle_name, bundle_storage_engine):
+        return
+
+    packs = _get_manifest(bundle_name, bundle_storage_engine)["packs"]
+    bundle_storage_engine.delete(manifest_name(bundle_name))
+
+    # only after deleting the manifest; see upload_bundle.
+    for pack in packs:
+        _release_pack(str(pack), bundle_name, bundle_storage_engine)
@@ -0,0 +1,325 @@
+"""
+Serving bundles between nodes, so that deploying a bundle to many nodes at
+once doesn't have every one of them download it from bundle storage.
+
+Each node runs a small HTTP server (in whichever of its celeryd processes
+starts it first) serving the bundle archives, manifests and packs in its
+bundle cache (see bundle_cache and bundle_manifest). A node deploying a bundle may be given peers deploying it
+at the same time, which it gets the bundle from through
+:class:`PeerStorage`, falling back to bundle storage if they can't provide
+it. :func:`fanout_peers` arranges the nodes of a deploy in a tree, so only
+the first downloads the bundle from storage.
+
+A peer asked for something it is busy fetching itself waits a while for it
+to turn up; it answers 404 at once for anything else it doesn't have.
+
+Bundles hold projects' code and settings, so requests carry a token: an
+expiry time and an HMAC of it and the name they ask for, keyed with
+taskconfig.BUNDLE_PEER_SECRET, so a token overheard can't be used for other
+names or replayed later. With no secret set, nodes neither serve nor fetch
+bundles from peers. Objects from packs
+fetched from peers are verified against their hash like those from storage.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import errno
+import hashlib
+import hmac
+import httplib
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import bundle_cache
+import bundle_manifest
+import taskconfig
+
+TOKEN_HEADER = "X-Bundle-Peer-Token"
+
+_BUFFER_SIZE = 1024 * 1024
+_POLL_INTERVAL = 0.5
+
+_BUNDLE_FILE_RE = re.compile(r"^\w[\w.-]*(\.tgz|%s)$" %
+                             re.escape(bundle_manifest.MANIFEST_SUFFIX))
+
+# the server running in this process, and the process it was started in; a
+# forked child doesn't inherit its thread.
+_server = None
+_server_pid = None
+_server_lock = threading.Lock()
+
+
+def is_enabled():
+    return bool(taskconfig.BUNDLE_PEER_SECRET)
+
+
+def _signature(name, expires):
+    return hmac.new(taskconfig.BUNDLE_PEER_SECRET, "%s\n%d" % (name, expires),
+                    hashlib.sha1).hexdigest()
+
+
+def _token(name, expires=None):
+    """Make a token for ``name``, valid until ``expires`` (by default
+    taskconfig.BUNDLE_PEER_TOKEN_TTL seconds from now)."""
+    if expires is None:
+        expires = int(time.time()) + taskconfig.BUNDLE_PEER_TOKEN_TTL
+    return "%d:%s" % (expires, _signature(name, expires))
+
+
+def _tokens_match(a, b):
+    """Compare tokens in time independent of where they differ."""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def _token_is_valid(token, name):
+    try:
+        expires, signature = token.split(":", 1)
+        expires = int(expires)
+    except ValueError:
+        return False
+    return (expires >= time.time() and
+            _tokens_match(signature, _signature(name, expires)))
+
+
+def _cache_entry(name):
+    """
+    Find where this node would keep the bundle storage file ``name``.
+
+    :returns: (cache, entry name), or (None, None) if nowhere.
+    """
+    if _BUNDLE_FILE_RE.match(name) and bundle_cache.is_enabled():
+        return bundle_cache.get_cache(), name
+
+    return None, None
+
+
+def _open_entry(cache, name, wait):
+    """
+    Open a cache entry, waiting up to ``wait`` seconds for it to be added
+    if it is being fetched. The open file stays usable if the entry is
+    evicted meanwhile.
+
+    :returns: the open file, or None if the entry didn't turn up.
+    """
+    deadline = time.time() + wait
+    while True:
+        # checked first: a fetch which ends after this adds the entry
+        # before we look for it.
+        fetching = cache.is_fetching(name)
+
+        lock = cache.lock()
+        try:
+            if cache.has(name):
+                cache.touch(name)
+                return open(cache.entry_path(name), "rb")
+        finally:
+            lock.close()
+
+        if not fetching or time.time() >= deadline:
+            return None
+        time.sleep(_POLL_INTERVAL)
+
+
+class _PeerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        name = self.path.lstrip("/")
+
+        if not _token_is_valid(self.headers.get(TOKEN_HEADER, ""), name):
+            self.send_error(httplib.FORBIDDEN)
+            return
+
+        cache, entry = _cache_entry(name)
+        f = None
+        if cache is not None:
+            f = _open_entry(cache, entry, taskconfig.BUNDLE_PEER_WAIT)
+        if f is None:
+            self.send_error(httplib.NOT_FOUND)
+            return
+
+        try:
+            self.send_response(httplib.OK)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length",
+                             str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, _BUFFER_SIZE)
+        finally:
+            f.close()
+
+    def log_message(self, format, *args):
+        pass  # celeryd's log needn't have a line for every object served.
+
+
+class _PeerServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_server():
+    """
+    Start serving this node's bundles to its peers in the background, unless
+    this or another process on the node already is.
+    """
+    global _server, _server_pid
+
+    if not is_enabled():
+        return
+
+    _server_lock.acquire()
+    try:
+        if _server is not None and _server_pid == os.getpid():
+            return
+
+        try:
+            server = _PeerServer(("", taskconfig.BUNDLE_PEER_PORT),
+                                 _PeerRequestHandler)
+        except socket.error, e:
+            if e.errno != errno.EADDRINUSE:
+                print "Warning: couldn't serve bundles to peers: %s" % e
+            return
+
+        t = threading.Thread(target=server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        _server = server
+        _server_pid = os.getpid()
+    finally:
+        _server_lock.release()
+
+
+def stop_server():
+    """Stop the server started by this process, if any."""
+    global _server
+
+    _server_lock.acquire()
+    try:
+        if _server is not None and _server_pid == os.getpid():
+            _server.shutdown()
+            _server.server_close()
+        _server = None
+    finally:
+        _server_lock.release()
+
+
+def _save_response(response):
+    """
+    Save a response's body to a temporary file.
+
+    :raises IOError: if the body is cut short.
+    """
+    expected = int(response.getheader("Content-Length"))
+    (fd, tmpfilename) = tempfile.mkstemp(prefix="tmpbundle")
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            received = 0
+            while True:
+                data = response.read(_BUFFER_SIZE)
+                if not data:
+                    break
+                f.write(data)
+                received += len(data)
+        finally:
+            f.close()
+
+        if received != expected:
+            raise IOError("Got %d of %d bytes" % (received, expected))
+    except:
+        os.remove(tmpfilename)
+        raise
+
+    return tmpfilename
+
+
+def _get_from_peer(peer, name):
+    """
+    Get the bundle storage object ``name`` from a peer. A peer not serving
+    yet, e.g. because its deploy task hasn't started, is retried for up to
+    taskconfig.BUNDLE_PEER_WAIT seconds.
+
+    :returns: path to a temporary file containing it, or None if the peer
+        couldn't provide it.
+    """
+    deadline = time.time() + taskconfig.BUNDLE_PEER_WAIT
+    # the peer may wait BUNDLE_PEER_WAIT itself before answering.
+    timeout = taskconfig.BUNDLE_PEER_WAIT + taskconfig.BUNDLE_PEER_TIMEOUT
+
+    while True:
+        conn = httplib.HTTPConnection(peer, taskconfig.BUNDLE_PEER_PORT,
+                                      timeout=timeout)
+        try:
+            conn.request("GET", "/" + name,
+                         headers={TOKEN_HEADER: _token(name)})
+            response = conn.getresponse()
+            if response.status != httplib.OK:
+                return None
+            return _save_response(response)
+
+        except (IOError, httplib.HTTPException), e:
+            if (getattr(e, "errno", None) == errno.ECONNREFUSED and
+                time.time() < deadline):
+                time.sleep(1)
+                continue
+            print "Warning: couldn't get %s from peer %s: %s" % (name, peer,
+                                                                  e)
+            return None
+
+        finally:
+            conn.close()
+
+
+class PeerStorage(object):
+    """
+    Bundle storage engine getting bundles from ``peers`` (host names) where
+    it can, and otherwise from ``bundle_storage_engine``, which it also uses
+    for everything besides getting bundles.
+    """
+
+    def __init__(self, bundle_storage_engine, peers):
+        self.bundle_storage_engine = bundle_storage_engine
+        self.peers = list(peers)
+
+    def __getattr__(self, attr):
+        return getattr(self.bundle_storage_engine, attr)
+
+    def get(self, bundle_name):
+        """
+        Get a bundle (or other object) by name, from a peer if possible.
+
+        :returns: Path to a temporary file containing it.
+        """
+        for peer in self.peers:
+            filename = _get_from_peer(peer, bundle_name)
+            if filename is not None:
+                return filename
+        return self.bundle_storage_engine.get(bundle_name)
+
+
+def fanout_peers(appservers, fanout=None):
+    """
+    Choose peers for appservers deploying a bundle at the same time. They
+    form a tree: each gets the bundle from its parent, so only the first
+    downloads it from bundle storage, and none serves more than ``fanout``
+    (default taskconfig.BUNDLE_PEER_FANOUT) others.
+
+    :returns: a list of peers for each appserver, in the same order.
+    """
+    fanout = fanout or taskconfig.BUNDLE_PEER_FANOUT
+    peers = []
+    for i, appserver in enumerate(appservers):
+        parent = appservers[(i - 1) // fanout] if i else None
+        if is_enabled() and parent not in (None, appserver):
+            peers.append([parent])
+        else:
+            peers.append([])
+    return peers
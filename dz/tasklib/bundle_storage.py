@@ -1,17 +1,257 @@
 """
 Bundle storage using S3.
+
+Connections to S3 and their bucket handles are pooled per process, so that
+the tasks a celeryd process runs reuse kept-alive connections rather than
+connecting and looking up the bucket for every operation.
+
+Bundles bigger than taskconfig.BUNDLE_TRANSFER_PART_SIZE are uploaded and
+downloaded in parts of that size, up to
+taskconfig.BUNDLE_TRANSFER_CONCURRENCY at once, each on its own connection.
+Each part is checked by S3 against its MD5 on upload, and whole bundles are
+checked against their ETag after uploading and downloading them; the part
+size is kept in the object's metadata for that.
 """
 
+import hashlib
+import os
+import sys
 import tempfile
+import threading
+import Queue
+from contextlib import contextmanager
+from cStringIO import StringIO
 
 from dz.tasklib import taskconfig
-from boto.s3.connection import S3Connection
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
+
+# the metadata recording the part size of objects uploaded in parts, without
+# which their ETags can't be checked.
+PART_SIZE_METADATA = "part-size"
+
+# idle (connection, bucket) pairs, and the process they were made in; a
+# forked child mustn't share its parent's connections.
+_idle_buckets = Queue.Queue()
+_idle_buckets_pid = os.getpid()
+_idle_buckets_lock = threading.Lock()
+
+
+def _connect():
+    if not taskconfig.BUNDLE_STORAGE_S3_HOST:
+        return S3Connection()
+
+    # a local stand-in for S3, e.g. for testing.
+    return S3Connection(host=taskconfig.BUNDLE_STORAGE_S3_HOST,
+                        port=taskconfig.BUNDLE_STORAGE_S3_PORT,
+                        is_secure=taskconfig.BUNDLE_STORAGE_S3_IS_SECURE,
+                        calling_format=OrdinaryCallingFormat())
+
+
+def _get_idle_buckets():
+    global _idle_buckets, _idle_buckets_pid
+
+    _idle_buckets_lock.acquire()
+    try:
+        if _idle_buckets_pid != os.getpid():
+            _idle_buckets = Queue.Queue()
+            _idle_buckets_pid = os.getpid()
+        return _idle_buckets
+    finally:
+        _idle_buckets_lock.release()
+
+
+@contextmanager
+def _bucket():
+    """
+    Borrow a handle on our bucket from the pool, making a new connection if
+    none is idle. boto reconnects by itself if a kept-alive connection has
+    been closed meanwhile.
+    """
+    idle_buckets = _get_idle_buckets()
+    try:
+        connection, bucket = idle_buckets.get_nowait()
+    except Queue.Empty:
+        connection = _connect()
+        bucket = connection.get_bucket(taskconfig.NR_BUNDLE_BUCKET)
+
+    try:
+        yield bucket
+    finally:
+        max_idle = taskconfig.BUNDLE_STORAGE_MAX_IDLE_CONNECTIONS
+        if idle_buckets.qsize() < max_idle:
+            idle_buckets.put((connection, bucket))
+        else:
+            connection.close()
+
+
+class _TransferPool(object):
+    """
+    Threads running transfer functions, each given a bucket handle of its
+    own as first argument. At most ``concurrency`` functions wait to run, so
+    submitting more blocks until the threads catch up.
+    """
+
+    def __init__(self, concurrency=None):
+        concurrency = max(1, concurrency or
+                          taskconfig.BUNDLE_TRANSFER_CONCURRENCY)
+        self.tasks = Queue.Queue(concurrency)
+        self.error = None
+        self.threads = []
+        for i in range(concurrency):
+            t = threading.Thread(target=self._work)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
 
+    def _run_tasks(self, bucket):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            # once one part has failed, don't bother with the rest.
+            if self.error is not None:
+                continue
+            try:
+                task[0](bucket, *task[1:])
+            except:
+                self.error = sys.exc_info()
 
-def _get_bucket():
-    connection = S3Connection()
-    bucket = connection.get_bucket(taskconfig.NR_BUNDLE_BUCKET)
-    return bucket
+    def _work(self):
+        finished = False
+        try:
+            with _bucket() as bucket:
+                self._run_tasks(bucket)
+                finished = True
+        except:
+            # we couldn't connect: fail, but keep taking (and skipping)
+            # tasks until told to stop, so submit() and join() don't block.
+            self.error = sys.exc_info()
+        if not finished:
+            self._run_tasks(None)
+
+    def check(self):
+        """Raise the first exception any transfer function raised."""
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def submit(self, func, *args):
+        self.check()
+        self.tasks.put((func,) + args)
+
+    def join(self):
+        for t in self.threads:
+            self.tasks.put(None)
+        for t in self.threads:
+            t.join()
+
+
+def _multipart_etag(part_md5s):
+    """The ETag S3 gives an object uploaded in parts with these MD5s."""
+    return "%s-%d" % (hashlib.md5("".join(part_md5s)).hexdigest(),
+                      len(part_md5s))
+
+
+def _file_md5s(filename, part_size):
+    part_md5s = []
+    f = open(filename, "rb")
+    try:
+        while True:
+            data = f.read(part_size)
+            if not data:
+                break
+            part_md5s.append(hashlib.md5(data).digest())
+    finally:
+        f.close()
+    return part_md5s
+
+
+def _check_etag(bundle_name, etag, filename, part_size=None):
+    """
+    Check a file's content against the ETag of the S3 object it was
+    uploaded to or downloaded from: the content's MD5, or for multipart
+    uploads, the MD5 of its parts' MD5s. Objects uploaded in parts can only
+    be checked given the ``part_size`` they were uploaded with.
+
+    :raises IOError: if the content doesn't match.
+    """
+    etag = etag.strip('"')
+    if "-" in etag:
+        if not part_size:
+            return
+        expected = _multipart_etag(_file_md5s(filename, part_size))
+    else:
+        md5 = hashlib.md5()
+        f = open(filename, "rb")
+        try:
+            for data in iter(lambda: f.read(1024 * 1024), ""):
+                md5.update(data)
+        finally:
+            f.close()
+        expected = md5.hexdigest()
+
+    if expected != etag:
+        raise IOError("Checksum mismatch for bundle %s: S3 has ETag %s, "
+                      "but the local copy's is %s" % (bundle_name, etag,
+                                                      expected))
+
+
+def _upload_part(bucket, mp, part_num, data, part_md5s):
+    # a handle on the upload for this thread's own connection.
+    part_mp = MultiPartUpload(bucket)
+    part_mp.key_name = mp.key_name
+    part_mp.id = mp.id
+
+    part_md5s[part_num - 1] = hashlib.md5(data).digest()
+    # boto sends the part's MD5, which S3 checks.
+    part_mp.upload_part_from_file(StringIO(data), part_num)
+
+
+def _upload_file_part(bucket, mp, part_num, filename, part_md5s):
+    part_size = taskconfig.BUNDLE_TRANSFER_PART_SIZE
+    f = open(filename, "rb")
+    try:
+        f.seek((part_num - 1) * part_size)
+        data = f.read(part_size)
+    finally:
+        f.close()
+    _upload_part(bucket, mp, part_num, data, part_md5s)
+
+
+def _multipart_upload(bundle_name, part_size, submit_parts):
+    """
+    Upload a bundle in parts of ``part_size``: ``submit_parts(pool, mp,
+    part_md5s)`` must submit one of the upload functions above to the pool
+    for each part, and return the number of parts. The upload is only
+    completed if all the parts were uploaded, and is checked against their
+    MD5s.
+    """
+    with _bucket() as bucket:
+        mp = bucket.initiate_multipart_upload(
+            bundle_name, policy="private",
+            metadata={PART_SIZE_METADATA: str(part_size)})
+
+        try:
+            part_md5s = {}
+            pool = _TransferPool()
+            try:
+                num_parts = submit_parts(pool, mp, part_md5s)
+            finally:
+                pool.join()
+            pool.check()
+
+            result = mp.complete_upload()
+        except:
+            mp.cancel_upload()
+            raise
+
+        expected = _multipart_etag([part_md5s[i] for i in range(num_parts)])
+        if result.etag.strip('"') != expected:
+            bucket.delete_key(bundle_name)
+            raise IOError("Checksum mismatch uploading bundle %s: S3 has "
+                          "ETag %s, expected %s" % (bundle_name, result.etag,
+                                                    expected))
 
 
 def put(bundle_name, filename):
@@ -20,8 +260,156 @@ def put(bundle_name, filename):
 
     :returns: None
     """
-    key = _get_bucket().new_key(bundle_name)
-    key.set_contents_from_file(open(filename), policy="private")
+    part_size = taskconfig.BUNDLE_TRANSFER_PART_SIZE
+    size = os.path.getsize(filename)
+
+    if size <= part_size:
+        with _bucket() as bucket:
+            key = bucket.new_key(bundle_name)
+            f = open(filename, "rb")
+            try:
+                # boto sends the content's MD5, which S3 checks.
+                key.set_contents_from_file(f, policy="private")
+            finally:
+                f.close()
+        return
+
+    def submit_parts(pool, mp, part_md5s):
+        num_parts = (size + part_size - 1) // part_size
+        for part_num in range(1, num_parts + 1):
+            pool.submit(_upload_file_part, mp, part_num, filename, part_md5s)
+        return num_parts
+
+    _multipart_upload(bundle_name, part_size, submit_parts)
+
+
+def _read_part(fileobj, size):
+    """Read ``size`` bytes from ``fileobj``, or as many as it has left."""
+    chunks = []
+    while size > 0:
+        chunk = fileobj.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+
+def _read_parts_in_background(fileobj, part_size):
+    """
+    Read ``fileobj`` in parts on another thread, a couple of parts ahead
+    of the caller, so that whatever writes it isn't held up while we upload.
+    Closing the iterator (or dropping it) stops reading, once the part being
+    read has been.
+
+    :returns: iterator over the parts.
+    """
+    parts = Queue.Queue(2)
+    stop = threading.Event()
+
+    def read_parts():
+        try:
+            while not stop.isSet():
+                part = _read_part(fileobj, part_size)
+                parts.put((part, None))
+                if len(part) < part_size:
+                    return
+        except Exception, e:
+            parts.put((None, e))
+
+    t = threading.Thread(target=read_parts)
+    t.setDaemon(True)
+    t.start()
+
+    try:
+        while True:
+            part, error = parts.get()
+            if error is not None:
+                raise error
+            yield part
+            if len(part) < part_size:
+                return
+    finally:
+        # make room for the part being read, so the thread can see it has
+        # to stop, and wait for it, so that nothing else reads (or closes)
+        # fileobj meanwhile.
+        stop.set()
+        while t.isAlive():
+            try:
+                while True:
+                    parts.get_nowait()
+            except Queue.Empty:
+                pass
+            t.join(0.1)
+
+
+def put_stream(bundle_name, fileobj):
+    """
+    Upload a bundle to our bucket on S3 from a file-like object, such as a
+    pipe, while it is being read. Bundles bigger than
+    taskconfig.BUNDLE_TRANSFER_PART_SIZE are uploaded in parts of that size,
+    by a multipart upload which is only completed once the whole of
+    ``fileobj`` has been read successfully.
+
+    :returns: None
+    """
+    part_size = taskconfig.BUNDLE_TRANSFER_PART_SIZE
+    parts = _read_parts_in_background(fileobj, part_size)
+    try:
+        first_part = parts.next()
+        if len(first_part) < part_size:
+            with _bucket() as bucket:
+                key = bucket.new_key(bundle_name)
+                key.set_contents_from_string(first_part, policy="private")
+            return
+
+        def submit_parts(pool, mp, part_md5s):
+            pool.submit(_upload_part, mp, 1, first_part, part_md5s)
+            num_parts = 1
+            for part in parts:
+                if not part:
+                    break
+                num_parts += 1
+                pool.submit(_upload_part, mp, num_parts, part, part_md5s)
+            return num_parts
+
+        _multipart_upload(bundle_name, part_size, submit_parts)
+    finally:
+        # stop reading ahead if the upload failed.
+        parts.close()
+
+
+def exists(bundle_name):
+    """Is there a bundle (or other object) by this name on S3?"""
+    with _bucket() as bucket:
+        return bucket.get_key(bundle_name) is not None
+
+
+def copy(bundle_name, new_bundle_name):
+    """Copy a bundle (or other object) to a new name within S3, without
+    downloading it."""
+    with _bucket() as bucket:
+        if bucket.get_key(bundle_name) is None:
+            raise KeyError("No such bundle: %s" % bundle_name)
+        bucket.copy_key(new_bundle_name, bucket.name, bundle_name,
+                        preserve_acl=True)
+
+
+def list_names(prefix):
+    """List the names of the bundles (and other objects) on S3 starting
+    with ``prefix``."""
+    with _bucket() as bucket:
+        return [key.name for key in bucket.list(prefix=prefix)]
+
+
+def _download_range(bucket, bundle_name, filename, start, end):
+    f = open(filename, "r+b")
+    try:
+        f.seek(start)
+        Key(bucket, bundle_name).get_contents_to_file(
+            f, headers={"Range": "bytes=%d-%d" % (start, end)})
+    finally:
+        f.close()
 
 
 def get(bundle_name):
@@ -29,13 +417,42 @@ def get(bundle_name):
 
     :returns: Path to a temporary file containing the bundle.
     """
-    key = _get_bucket().get_key(bundle_name)
+    part_size = taskconfig.BUNDLE_TRANSFER_PART_SIZE
+
+    with _bucket() as bucket:
+        key = bucket.get_key(bundle_name)
+
+        if key is None:
+            raise KeyError("No such bundle: %s" % bundle_name)
+
+        (fd, tmpfilename) = tempfile.mkstemp(prefix="tmpbundle")
+        os.close(fd)
+
+        try:
+            if key.size <= part_size:
+                key.get_contents_to_filename(tmpfilename)
+        except:
+            os.remove(tmpfilename)
+            raise
+
+    try:
+        if key.size > part_size:
+            pool = _TransferPool()
+            try:
+                for start in range(0, key.size, part_size):
+                    pool.submit(_download_range, bundle_name, tmpfilename,
+                                start, min(start + part_size, key.size) - 1)
+            finally:
+                pool.join()
+            pool.check()
 
-    if key is None:
-        raise KeyError("No such bundle: %s" % bundle_name)
+        uploaded_part_size = key.get_metadata(PART_SIZE_METADATA)
+        _check_etag(bundle_name, key.etag, tmpfilename,
+                    uploaded_part_size and int(uploaded_part_size))
+    except:
+        os.remove(tmpfilename)
+        raise
 
-    (fd, tmpfilename) = tempfile.mkstemp(prefix="tmpbundle")
-    key.get_contents_to_filename(tmpfilename)
     return tmpfilename
 
 
@@ -45,5 +462,6 @@ def delete(bundle_name):
 
     :returns: None
     """
-    key = _get_bucket().get_key(bundle_name)
-    key.delete()
+    with _bucket() as bucket:
+        key = bucket.get_key(bundle_name)
+        key.delete()
@@ -1,37 +1,116 @@
 """
 Bundle storage using local files. This is very simple and intended only
 for development/testing, not production deployment.
+
+Stored bundles are read-only, and are only ever replaced by renaming a new
+file into place, so any number of readers can use them concurrently. With
+taskconfig.BUNDLE_STORAGE_LOCAL_LINKS set, :func:`get` hands out hard
+links to them rather than copies, and bundles are stored as reflinks of
+the uploaded files where the filesystem supports it.
 """
 
 import os
 import shutil
 import tempfile
-from dz.tasklib import taskconfig
+from dz.tasklib import (taskconfig,
+                        fastcopy)
 
 
 def _get_bundle_file(bundle_name):
     bundle_storage_dir = os.path.join(taskconfig.NR_CUSTOMER_DIR,
                                       "bundle_storage_local")
 
-    if not os.path.isdir(bundle_storage_dir):
-        os.makedirs(bundle_storage_dir)
+    bundle_file = os.path.join(bundle_storage_dir,
+                               bundle_name)
+
+    # names may contain a directory, as for manifest objects.
+    if not os.path.isdir(os.path.dirname(bundle_file)):
+        os.makedirs(os.path.dirname(bundle_file))
+
+    return bundle_file
 
-    return os.path.join(bundle_storage_dir,
-                        bundle_name)
+
+def _tmp_name(bf):
+    # next to the bundle, so it can be renamed into place or linked to.
+    return tempfile.mktemp(prefix=".tmpbundle", dir=os.path.dirname(bf))
 
 
 def put(bundle_name, filename):
-    shutil.copy(filename, _get_bundle_file(bundle_name))
+    bf = _get_bundle_file(bundle_name)
+    tmpfilename = _tmp_name(bf)
+    try:
+        if taskconfig.BUNDLE_STORAGE_LOCAL_LINKS:
+            # never a hard link: the caller may change its file afterwards.
+            fastcopy.copyfile(filename, tmpfilename)
+        else:
+            shutil.copy(filename, tmpfilename)
+        os.chmod(tmpfilename, 0444)
+        os.rename(tmpfilename, bf)
+    finally:
+        if os.path.exists(tmpfilename):
+            os.remove(tmpfilename)
 
 
-def get(bundle_name):
+def put_stream(bundle_name, fileobj):
+    bf = _get_bundle_file(bundle_name)
+    (fd, tmpfilename) = tempfile.mkstemp(prefix=".tmpbundle",
+                                         dir=os.path.dirname(bf))
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            shutil.copyfileobj(fileobj, f)
+        finally:
+            f.close()
+        os.chmod(tmpfilename, 0444)
+        os.rename(tmpfilename, bf)
+    finally:
+        if os.path.exists(tmpfilename):
+            os.remove(tmpfilename)
+
+
+def exists(bundle_name):
+    return os.path.isfile(_get_bundle_file(bundle_name))
+
+
+def copy(bundle_name, new_bundle_name):
+    put(new_bundle_name, get_path(bundle_name))
+
+
+def list_names(prefix):
+    """List the names of the stored bundles (and other files) starting with
+    ``prefix``; only the last part of ``prefix`` may be incomplete."""
+    prefix_file = _get_bundle_file(prefix)
+    dirname, start = os.path.split(prefix_file)
+    return [prefix[:len(prefix) - len(start)] + name
+            for name in sorted(os.listdir(dirname))
+            if name.startswith(start) and not name.startswith(".tmpbundle")
+            and os.path.isfile(os.path.join(dirname, name))]
+
+
+def get_path(bundle_name):
+    """
+    Get the path of a stored bundle, to read it in place. The bundle mustn't
+    be modified; deleting it doesn't affect readers which have opened it.
+    """
     bf = _get_bundle_file(bundle_name)
     if not os.path.isfile(bf):
         raise KeyError("Bundle not found: %s (expected it in %s)" % (
                 bundle_name,
                 bf))
-    tmpfilename = tempfile.mktemp(prefix="tmpbundle")
-    shutil.copy(bf, tmpfilename)
+    return bf
+
+
+def get(bundle_name):
+    bf = get_path(bundle_name)
+    if not taskconfig.BUNDLE_STORAGE_LOCAL_LINKS:
+        tmpfilename = tempfile.mktemp(prefix="tmpbundle")
+        shutil.copy(bf, tmpfilename)
+        return tmpfilename
+
+    # a link to the read-only bundle, which stays valid if it's deleted or
+    # replaced meanwhile.
+    tmpfilename = _tmp_name(bf)
+    fastcopy.copyfile(bf, tmpfilename, hardlink=True)
     return tmpfilename
 
 
@@ -0,0 +1,161 @@
+"""
+A directory of cached files, shared by concurrent tasks and processes on a
+node and kept under a maximum total size by evicting the least recently used
+entries.
+"""
+
+import fcntl
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+# temp files (or directories) older than this are assumed to have been
+# abandoned by a crashed process, and are removed when evicting.
+STALE_TEMP_FILE_AGE = 60 * 60
+
+
+class CacheDir(object):
+    """
+    Entries are plain files in ``path``. Writers create them with
+    :meth:`mkstemp` and :meth:`add` (an atomic rename), so readers never see
+    a partial entry, and may record with :meth:`mark_fetching` that an entry
+    is on its way. Users should touch entries they use, so that eviction
+    removes the least recently used ones first.
+
+    :param group: optional function mapping an entry name to the name of
+        the group it belongs to; entries in a group are evicted together.
+    """
+
+    LOCK_FILENAME = ".lock"
+    TEMP_PREFIX = ".tmp-"
+    FETCHING_PREFIX = ".fetching-"
+
+    def __init__(self, path, max_bytes, group=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.group = group or (lambda name: name)
+
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):  # lost a race to create it
+                    raise
+
+    def lock(self, exclusive=False):
+        """
+        Lock the cache; take an exclusive lock to add or remove entries and a
+        shared lock to read them.
+
+        :returns: a file object; close it to release the lock.
+        """
+        lockfile = open(os.path.join(self.path, self.LOCK_FILENAME), "a")
+        fcntl.flock(lockfile.fileno(),
+                    fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return lockfile
+
+    def entry_path(self, name):
+        return os.path.join(self.path, name)
+
+    def has(self, name):
+        return os.path.isfile(self.entry_path(name))
+
+    def names(self):
+        return [n for n in os.listdir(self.path) if not n.startswith(".")]
+
+    def touch(self, name):
+        """Mark an entry as used just now."""
+        try:
+            os.utime(self.entry_path(name), None)
+        except OSError:
+            pass  # evicted meanwhile
+
+    def mkstemp(self):
+        """
+        Make a temp file in the cache directory, to be filled and then
+        moved into place with :meth:`add`.
+
+        :returns: (fd, filename), as tempfile.mkstemp.
+        """
+        return tempfile.mkstemp(prefix=self.TEMP_PREFIX, dir=self.path)
+
+    def add(self, name, tmp_filename):
+        """Atomically move a temp file from :meth:`mkstemp` into the cache."""
+        os.chmod(tmp_filename, 0644)
+        os.rename(tmp_filename, self.entry_path(name))
+
+    def _fetching_path(self, name):
+        return os.path.join(self.path, self.FETCHING_PREFIX + name)
+
+    def mark_fetching(self, name):
+        """
+        Record that this process is fetching the entry ``name``, until it
+        closes the returned file (or exits).
+
+        :returns: a file object; close it once the entry is added, or its
+            fetch has failed.
+        """
+        marker = open(self._fetching_path(name), "a")
+        # held shared, so any number of processes can fetch the entry.
+        fcntl.flock(marker.fileno(), fcntl.LOCK_SH)
+        return marker
+
+    def is_fetching(self, name):
+        """Is any process fetching the entry ``name``?"""
+        try:
+            marker = open(self._fetching_path(name))
+        except IOError:
+            return False
+        try:
+            try:
+                fcntl.flock(marker.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return True
+            return False
+        finally:
+            marker.close()
+
+    def evict(self):
+        """
+        Remove the least recently used groups of entries until the cache is
+        no bigger than max_bytes. Call while holding an exclusive lock.
+        """
+        groups = {}
+        total = 0
+        now = time.time()
+
+        for name in os.listdir(self.path):
+            filename = self.entry_path(name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+
+            if name.startswith(self.TEMP_PREFIX):
+                if now - st.st_mtime > STALE_TEMP_FILE_AGE:
+                    if stat.S_ISDIR(st.st_mode):
+                        shutil.rmtree(filename, ignore_errors=True)
+                    else:
+                        os.remove(filename)
+                continue
+            if name.startswith(self.FETCHING_PREFIX):
+                if not self.is_fetching(name[len(self.FETCHING_PREFIX):]):
+                    os.remove(filename)
+                continue
+            if name.startswith("."):
+                continue
+
+            total += st.st_size
+            group = groups.setdefault(self.group(name), [0, 0, []])
+            group[0] = max(group[0], st.st_mtime)
+            group[1] += st.st_size
+            group[2].append(filename)
+
+        for mtime, size, filenames in sorted(groups.values()):
+            if total <= self.max_bytes:
+                break
+            for filename in filenames:
+                os.remove(filename)
+            total -= size
@@ -0,0 +1,187 @@
+"""
+Per-app control groups, which limit and account for the resources used by
+each project's builds, commands and served bundles.
+
+With taskconfig.CGROUPS_ENABLED, everything run in a project's UserEnv is
+started (by the privileged program run_in_cgroup) in the cgroup
+``dz/<app id>/<group>``: BUILD_GROUP for builds and management commands, or
+the bundle's name for a bundle being served. The limits in taskconfig
+(CGROUP_CPU_SHARES, CGROUP_MEMORY_LIMIT and CGROUP_IO_WEIGHT) are set on
+the app's cgroup, so all of its groups share them.
+
+:func:`usage` reports what an app, or one of its groups, has used so far.
+A bundle's group is removed when it stops being served (see
+:func:`remove_privileged`), but the kernel counts each group's CPU time and
+I/O in its app's cgroup too, and keeps them there; app cgroups are never
+removed, so their totals cover everything run on the node since it booted.
+Both cgroup v1 and the unified v2 hierarchy are supported.
+
+This module only depends on the standard library, as it is used by userenv.
+"""
+
+import os
+
+from dz.tasklib import taskconfig
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+PARENT = "dz"
+
+BUILD_GROUP = "build"
+
+
+def is_enabled():
+    return taskconfig.CGROUPS_ENABLED
+
+
+def _is_unified():
+    return os.path.isfile(os.path.join(CGROUP_ROOT, "cgroup.controllers"))
+
+
+def wrap_privileged(app_id, group, cmdargs):
+    """
+    Make the privileged command ``cmdargs`` run in the cgroup for
+    ``app_id``'s ``group``, if cgroups are enabled.
+    """
+    if not is_enabled():
+        return cmdargs
+    return ["run_in_cgroup", app_id, group,
+            str(taskconfig.CGROUP_CPU_SHARES or 0),
+            str(taskconfig.CGROUP_MEMORY_LIMIT or 0),
+            str(taskconfig.CGROUP_IO_WEIGHT or 0)] + cmdargs
+
+
+def remove_privileged(app_id, group):
+    """
+    Make the privileged command removing the cgroup for ``app_id``'s
+    ``group`` (killing any processes left in it), or None if cgroups aren't
+    enabled.
+    """
+    if not is_enabled():
+        return None
+    return ["remove_cgroup", app_id, group]
+
+
+def _cgroup_dir(controller, app_id, group=None):
+    parts = [CGROUP_ROOT]
+    if not _is_unified():
+        parts.append(controller)
+    parts += [PARENT, app_id]
+    if group:
+        parts.append(group)
+    return os.path.join(*parts)
+
+
+def _read(controller, app_id, group, filename):
+    """The content of a cgroup's file, or None if it doesn't have it."""
+    try:
+        f = open(os.path.join(_cgroup_dir(controller, app_id, group),
+                              filename))
+    except IOError:
+        return None
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def _read_int(controller, app_id, group, filename):
+    content = _read(controller, app_id, group, filename)
+    if content is None:
+        return None
+    return int(content.split()[0])
+
+
+def _io_bytes_v1(content):
+    """Sum a blkio.*io_service_bytes file's reads and writes."""
+    read_bytes = write_bytes = 0
+    for line in content.splitlines():
+        fields = line.split()
+        if len(fields) != 3:
+            continue  # the total line
+        if fields[1] == "Read":
+            read_bytes += int(fields[2])
+        elif fields[1] == "Write":
+            write_bytes += int(fields[2])
+    return read_bytes, write_bytes
+
+
+def _io_bytes_v2(content):
+    """Sum an io.stat file's reads and writes."""
+    read_bytes = write_bytes = 0
+    for line in content.splitlines():
+        for field in line.split()[1:]:
+            key, _sep, value = field.partition("=")
+            if key == "rbytes":
+                read_bytes += int(value)
+            elif key == "wbytes":
+                write_bytes += int(value)
+    return read_bytes, write_bytes
+
+
+def usage(app_id, group=None):
+    """
+    Get the resources used by ``app_id`` (with all its groups), or by one of
+    its groups.
+
+    :returns: a dict with the CPU time used in seconds (cpu_time), the
+        memory in use and the most used at once (memory_bytes,
+        max_memory_bytes) and the bytes read from and written to block
+        devices (read_bytes, write_bytes), where any the kernel doesn't
+        report are None; or None if the app has no cgroup.
+    """
+    if not os.path.isdir(_cgroup_dir("cpu", app_id, group)):
+        return None
+
+    result = dict.fromkeys(("cpu_time", "memory_bytes", "max_memory_bytes",
+                            "read_bytes", "write_bytes"))
+
+    if _is_unified():
+        cpu_stat = _read("cpu", app_id, group, "cpu.stat") or ""
+        for line in cpu_stat.splitlines():
+            key, value = line.split()
+            if key == "usage_usec":
+                result["cpu_time"] = int(value) / 1e6
+        result["memory_bytes"] = _read_int("memory", app_id, group,
+                                           "memory.current")
+        result["max_memory_bytes"] = _read_int("memory", app_id, group,
+                                               "memory.peak")
+        io_stat = _read("io", app_id, group, "io.stat")
+        if io_stat is not None:
+            result["read_bytes"], result["write_bytes"] = _io_bytes_v2(
+                io_stat)
+    else:
+        cpu_ns = _read_int("cpuacct", app_id, group, "cpuacct.usage")
+        if cpu_ns is not None:
+            result["cpu_time"] = cpu_ns / 1e9
+        result["memory_bytes"] = _read_int("memory", app_id, group,
+                                           "memory.usage_in_bytes")
+        result["max_memory_bytes"] = _read_int("memory", app_id, group,
+                                               "memory.max_usage_in_bytes")
+        io_bytes = (
+            _read("blkio", app_id, group,
+                  "blkio.throttle.io_service_bytes_recursive") or
+            _read("blkio", app_id, group, "blkio.throttle.io_service_bytes"))
+        if io_bytes is not None:
+            result["read_bytes"], result["write_bytes"] = _io_bytes_v1(
+                io_bytes)
+
+    return result
+
+
+def get_app_groups():
+    """
+    List the apps with cgroups on this node, and their groups.
+
+    :returns: a dict mapping app ids to lists of group names.
+    """
+    parent_dir = os.path.dirname(_cgroup_dir("cpu", "app"))
+    if not os.path.isdir(parent_dir):
+        return {}
+
+    result = {}
+    for app_id in os.listdir(parent_dir):
+        app_dir = os.path.join(parent_dir, app_id)
+        if os.path.isdir(app_dir):
+            result[app_id] = [g for g in os.listdir(app_dir)
+                              if os.path.isdir(os.path.join(app_dir, g))]
+    return result
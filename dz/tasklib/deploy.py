@@ -10,6 +10,7 @@
 
 """
 import datetime
+import fcntl
 import pytz
 import os
 #import pwd
@@ -19,6 +20,8 @@ import socket
 from dz.tasklib import (bundle_storage,
                         bundle_storage_local,
                         bundle,
+                        bundle_peers,
+                        cgroups,
                         taskconfig,
                         utils,
                         userenv)
@@ -30,14 +33,19 @@ def _write_deployment_config(outfilename, bundle_name, dbinfo, num_workers=1):
         outfilename,
         bundle_name=bundle_name,
         dbinfo=dbinfo,
-        num_workers=num_workers)
-    os.chmod(outfilename, 0700)
+        num_workers=num_workers,
+        mode=0700)
 
 
 def deploy_app_bundle(app_id, bundle_name, appserver_name, dbinfo,
                       bundle_storage_engine=None,
-                      num_workers=1):
+                      num_workers=1, peers=None):
+    """
+    Install a bundle on this appserver and start serving it.
 
+    :param peers: other appservers to try getting the bundle from
+        before bundle storage; see bundle_peers.fanout_peers.
+    """
     bundle_storage_engine = bundle.get_bundle_storage_engine(
         bundle_storage_engine)
 
@@ -50,6 +58,12 @@ def deploy_app_bundle(app_id, bundle_name, appserver_name, dbinfo,
             "I am %s but the deploy is requesting %s." % (my_hostname,
                                                           appserver_name))
 
+    # serve our bundles to any peers getting this one from us.
+    bundle_peers.start_server()
+    if peers:
+        bundle_storage_engine = bundle_peers.PeerStorage(
+            bundle_storage_engine, peers)
+
     install_app_bundle(app_id, bundle_name, appserver_name, dbinfo,
                        bundle_storage_engine=bundle_storage_engine,
                        num_workers=num_workers)
@@ -58,15 +72,59 @@ def deploy_app_bundle(app_id, bundle_name, appserver_name, dbinfo,
     return start_serving_bundle(app_id, bundle_name)
 
 
+def _get_bundle_in_place(app_id, bundle_name, bundle_storage_engine):
+    """
+    Get and extract a bundle into its app directory, unless it's there
+    already. A lock per bundle stops a prefetch and an install extracting
+    it at the same time, or either seeing it half extracted.
+    """
+    app_dir, bundle_dir = utils.app_and_bundle_dirs(app_id, bundle_name)
+
+    if not os.path.isdir(app_dir):
+        os.makedirs(app_dir)
+
+    lockfile = open(os.path.join(app_dir, ".%s.lock" % bundle_name), "a")
+    try:
+        fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        if os.path.exists(bundle_dir):
+            return
+
+        try:
+            utils.get_and_extract_bundle(bundle_name, app_dir,
+                                         bundle_storage_engine)
+        except:
+            shutil.rmtree(bundle_dir, ignore_errors=True)
+            raise
+    finally:
+        lockfile.close()
+
+
+def prefetch_app_bundle(app_id, bundle_name, bundle_storage_engine=None,
+                        peers=None):
+    """
+    Get and extract a bundle on this appserver ahead of its deploy, so that
+    install_app_bundle finds it already in place.
+
+    :param peers: as for deploy_app_bundle.
+    """
+    bundle_storage_engine = bundle.get_bundle_storage_engine(
+        bundle_storage_engine)
+
+    bundle_peers.start_server()
+    if peers:
+        bundle_storage_engine = bundle_peers.PeerStorage(
+            bundle_storage_engine, peers)
+
+    _get_bundle_in_place(app_id, bundle_name, bundle_storage_engine)
+
+
 def install_app_bundle(app_id, bundle_name, appserver_name, dbinfo,
                        bundle_storage_engine=bundle_storage,
                        static_only=False, num_workers=1,
                        remove_other_bundles=False):
     app_dir, bundle_dir = utils.app_and_bundle_dirs(app_id, bundle_name)
 
-    if not os.path.exists(bundle_dir):
-        utils.get_and_extract_bundle(bundle_name, app_dir,
-                                     bundle_storage_engine)
+    _get_bundle_in_place(app_id, bundle_name, bundle_storage_engine)
 
     if remove_other_bundles:
         for fname in os.listdir(app_dir):
@@ -110,9 +168,11 @@ def managepy_command(app_id, bundle_name, command, nonzero_exit_ok=False,
     else:
         procargs.append(command)
 
-    ue = userenv.UserEnv(app_id)
-    stdout, stderr, proc = ue.subproc(procargs, nonzero_exit_ok=True)
-    ue.destroy()
+    ue = userenv.get_userenv(app_id)
+    try:
+        stdout, stderr, proc = ue.subproc(procargs, nonzero_exit_ok=True)
+    finally:
+        userenv.release_userenv(ue)
 
     result = stdout + "\n" + stderr
 
@@ -139,9 +199,12 @@ def managepy_shell(app_id, bundle_name, some_python_code):
     procargs = [os.path.join(bundle_dir, "thisbundle.py"),
                 "shell", "--plain"]
 
-    ue = userenv.UserEnv(app_id)
-    stdout, stderr, proc = ue.subproc(procargs,
-                                      stdin_string=some_python_code)
+    ue = userenv.get_userenv(app_id)
+    try:
+        stdout, stderr, proc = ue.subproc(procargs,
+                                          stdin_string=some_python_code)
+    finally:
+        userenv.release_userenv(ue)
 
     result = stdout
     if stderr:
@@ -284,7 +347,8 @@ def start_serving_bundle(app_id, bundle_name):
 def stop_serving_bundle(app_id, bundle_name):
     """
     Remove the supervisor entry for this bundle, and ask supervisor to
-    terminate the supervised worker process.
+    terminate the supervised worker process; then remove the bundle's cgroup,
+    if cgroups are enabled.
 
     :returns: the number of bundles that were stopped.
     """
@@ -300,6 +364,10 @@ def stop_serving_bundle(app_id, bundle_name):
 
     _kick_supervisor()
 
+    remove_cgroup_cmd = cgroups.remove_privileged(app_id, bundle_name)
+    if remove_cgroup_cmd:
+        utils.local_privileged(remove_cgroup_cmd)
+
     return num_stopped
 
 
@@ -1,4 +1,5 @@
 from dz.tasklib import (taskconfig,
+                        cgroups,
                         utils)
 import os
 import psi
@@ -75,6 +76,21 @@ def get_nginx_sites_enabled():
     return result
 
 
+def get_app_usage():
+    """
+    Get the resources each app with a cgroup on this node (see the cgroups
+    module) has used, in total and by each of its groups (builds, and the
+    bundles it is serving).
+    """
+    result = []
+    for app_id, groups in sorted(cgroups.get_app_groups().items()):
+        result.append(dict(app_id=app_id,
+                           usage=cgroups.usage(app_id),
+                           groups=dict((group, cgroups.usage(app_id, group))
+                                       for group in groups)))
+    return result
+
+
 def get_uptime():
     return psi.uptime().timestamp()
 
@@ -4,11 +4,14 @@ replace any existing configuration file and kick nginx.
 """
 
 import os
+import re
 import shutil
 
 from dz.tasklib import (taskconfig,
                         bundle,
+                        bundle_peers,
                         deploy,
+                        static_assets,
                         utils)
 
 SKIP_BUNDLE_INSTALL = object()
@@ -22,7 +25,8 @@ def _get_nginx_conffile(app_id):
 def update_local_proxy_config(app_id, bundle_name,
                               appservers, virtual_hostnames, site_media_map,
                               bundle_storage_engine=None,
-                              remove_other_bundles=True):
+                              remove_other_bundles=True,
+                              peers=None):
 
     bundle_storage_engine = bundle.get_bundle_storage_engine(
         bundle_storage_engine)
@@ -35,38 +39,46 @@ def update_local_proxy_config(app_id, bundle_name,
                 "At least one upstream is required.") % app_id)
 
     app_dir, bundle_dir = utils.app_and_bundle_dirs(app_id, bundle_name)
+    media_dir = bundle_dir
+    static_bundle = False
 
     # We need to make sure this bundle's static is installed locally, so we
-    # can serve its static media.
+    # can serve its static media. Bundles built with a static bundle (see
+    # bundle.make_static_bundle) only need that; older ones are installed
+    # whole.
     if bundle_storage_engine is not SKIP_BUNDLE_INSTALL:
-        deploy.install_app_bundle_static(
-            app_id, bundle_name,
-            bundle_storage_engine,
-            remove_other_bundles=remove_other_bundles)
-    file_path_vars = {
-        "{SITE_PACKAGES}": os.path.join(bundle_dir,
-                                        "lib/python2.6/site-packages"),
-        "{SRC_PACKAGES}": os.path.join(bundle_dir, "src"),
-        }
-    default_file_path_base = os.path.join(bundle_dir, "user-repo")
-
-    def _make_full_path(original_file_path):
-        for varname, pathbase in file_path_vars.items():
-            if original_file_path.startswith(varname):
-                rest = original_file_path[len(varname):]
-                rest = rest.lstrip("/")
-                return os.path.join(pathbase, rest)
-
-        return os.path.join(default_file_path_base,
-                            original_file_path)
-
-    sme = [dict(url_path=url_path,
-                alias_dest=_make_full_path(file_path.strip('/')),
-                ) for url_path, file_path in site_media_map.items()]
-    sme.append(dict(url_path=taskconfig.DZ_ADMIN_MEDIA["url_path"],
-                    alias_dest=os.path.join(
-                bundle_dir,
-                taskconfig.DZ_ADMIN_MEDIA["bundle_file_path"])))
+        if bundle.has_static_bundle(bundle_name, bundle_storage_engine):
+            static_name = bundle.static_bundle_name(bundle_name)
+            media_dir = os.path.join(app_dir, static_name)
+            static_bundle = True
+            deploy.install_app_bundle_static(
+                app_id, static_name,
+                bundle_storage_engine,
+                remove_other_bundles=remove_other_bundles)
+        else:
+            if peers:
+                # get the bundle from appservers which already have it.
+                bundle_storage_engine = bundle_peers.PeerStorage(
+                    bundle_storage_engine, peers)
+            deploy.install_app_bundle_static(
+                app_id, bundle_name,
+                bundle_storage_engine,
+                remove_other_bundles=remove_other_bundles)
+    sme = utils.site_media_entries(media_dir, site_media_map)
+
+    if static_bundle:
+        # static bundles' media are precompressed, and may be fingerprinted
+        # (see static_assets).
+        for entry in sme:
+            entry["gzip_static"] = True
+            entry["expires"] = taskconfig.NGINX_STATIC_EXPIRES
+            if static_assets.has_fingerprints(entry["alias_dest"]):
+                entry["fingerprinted_regex"] = "^%s(.+%s)$" % (
+                    re.escape(entry["url_path"]),
+                    static_assets.FINGERPRINTED_PATTERN)
+        # nginx uses the first regex location matching, so try the longest
+        # url paths first.
+        sme.sort(key=lambda entry: len(entry["url_path"]), reverse=True)
 
     # NOTE THE SLASHES::::
     # location /static/ {
@@ -0,0 +1,165 @@
+"""
+Node-wide cache of packages downloaded by pip, shared by all projects'
+builds.
+
+pip runs inside each project's UserEnv, so it can't be given write access
+to a cache other projects read from. Instead, each build gets a private
+``--download-cache`` directory in the project's directory, seeded with
+read-only hard links to the shared cache's entries. After the build, the
+packages pip added to it are downloaded again by us, from trusted package
+indexes only, into the shared cache: nothing a build writes is ever
+copied into the shared cache.
+"""
+
+import errno
+import os
+import pwd
+import re
+import shutil
+import tempfile
+import urllib
+import urllib2
+import urlparse
+
+import taskconfig
+from cachedir import CacheDir
+from utils_essentials import local_privileged
+
+# pip stores the content type of each download next to it, in a file
+# named after the download's with this suffix.
+CONTENT_TYPE_SUFFIX = ".content-type"
+
+_USING_CACHE_RE = re.compile(r"Using download cache from (\S+)")
+
+
+def _entry_group(name):
+    if name.endswith(CONTENT_TYPE_SUFFIX):
+        return name[:-len(CONTENT_TYPE_SUFFIX)]
+    return name
+
+
+def is_enabled():
+    return bool(taskconfig.PIP_DOWNLOAD_CACHE_DIR)
+
+
+def get_shared_cache():
+    return CacheDir(taskconfig.PIP_DOWNLOAD_CACHE_DIR,
+                    taskconfig.PIP_DOWNLOAD_CACHE_MAX_BYTES,
+                    group=_entry_group)
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM):
+            raise
+        shutil.copy2(src, dst)
+
+
+def make_build_cache(parent_dir):
+    """
+    Make a private pip download cache for one build, in ``parent_dir``, and
+    seed it from the shared cache.
+
+    :returns: the path of the private cache directory; pass it to pip as
+        ``--download-cache`` and to :func:`finish_build_cache` afterwards.
+    """
+    build_cache_dir = tempfile.mkdtemp(prefix=".pip-cache-", dir=parent_dir)
+    # the build runs pip as the project's user.
+    os.chmod(build_cache_dir, 0777)
+
+    shared = get_shared_cache()
+    lock = shared.lock()
+    try:
+        names = set(shared.names())
+        for name in names:
+            if name.endswith(CONTENT_TYPE_SUFFIX):
+                continue
+            # pip needs both halves of an entry.
+            if name + CONTENT_TYPE_SUFFIX not in names:
+                continue
+            for entry in (name, name + CONTENT_TYPE_SUFFIX):
+                _link_or_copy(shared.entry_path(entry),
+                              os.path.join(build_cache_dir, entry))
+    finally:
+        lock.close()
+
+    return build_cache_dir
+
+
+def _is_trusted_url(url):
+    scheme, host = urlparse.urlparse(url)[0:2]
+    return (scheme in ("http", "https") and
+            host in taskconfig.PIP_DOWNLOAD_CACHE_TRUSTED_HOSTS)
+
+
+def _download_to_cache(shared, url):
+    """Download ``url`` into the shared cache, as pip would store it."""
+    name = urllib.quote(url, "")
+
+    data_fd, data_tmp = shared.mkstemp()
+    type_fd, type_tmp = shared.mkstemp()
+    try:
+        resp = urllib2.urlopen(url)
+        data_file = os.fdopen(data_fd, "wb")
+        shutil.copyfileobj(resp, data_file)
+        data_file.close()
+
+        type_file = os.fdopen(type_fd, "w")
+        type_file.write(resp.info().get("content-type", ""))
+        type_file.close()
+
+        lock = shared.lock(exclusive=True)
+        try:
+            # the content type goes first, so the entry is complete as soon
+            # as its data file appears.
+            shared.add(name + CONTENT_TYPE_SUFFIX, type_tmp)
+            shared.add(name, data_tmp)
+        finally:
+            lock.close()
+    finally:
+        for tmp in (data_tmp, type_tmp):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def finish_build_cache(build_cache_dir, pip_output=None):
+    """
+    Update the shared cache after a build: mark the entries pip used as
+    recently used, add the packages it downloaded from trusted indexes,
+    evict old entries, and remove the build's private cache.
+
+    :param pip_output: pip's output, which notes the cache entries used.
+    """
+    shared = get_shared_cache()
+
+    try:
+        for cache_file in _USING_CACHE_RE.findall(pip_output or ""):
+            name = os.path.basename(cache_file)
+            shared.touch(name)
+            shared.touch(name + CONTENT_TYPE_SUFFIX)
+
+        for name in os.listdir(build_cache_dir):
+            if name.endswith(CONTENT_TYPE_SUFFIX) or shared.has(name):
+                continue
+            url = urllib.unquote(name)
+            if not _is_trusted_url(url):
+                continue
+            try:
+                _download_to_cache(shared, url)
+            except (IOError, OSError), e:
+                print "Warning: couldn't add %s to pip cache: %s" % (url, e)
+
+        lock = shared.lock(exclusive=True)
+        try:
+            shared.evict()
+        finally:
+            lock.close()
+
+    finally:
+        # entries written by pip belong to the project's user.
+        local_privileged(["project_chown",
+                          pwd.getpwuid(os.geteuid()).pw_name,
+                          build_cache_dir])
+        shutil.rmtree(build_cache_dir)
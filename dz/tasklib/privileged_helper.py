@@ -0,0 +1,163 @@
+"""
+A long-running root process running privileged programs (those in
+taskconfig.PRIVILEGED_PROGRAMS_PATH) on behalf of the tasks, so that
+``local_privileged`` doesn't have to start sudo, with its PAM session and
+logging, for every mount, chown and command run in a UserEnv.
+
+The helper listens on the Unix socket taskconfig.PRIVILEGED_HELPER_SOCKET,
+which only the tasks' user can connect to; each connection's peer
+credentials are checked as well. It runs the same programs, with the same
+arguments, as would be run with sudo, and nothing else.
+
+A request is a line of JSON listing one or more commands to run in order;
+the result of each is sent back, also as a line of JSON, as soon as it has
+finished. The helper stops at the first command which fails. See
+``utils_essentials.local_privileged`` and ``local_privileged_batch``.
+
+Run it as root, with the name of the user the tasks run as::
+
+    python -m dz.tasklib.privileged_helper <username>
+"""
+
+import SocketServer
+import json
+import os
+import pwd
+import socket
+import stat
+import struct
+import sys
+import time
+
+from dz.tasklib import (taskconfig,
+                        utils_essentials)
+
+# not exposed by the socket module in python 2; this is the Linux value.
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+
+# a sanity limit on the size of a request.
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+# like sudo's env_reset, commands get a minimal environment.
+COMMAND_ENV = {"PATH": "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:"
+                       "/sbin:/bin"}
+
+
+def peer_uid(sock):
+    """Get the uid of the process connected to the Unix socket ``sock``."""
+    creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                            struct.calcsize("3i"))
+    pid, uid, gid = struct.unpack("3i", creds)
+    return uid
+
+
+def _check_command(command):
+    """
+    Get the command line to run for a command in a request, which must be
+    a privileged program and its (string) arguments.
+    """
+    args = command.get("args")
+    if (not isinstance(args, list) or not args or
+        [a for a in args if not isinstance(a, basestring)]):
+        raise ValueError("Invalid command: %r" % (args,))
+    args = [a.encode("utf8") for a in args]
+    if os.path.basename(args[0]) != args[0] or args[0] in (".", ".."):
+        raise ValueError("Not a privileged program: %r" % (args[0],))
+    return [utils_essentials.privileged_program_path(args[0])] + args[1:]
+
+
+def _run(cmd, stdin_string):
+    start_time = time.time()
+    stdout, stderr, p = utils_essentials.subproc(cmd,
+                                                 stdin_string=stdin_string)
+    return dict(
+        stdout=stdout.decode("latin-1"),
+        stderr=stderr.decode("latin-1"),
+        returncode=p.returncode,
+        wall_time=time.time() - start_time,
+        rusage=dict((field, getattr(p.rusage, field))
+                    for field in utils_essentials.RUSAGE_FIELDS))
+
+
+class _HelperRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        uid = peer_uid(self.connection)
+        if uid not in (0, self.server.allowed_uid):
+            print "Refusing connection from uid %d." % uid
+            return
+
+        line = self.rfile.readline(MAX_REQUEST_SIZE)
+        try:
+            commands = json.loads(line)["commands"]
+            cmds = [_check_command(command) for command in commands]
+        except (ValueError, KeyError, TypeError, AttributeError), e:
+            utils_essentials.send_message(self.connection,
+                                          dict(error=str(e)))
+            return
+
+        for cmd, command in zip(cmds, commands):
+            stdin_string = command.get("stdin")
+            if stdin_string:
+                stdin_string = stdin_string.encode("latin-1")
+            try:
+                result = _run(cmd, stdin_string)
+            except OSError, e:
+                result = dict(error=str(e))
+            utils_essentials.send_message(self.connection, result)
+            if result.get("returncode") != 0:
+                break
+
+
+class _HelperServer(SocketServer.ThreadingMixIn,
+                    SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, allowed_uid):
+        self.allowed_uid = allowed_uid
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               _HelperRequestHandler)
+
+
+def serve(username, socket_path=None):
+    """
+    Run the helper until killed, for the tasks running as ``username``.
+    """
+    if socket_path is None:
+        socket_path = taskconfig.PRIVILEGED_HELPER_SOCKET
+    assert socket_path, "PRIVILEGED_HELPER_SOCKET is not configured."
+    assert os.geteuid() == 0, "The privileged helper must be run as root."
+
+    user = pwd.getpwnam(username)
+
+    # replace the socket of a previous run.
+    if os.path.exists(socket_path):
+        assert stat.S_ISSOCK(os.lstat(socket_path).st_mode), (
+            "%s exists and isn't a socket." % socket_path)
+        os.remove(socket_path)
+
+    old_umask = os.umask(0177)
+    try:
+        server = _HelperServer(socket_path, user.pw_uid)
+    finally:
+        os.umask(old_umask)
+    os.chown(socket_path, user.pw_uid, user.pw_gid)
+    os.environ.clear()
+    os.environ.update(COMMAND_ENV)
+
+    print "Privileged helper for %s listening on %s." % (username,
+                                                        socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        os.remove(socket_path)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print "Usage: privileged_helper.py <username>"
+        sys.exit(1)
+    serve(sys.argv[1])
+
+
+if __name__ == "__main__":
+    main()
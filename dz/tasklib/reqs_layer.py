@@ -0,0 +1,152 @@
+"""
+Reuse of a project's installed requirements between its bundles.
+
+After pip installs a bundle's requirements, a copy of the bundle's
+virtualenv (without the project's own code) is kept in the project's
+directory, along with a key identifying the requirements it was built with.
+The next bundle of the project with the same key is made from a copy of
+that layer instead of running pip again.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from dz.tasklib import (taskconfig,
+                        utils,
+                        venv_templates)
+
+LAYER_DIRNAME = ".reqs-layer"
+
+# bump this to stop reusing all existing layers.
+LAYER_FORMAT_VERSION = "1"
+
+# bundle contents which are not part of the layer.
+EXCLUDED_FROM_LAYER = ("user-src", "user-repo", "zoombuild.cfg",
+                       taskconfig.NR_PIP_REQUIREMENTS_FILENAME)
+
+
+def is_enabled():
+    return taskconfig.REQUIREMENTS_LAYER_ENABLED
+
+
+def layer_key(django_version, reqs):
+    """
+    Compute the key for a layer with ``django_version`` and the requirement
+    lines ``reqs`` installed; or None if the requirements can't be reused,
+    because some of them are installed from the project's own files.
+    """
+    if [r for r in reqs if "file:" in r]:
+        return None
+
+    parts = [LAYER_FORMAT_VERSION,
+             venv_templates.django_requirement(django_version)]
+    if venv_templates.is_enabled():
+        parts.append(venv_templates.template_path(django_version))
+    parts.extend(reqs)
+    return hashlib.sha1("\n".join(parts)).hexdigest()
+
+
+def _layer_dir(app_id):
+    return os.path.join(taskconfig.NR_CUSTOMER_DIR, app_id, LAYER_DIRNAME)
+
+
+def _read(filename):
+    f = open(filename)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def _write(filename, content):
+    f = open(filename, "w")
+    f.write(content)
+    f.close()
+
+
+def _copy(sources, dest_dir):
+    stdout, stderr, p = utils.subproc(["cp", "-a", "--reflink=auto"] +
+                                      sources + [dest_dir])
+    if p.returncode != 0:
+        raise utils.InfrastructureException(
+            "Error copying requirements layer: %s" % (stdout + stderr))
+
+
+def restore(app_id, key, bundle_dir):
+    """
+    If the project's saved layer has the given key, create ``bundle_dir``
+    (which must not exist yet) from a copy of it.
+
+    :returns: True if the layer was used.
+    """
+    layer_dir = _layer_dir(app_id)
+    key_file = os.path.join(layer_dir, "key")
+
+    if key is None or not os.path.isfile(key_file):
+        return False
+    if _read(key_file) != key:
+        return False
+    if (time.time() - os.stat(key_file).st_mtime >
+        taskconfig.REQUIREMENTS_LAYER_MAX_AGE.days * 86400 +
+        taskconfig.REQUIREMENTS_LAYER_MAX_AGE.seconds):
+        return False
+
+    _copy([os.path.join(layer_dir, "venv")], bundle_dir)
+    utils.relocate_tree(bundle_dir,
+                        _read(os.path.join(layer_dir, "origin")),
+                        bundle_dir)
+    return True
+
+
+def save(app_id, key, bundle_dir, zoomdb=None):
+    """
+    Save the requirements installed in ``bundle_dir`` as the project's
+    layer, replacing any previous one. Failures are only warned about,
+    through ``zoomdb`` if given.
+
+    The bundle belongs to the project's user once its requirements are
+    installed, so it is taken back while it's copied, and then returned.
+    """
+    app_dir = os.path.join(taskconfig.NR_CUSTOMER_DIR, app_id)
+    layer_dir = _layer_dir(app_id)
+    tmp_dir = tempfile.mkdtemp(prefix=LAYER_DIRNAME + "-", dir=app_dir)
+
+    try:
+        utils.chown_to_me(bundle_dir)
+        try:
+            venv_dir = os.path.join(tmp_dir, "venv")
+            os.mkdir(venv_dir)
+            _copy([os.path.join(bundle_dir, name)
+                   for name in os.listdir(bundle_dir)
+                   if name not in EXCLUDED_FROM_LAYER], venv_dir)
+        finally:
+            utils.local_privileged(["project_chown", app_id, bundle_dir])
+
+        # this lists the project's own code dirs, which bundle_app adds
+        # again for each bundle.
+        pth = os.path.join(utils.get_site_packages(venv_dir),
+                           taskconfig.NR_PTH_FILENAME)
+        if os.path.exists(pth):
+            os.remove(pth)
+
+        _write(os.path.join(tmp_dir, "origin"), bundle_dir)
+        _write(os.path.join(tmp_dir, "key"), key)
+
+        if os.path.isdir(layer_dir):
+            shutil.rmtree(layer_dir)
+        os.rename(tmp_dir, layer_dir)
+
+    except Exception, e:
+        message = "Couldn't save requirements layer for %s: %s" % (app_id,
+                                                                   e)
+        if zoomdb:
+            zoomdb.log(message, zoomdb.LOG_WARN)
+        else:
+            print "Warning: " + message
+
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,166 @@
+"""
+Build-time processing of the static media in static bundles (see
+bundle.make_static_bundle), so that frontend proxies can serve them
+cheaply:
+
+- Text files get a gzipped sibling, ``<name>.gz``, at maximum compression,
+  which nginx serves with gzip_static rather than compressing the file for
+  every request.
+- Optionally, each file also gets a fingerprinted copy named after its
+  content, ``<name>.<hash>.<ext>``, which nginx serves with far-future
+  expiry headers as its content can never change. FINGERPRINTS_FILENAME in
+  each media directory maps the files' names to their fingerprinted ones.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+from dz.tasklib import taskconfig
+
+GZIP_EXTENSIONS = (".css", ".js", ".htm", ".html", ".txt", ".xml", ".json",
+                   ".svg", ".ico", ".eot", ".ttf")
+
+FINGERPRINT_LENGTH = 12
+FINGERPRINTS_FILENAME = "dz-fingerprints.json"
+
+# matches fingerprinted file names; nginx is given the same pattern.
+FINGERPRINTED_PATTERN = r"\.[0-9a-f]{%d}\.[^./]+" % FINGERPRINT_LENGTH
+_FINGERPRINTED_RE = re.compile(FINGERPRINTED_PATTERN + "$")
+
+_BUFFER_SIZE = 1024 * 1024
+
+
+def _media_files(media_dir):
+    """Paths, relative to ``media_dir``, of the files to process."""
+    for dirpath, dirnames, filenames in os.walk(media_dir):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(dirpath, filename),
+                                   media_dir)
+            if (filename.endswith(".gz") or
+                path == FINGERPRINTS_FILENAME or
+                os.path.islink(os.path.join(media_dir, path))):
+                continue
+            yield path
+
+
+def has_fingerprints(media_dir):
+    """
+    Did :func:`fingerprint` give any files in ``media_dir`` fingerprinted
+    copies? Only then should they be served with far-future expiry headers.
+    """
+    try:
+        f = open(os.path.join(media_dir, FINGERPRINTS_FILENAME))
+    except IOError:
+        return False
+    try:
+        return bool(json.load(f))
+    except ValueError:
+        return False
+    finally:
+        f.close()
+
+
+def _file_md5(filename):
+    h = hashlib.md5()
+    f = open(filename, "rb")
+    try:
+        for buf in iter(lambda: f.read(_BUFFER_SIZE), ""):
+            h.update(buf)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def fingerprinted_name(path, digest):
+    base, ext = os.path.splitext(path)
+    return "%s.%s%s" % (base, digest[:FINGERPRINT_LENGTH], ext)
+
+
+def fingerprint(media_dir):
+    """
+    Give each file in ``media_dir`` a fingerprinted copy (a hard link, as
+    neither is modified), and list them in FINGERPRINTS_FILENAME.
+
+    :returns: dict mapping file paths to fingerprinted paths.
+    """
+    fingerprints = {}
+    for path in list(_media_files(media_dir)):
+        if _FINGERPRINTED_RE.search(path):
+            continue  # fingerprinted already, by the project's own tools.
+        filename = os.path.join(media_dir, path)
+        new_path = fingerprinted_name(path, _file_md5(filename))
+        if not os.path.exists(os.path.join(media_dir, new_path)):
+            os.link(filename, os.path.join(media_dir, new_path))
+        fingerprints[path] = new_path
+
+    f = open(os.path.join(media_dir, FINGERPRINTS_FILENAME), "w")
+    try:
+        json.dump(fingerprints, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    return fingerprints
+
+
+def _gzip_file(filename, gz_filename):
+    """
+    Write a maximally compressed copy of a file, unless it wouldn't be
+    smaller.
+
+    :returns: True if the copy was written.
+    """
+    fsrc = open(filename, "rb")
+    try:
+        fdst = open(gz_filename, "wb")
+        try:
+            gz = gzip.GzipFile(os.path.basename(filename), "wb", 9, fdst)
+            try:
+                shutil.copyfileobj(fsrc, gz, _BUFFER_SIZE)
+            finally:
+                gz.close()
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+
+    if os.path.getsize(gz_filename) >= os.path.getsize(filename):
+        os.remove(gz_filename)
+        return False
+
+    shutil.copystat(filename, gz_filename)
+    return True
+
+
+def precompress(media_dir):
+    """
+    Write gzipped siblings of the text files in ``media_dir`` of at least
+    taskconfig.STATIC_GZIP_MIN_SIZE bytes.
+    """
+    # hard linked files, such as fingerprinted copies, share their .gz too.
+    gzipped = {}
+
+    for path in list(_media_files(media_dir)):
+        filename = os.path.join(media_dir, path)
+        gz_filename = filename + ".gz"
+        st = os.stat(filename)
+        if (not path.lower().endswith(GZIP_EXTENSIONS) or
+            st.st_size < taskconfig.STATIC_GZIP_MIN_SIZE or
+            os.path.exists(gz_filename)):
+            continue
+
+        inode = (st.st_dev, st.st_ino)
+        if inode in gzipped:
+            os.link(gzipped[inode], gz_filename)
+        elif _gzip_file(filename, gz_filename):
+            gzipped[inode] = gz_filename
+
+
+def process(media_dir):
+    """Process a static bundle's media directory as configured."""
+    if taskconfig.STATIC_FINGERPRINTS_ENABLED:
+        fingerprint(media_dir)
+    if taskconfig.STATIC_GZIP_ENABLED:
+        precompress(media_dir)
@@ -1,3 +1,4 @@
+import datetime
 import os
 
 from dz.tasklib.taskconfig_django import (DJANGO_VERSIONS,
@@ -60,10 +61,25 @@ APP_SERVICE_MAX_PORT = 25000
 NGINX_SITES_ENABLED_DIR = "/etc/nginx/sites-enabled"
 NGINX_REMOVE_OLD_BUNDLES_ON_UPDATE = True
 
+# Text files in static bundles get gzipped copies at maximum compression,
+# which nginx serves instead of compressing them for every request. With
+# STATIC_FINGERPRINTS_ENABLED, each static file also gets a copy named after
+# its content (see static_assets), which nginx serves with far-future expiry
+# headers; other static files expire after NGINX_STATIC_EXPIRES.
+STATIC_GZIP_ENABLED = True
+STATIC_GZIP_MIN_SIZE = 1100
+STATIC_FINGERPRINTS_ENABLED = False
+NGINX_STATIC_EXPIRES = "1h"
+
 PRIVILEGED_PROGRAMS_PATH = os.path.join(
     os.path.abspath(os.path.dirname(__file__)),
     "privileged-bin")
 
+# Unix socket of the privileged helper (see privileged_helper), which runs
+# privileged programs without starting sudo each time. With None, or if the
+# helper isn't running, they are run with sudo.
+PRIVILEGED_HELPER_SOCKET = None
+
 DEFAULT_BUNDLE_STORAGE_ENGINE = "bundle_storage"  # override to use
                                                   # "bundle_storage_local"
                                                   # in development
@@ -76,6 +92,152 @@ DZ_ADMIN_MEDIA = {
 
 LOG_DIR_SUPERVISOR = "/var/log/supervisor"
 
+# How many independent build_and_deploy steps may run at once? Set to 1 to
+# run every step in order. Only zoomdb's methods are called from the main
+# thread (see utils.run_steps); steps running at once may still share the
+# sqlsoup rows in opts, such as BUNDLE_INFO, so this stays 1 until every
+# step's declared reads and writes cover those.
+BUILD_STEPS_MAX_PARALLEL = 1
+
+# Reuse a copy of an earlier bundle of the same project, instead of building
+# a new one, when the code revision, zoombuild.cfg, requirements and Django
+# version are all unchanged? Only bundles at most BUILD_CACHE_MAX_AGE old are
+# reused, so that unpinned requirements are picked up again eventually.
+# This needs the build_key column of dz2_appbundle (see
+# tests/fixtures/dz2-simplified.sql), so it's off until the database has it.
+BUILD_CACHE_ENABLED = False
+BUILD_CACHE_MAX_AGE = datetime.timedelta(days=7)
+
+# Save a checkpoint after each build_and_deploy step, so that a failed job
+# retried with the same inputs and code resumes where it left off? Older
+# checkpoints than BUILD_CHECKPOINT_MAX_AGE are ignored. This needs the
+# dz2_jobcheckpoint table, so it's off until the database has it.
+BUILD_CHECKPOINTS_ENABLED = False
+BUILD_CHECKPOINT_MAX_AGE = datetime.timedelta(hours=6)
+
+# Bundles are cloned from virtualenvs with Django already installed, which
+# are kept here; set to None to build each bundle's virtualenv from scratch.
+# Keep it on the same filesystem as NR_CUSTOMER_DIR, so copies can be
+# reflinked where the filesystem supports it.
+VENV_TEMPLATES_DIR = os.path.join(NR_CUSTOMER_DIR, "venv-templates")
+
+# Packages downloaded by pip are cached here, and shared by all builds on the
+# node; set to None to disable. Keep it on the same filesystem as
+# NR_CUSTOMER_DIR, so that builds can use hard links to its entries.
+# Only downloads from PIP_DOWNLOAD_CACHE_TRUSTED_HOSTS are cached.
+PIP_DOWNLOAD_CACHE_DIR = os.path.join(NR_CUSTOMER_DIR, ".pip-download-cache")
+PIP_DOWNLOAD_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+PIP_DOWNLOAD_CACHE_TRUSTED_HOSTS = ("pypi.python.org",)
+
+# Keep a copy of the requirements installed in each project's latest bundle,
+# and make its next bundle from that copy instead of running pip, if its
+# requirements and Django version are unchanged? Copies older than
+# REQUIREMENTS_LAYER_MAX_AGE are not reused, so that unpinned requirements
+# are picked up again eventually.
+REQUIREMENTS_LAYER_ENABLED = True
+REQUIREMENTS_LAYER_MAX_AGE = datetime.timedelta(days=7)
+
+# Compression for bundle archives: "gzip", "pigz" (parallel gzip, falling
+# back to gzip where pigz isn't installed), "zstd" or "lz4". Archives are
+# extracted with the right decompressor whatever this is set to, but nodes
+# extracting zstd or lz4 bundles need those programs installed.
+# BUNDLE_CODEC_LEVEL of None uses the codec's default level, and
+# BUNDLE_CODEC_THREADS of 0 uses all CPUs (for pigz and zstd).
+BUNDLE_CODEC = "pigz"
+BUNDLE_CODEC_LEVEL = None
+BUNDLE_CODEC_THREADS = 0
+
+# Store bundles as a manifest of their files plus packs of their distinct
+# file contents, shared with the project's previous bundle, rather than as
+# an archive, so uploads and downloads only transfer contents not already
+# stored? A bundle doesn't share the packs of a previous bundle which uses
+# BUNDLE_MAX_PACKS or more. Nodes keep the contents they have downloaded in
+# BUNDLE_OBJECT_CACHE_DIR.
+BUNDLE_MANIFESTS_ENABLED = False
+BUNDLE_MAX_PACKS = 8
+BUNDLE_OBJECT_CACHE_DIR = os.path.join(NR_CUSTOMER_DIR, ".bundle-objects")
+BUNDLE_OBJECT_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+# Bundle archives (and manifests) downloaded on each node are kept here, so
+# reinstalling them doesn't download them again; set to None to disable.
+BUNDLE_ARCHIVE_CACHE_DIR = os.path.join(NR_CUSTOMER_DIR, ".bundle-cache")
+BUNDLE_ARCHIVE_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+# Connections to S3 for bundle storage are kept alive and reused; at most
+# this many idle ones are kept per process.
+BUNDLE_STORAGE_MAX_IDLE_CONNECTIONS = 8
+
+# Set BUNDLE_STORAGE_S3_HOST to use a local stand-in for S3 instead, at that
+# host and port.
+BUNDLE_STORAGE_S3_HOST = None
+BUNDLE_STORAGE_S3_PORT = None
+BUNDLE_STORAGE_S3_IS_SECURE = False
+
+# Have bundle_storage_local hand out hard links to stored bundles, and store
+# reflinks of uploaded ones where possible, rather than copying them?
+BUNDLE_STORAGE_LOCAL_LINKS = True
+
+# Bundles are uploaded to S3 while being compressed. Bundles bigger than
+# BUNDLE_TRANSFER_PART_SIZE (S3's minimum is 5MB) are uploaded and
+# downloaded in parts of that size, BUNDLE_TRANSFER_CONCURRENCY at once.
+BUNDLE_TRANSFER_PART_SIZE = 16 * 1024 * 1024
+BUNDLE_TRANSFER_CONCURRENCY = 4
+
+# Appservers deploying a bundle at the same time get it from each other,
+# rather than all from bundle storage (see bundle_peers). Each serves the
+# bundles it has on BUNDLE_PEER_PORT, where the others must be able to reach
+# it by its appserver name, to at most BUNDLE_PEER_FANOUT others. Peers wait
+# up to BUNDLE_PEER_WAIT seconds for a bundle they are still fetching before
+# the requester falls back to bundle storage. Requests are signed with
+# BUNDLE_PEER_SECRET, which must be the same on every node; leave it None to
+# get bundles from bundle storage only. Signatures expire after
+# BUNDLE_PEER_TOKEN_TTL seconds, so nodes' clocks must agree to well within
+# that.
+BUNDLE_PEER_SECRET = None
+BUNDLE_PEER_PORT = 8470
+BUNDLE_PEER_FANOUT = 2
+BUNDLE_PEER_WAIT = 60
+BUNDLE_PEER_TIMEOUT = 30
+BUNDLE_PEER_TOKEN_TTL = 300
+
+# Celery priority (0 highest, 9 lowest, where the broker supports them) of
+# the tasks getting bundles onto appservers ahead of their deploys.
+PREFETCH_TASK_PRIORITY = 9
+
+# How UserEnvs are made: "mounts" bind mounts a container directory for
+# each, which commands are run chrooted to; "namespace" sets up a root in a
+# private mount namespace for each command instead (see
+# userenv.NamespaceUserEnv), which needs unshare from util-linux.
+USERENV_BACKEND = "mounts"
+
+# Run projects' builds, commands and bundles in per-project cgroups (see the
+# cgroups module), with these limits on each project; a limit of None
+# leaves it unset. CGROUP_CPU_SHARES is relative to the default of 1024,
+# CGROUP_MEMORY_LIMIT is in bytes and CGROUP_IO_WEIGHT is 10-1000 (100 by
+# default).
+CGROUPS_ENABLED = False
+CGROUP_CPU_SHARES = 1024
+CGROUP_MEMORY_LIMIT = None
+CGROUP_IO_WEIGHT = None
+
+# UserEnvs got with userenv.get_userenv are kept for reuse by the same
+# project for up to USERENV_POOL_IDLE_TIMEOUT seconds; each process keeps at
+# most USERENV_POOL_MAX_IDLE of them, evicting the least recently used.
+# Celery workers destroy expired ones after each task, and all of them when
+# they shut down.
+USERENV_POOL_MAX_IDLE = 8
+USERENV_POOL_IDLE_TIMEOUT = 300
+
+# How many threads to copy a project's source into its bundle with.
+SOURCE_COPY_WORKERS = 4
+
+# Compile all of a bundle's Python to bytecode when building it?
+BUNDLE_PRECOMPILE_BYTECODE = True
+
+# Store per-step and per-subprocess timings in the dz2_jobtiming table? Off
+# until the database has that table.
+RECORD_JOB_TIMING = False
+
 # How long should the celery broadcast timeout be for log requests?
 LOGS_CELERY_BCAST_TIMEOUT = 1
 
@@ -28,7 +28,9 @@ CREATE TABLE "dz2_appbundle" (
     "project_id" integer NOT NULL, -- REFERENCES "dz2_project" ("id") DEFERRABLE INITIALLY DEFERRED,
     "bundle_name" varchar(255) NOT NULL,
     "code_revision" varchar(255),
-    "creation_date" timestamp with time zone NOT NULL
+    "creation_date" timestamp with time zone NOT NULL,
+    "deletion_date" timestamp with time zone,
+    "build_key" varchar(40)
 )
 ;
 
@@ -51,6 +53,31 @@ CREATE TABLE "dz2_log" (
 )
 ;
 
+CREATE TABLE "dz2_jobtiming" (
+    "id" INTEGER NOT NULL PRIMARY KEY,
+    "job_id" integer NOT NULL, -- REFERENCES "dz2_job" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "parent_id" integer, -- REFERENCES "dz2_jobtiming" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "kind" varchar(16) NOT NULL,
+    "name" varchar(255) NOT NULL,
+    "started_at" timestamp with time zone NOT NULL,
+    "wall_time" double precision NOT NULL,
+    "cpu_time" double precision,
+    "max_rss" bigint,
+    "read_bytes" bigint,
+    "write_bytes" bigint
+)
+;
+
+CREATE TABLE "dz2_jobcheckpoint" (
+    "id" INTEGER NOT NULL PRIMARY KEY,
+    "project_id" integer NOT NULL UNIQUE, -- REFERENCES "dz2_project" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "job_id" integer NOT NULL, -- REFERENCES "dz2_job" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "fingerprint" varchar(40) NOT NULL,
+    "state" text NOT NULL,
+    "updated_at" timestamp with time zone NOT NULL
+)
+;
+
 CREATE TABLE "dz2_appserverdeployment" (
     "id" INTEGER NOT NULL PRIMARY KEY,
     "project_id" integer NOT NULL, -- REFERENCES "dz2_project" ("id") DEFERRABLE INITIALLY DEFERRED,
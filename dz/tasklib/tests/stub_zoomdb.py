@@ -2,6 +2,7 @@ from dz.tasklib.zoomdb import ZoomDatabase
 from dz.tasklib import taskconfig
 
 import datetime
+import json
 
 class MockProject(object):
     owner = 0
@@ -54,9 +55,12 @@ class StubZoomDB(ZoomDatabase):
         self.project = MockProject()
         self.is_flushed = False
         self.bundles = []
+        self.bundle_build_keys = {}
         self.workers = []
         self.test_vhosts = []
         self._job_id = 1
+        self.timings = []
+        self.build_checkpoint = None
 
     def flush(self):
         self.is_flushed = True
@@ -76,10 +80,23 @@ class StubZoomDB(ZoomDatabase):
     def get_project_id(self):
         return self.project.project_id
 
-    def add_bundle(self, bundle_name, code_revision=None):
+    def add_bundle(self, bundle_name, code_revision=None, build_key=None):
         self.bundles.append((bundle_name, code_revision))
+        if build_key is not None:
+            self.bundle_build_keys[build_key] = bundle_name
         return MockBundle()
 
+    def find_bundle_by_build_key(self, build_key, max_age=None):
+        if build_key in self.bundle_build_keys:
+            return MockBundle(bundle_name=self.bundle_build_keys[build_key])
+        return None
+
+    def get_latest_bundle(self, exclude_name=None):
+        for bundle_name, code_revision in reversed(self.bundles):
+            if bundle_name != exclude_name:
+                return MockBundle(bundle_name=bundle_name)
+        return None
+
     def get_bundle(self, bundle_id):
         if len(self.bundles):
             return MockBundle(bundle_name=self.bundles[0][0])
@@ -97,6 +114,9 @@ class StubZoomDB(ZoomDatabase):
     def get_project_workers(self):
         return self.workers
 
+    def get_project_worker_by_id(self, deployment_id):
+        return [w for w in self.workers if w.id == deployment_id][0]
+
     def search_workers(self, bundle_ids=None, active=True):
         return self.workers
 
@@ -123,3 +143,23 @@ class StubZoomDB(ZoomDatabase):
             taskconfig.PROJECT_SYSID_FORMAT % self.get_project_id())
 
         return ["test-%s" % canonical_vhost_name] + self.test_vhosts
+
+    def add_step_timing(self, step, processes=()):
+        self.timings.append((step, list(processes)))
+
+    def get_timing_tree(self, job_id=None):
+        return [dict(step, children=list(processes))
+                for (step, processes) in self.timings]
+
+    def save_build_checkpoint(self, fingerprint, state):
+        # round-trip through JSON, as the real zoomdb does.
+        self.build_checkpoint = (fingerprint, self._job_id,
+                                 json.loads(json.dumps(state)))
+
+    def get_build_checkpoint(self, fingerprint, max_age=None):
+        if self.build_checkpoint and self.build_checkpoint[0] == fingerprint:
+            return self.build_checkpoint[1:]
+        return None
+
+    def clear_build_checkpoint(self):
+        self.build_checkpoint = None
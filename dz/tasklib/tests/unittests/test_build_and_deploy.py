@@ -0,0 +1,124 @@
+import os
+
+from dz.tasklib import (build_and_deploy,
+                        bundle)
+from dz.tasklib.database import DatabaseInfo
+from dz.tasklib.tests.dztestcase import DZTestCase
+from dz.tasklib.tests.stub_zoomdb import StubZoomDB
+
+
+class BuildCheckpointTestCase(DZTestCase):
+    def setUp(self):
+        self.zoomdb = StubZoomDB()
+        self.opts = {"APP_ID": "app", "APP_DIR": self.makeDir()}
+        self.input_keys = set(self.opts)
+        self.steps = (build_and_deploy.build_project_bundle,
+                      build_and_deploy.request_database_setup,
+                      build_and_deploy.upload_project_bundle,
+                      build_and_deploy.wait_for_database_setup_to_complete,
+                      build_and_deploy.select_app_server_for_deployment,
+                      build_and_deploy.deploy_project_to_appserver,
+                      build_and_deploy.run_post_deploy_hooks)
+
+    def _save(self, completed):
+        build_and_deploy._save_checkpoint(self.zoomdb, self.opts, "fp",
+                                          self.input_keys,
+                                          list(self.steps[:completed]))
+
+    def _resume(self, fingerprint="fp"):
+        opts = {"APP_ID": "app", "APP_DIR": self.opts["APP_DIR"]}
+        steps, skipped = build_and_deploy._resume_from_checkpoint(
+            self.zoomdb, opts, fingerprint, self.steps)
+        return opts, steps, skipped
+
+    def test_resume_after_deploy(self):
+        """
+        Test resuming a job whose deploy step finished, skipping everything
+        up to the post-deploy hooks.
+        """
+        self.opts["BUNDLE_NAME"] = "bundle_app_1"
+        self.opts["BUNDLE_INFO"] = self.zoomdb.add_bundle("bundle_app_1")
+        self.opts["BUNDLE_ARCHIVE"] = "bundle_app_1.tgz"
+        self.opts["DB"] = DatabaseInfo("host", "db", "user", "pw")
+        self.opts["PLACEMENT"] = ["localhost"]
+        worker = self.zoomdb.add_worker(self.opts["BUNDLE_INFO"].id,
+                                        "localhost", "127.0.0.1", 10001)
+        self.opts["DEPLOYED_ADDRESSES"] = [("localhost", "localhost",
+                                            "127.0.0.1", 10001)]
+        self.opts["DEPLOYED_WORKERS"] = [worker]
+        self._save(6)
+
+        opts, steps, skipped = self._resume()
+        self.assertEqual(list(steps),
+                         [build_and_deploy.run_post_deploy_hooks])
+        self.assertEqual(len(skipped), 6)
+        self.assertEqual(opts["BUNDLE_NAME"], "bundle_app_1")
+        self.assertEqual(opts["DB"].db_name, "db")
+        self.assertEqual(opts["DEPLOYED_ADDRESSES"],
+                         self.opts["DEPLOYED_ADDRESSES"])
+        self.assertEqual(opts["DEPLOYED_WORKERS"], [worker])
+
+        # undeployed workers can't be reused
+        worker.deactivation_date = worker.creation_date
+        opts, steps, skipped = self._resume()
+        self.assertEqual(steps[0],
+                         build_and_deploy.deploy_project_to_appserver)
+        self.assertFalse("DEPLOYED_WORKERS" in opts)
+
+        # nor can a checkpoint for different inputs
+        opts, steps, skipped = self._resume(fingerprint="other")
+        self.assertEqual(steps, self.steps)
+        self.assertEqual(skipped, [])
+
+    def test_pending_database_setup_is_rerun(self):
+        """
+        Test that a database setup request whose result was never collected
+        is made again on resume.
+        """
+        self.opts["BUNDLE_NAME"] = "bundle_app_1"
+        self.opts["BUNDLE_INFO"] = self.zoomdb.add_bundle("bundle_app_1")
+        self.opts["database_setup_result"] = object()
+        self.makeDir(path=os.path.join(self.opts["APP_DIR"], "bundle_app_1"))
+        self._save(2)
+
+        opts, steps, skipped = self._resume()
+        self.assertEqual(skipped, [build_and_deploy.build_project_bundle])
+        self.assertEqual(steps[0], build_and_deploy.request_database_setup)
+
+    def test_unuploaded_bundle_is_rebuilt(self):
+        """
+        Test that a bundle built but not uploaded, and missing from this
+        node, is built again on resume.
+        """
+        self.opts["BUNDLE_NAME"] = "bundle_not_on_this_node"
+        self.opts["BUNDLE_INFO"] = self.zoomdb.add_bundle(
+            "bundle_not_on_this_node")
+        self._save(1)
+
+        opts, steps, skipped = self._resume()
+        self.assertEqual(steps, self.steps)
+        self.assertFalse("BUNDLE_NAME" in opts)
+
+
+class BuildCacheTestCase(DZTestCase):
+    def test_lookup_failure_builds_from_scratch(self):
+        """
+        Test that failing to look up a previous build (e.g. without the
+        build_key column) leads to a full build, storing no build key.
+        """
+        zoomdb = StubZoomDB()
+
+        def find_bundle_by_build_key(build_key, max_age=None):
+            raise Exception("column dz2_appbundle.build_key does not exist")
+
+        self.patch(zoomdb, "find_bundle_by_build_key",
+                   find_bundle_by_build_key)
+        self.patch(bundle, "build_cache_key",
+                   lambda app_id, ue, **kwargs: ("key", u"rev"))
+
+        self.assertEqual(
+            build_and_deploy._reuse_cached_build(
+                zoomdb, {"APP_ID": "app", "SRC_REPO_TYPE": "git",
+                         "POST_BUILD_HOOKS": []}, None),
+            (None, None, None))
+        self.assertEqual(zoomdb.logs[-1][1], zoomdb.LOG_WARN)
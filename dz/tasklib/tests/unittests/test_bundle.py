@@ -2,6 +2,7 @@ import os
 import random
 import shutil
 import string
+import sys
 import tarfile
 import logging
 from StringIO import StringIO
@@ -169,7 +170,8 @@ class TasksTestCase(DZTestCase):
                                       base_package_as_path)
         # ensure base_python_path is represented
         self.assertTrue(path.isdir(user_src_base_dir))
-        listdir_usersrc = os.listdir(user_src_base_dir)
+        listdir_usersrc = [n for n in os.listdir(user_src_base_dir)
+                           if not n.endswith(".pyc")]
 
         listdir_fixture.sort()
         listdir_usersrc.sort()
@@ -221,6 +223,32 @@ class TasksTestCase(DZTestCase):
 
         self.assertTrue(first_settings < first_import < last_settings)
 
+        # the bundle's python was compiled.
+        self.assertTrue(path.isfile(path.join(user_src_base_dir, "urls.pyc")))
+        self.assertTrue(path.isfile(path.join(bundle_dir, "dz_settings.pyc")))
+
+    def test_precompile_bundle_failures(self):
+        """
+        Test a bundle is compiled with its own python, and files which
+        don't compile are reported.
+        """
+        class LocalEnv(object):
+            def subproc(self, command_list, nonzero_exit_ok=False):
+                return utils.subproc(command_list)
+
+        os.mkdir(path.join(self.dir, "bin"))
+        os.symlink(sys.executable, path.join(self.dir, "bin", "python"))
+        self.makeFile(content="x = 1\n", basename="good.py",
+                      dirname=self.dir)
+        self.makeFile(content="def (\n", basename="bad.py", dirname=self.dir)
+
+        zoomdb = StubZoomDB()
+        bundle._precompile_bundle(self.dir, LocalEnv(), zoomdb=zoomdb)
+        self.assertTrue(path.isfile(path.join(self.dir, "good.pyc")))
+        self.assertEqual(len(zoomdb.logs), 1)
+        self.assertEqual(zoomdb.logs[0][1], zoomdb.LOG_WARN)
+        self.assertTrue("bad.py" in zoomdb.logs[0][0])
+
     def test_build_and_upload(self):
         """
         Test that I can do a build and then upload the result. This test that
@@ -266,6 +294,70 @@ class TasksTestCase(DZTestCase):
         # delete uploaded bundle
         bundle_storage_local.delete(bundle_file_name)
 
+    def test_restore_cached_bundle_copy(self):
+        """
+        Test a reused build which needn't be relocated is copied within
+        bundle storage, rather than restored to be uploaded again.
+        """
+        self.patch(taskconfig, "NR_CUSTOMER_DIR", self.customer_directory)
+        app_id = path.basename(self.app_dir)
+        cached_name = path.basename(self.dir)
+        self.makeFile(content="print 'hi'\n", basename="hi.py",
+                      dirname=self.dir)
+        bundle.zip_and_upload_bundle(
+            app_id, cached_name, bundle_storage_engine=bundle_storage_local,
+            site_media_map={})
+
+        bundle_name, stored = bundle.restore_cached_bundle(
+            app_id, cached_name, bundle_storage_engine=bundle_storage_local)
+        self.assertTrue(stored)
+        self.assertFalse(path.exists(path.join(self.app_dir, bundle_name)))
+        self.assertEqual(bundle.stored_archive_name(bundle_name,
+                                                    bundle_storage_local),
+                         bundle_name + ".tgz")
+        self.assertTrue(bundle.has_static_bundle(bundle_name,
+                                                 bundle_storage_local))
+
+        # the copied archive extracts under the new bundle's name.
+        utils.get_and_extract_bundle(bundle_name, self.app_dir,
+                                     bundle_storage_local)
+        self.assertEqual(open(path.join(self.app_dir, bundle_name,
+                                        "hi.py")).read(),
+                         "print 'hi'\n")
+
+    def test_get_and_extract_bundle(self):
+        """
+        Test extracting a bundle replaces any left behind by an interrupted
+        extraction, and a corrupt archive fails without leaving one.
+        """
+        self.patch(taskconfig, "NR_CUSTOMER_DIR", self.customer_directory)
+        self.patch(taskconfig, "BUNDLE_ARCHIVE_CACHE_DIR", None)
+        app_id = path.basename(self.app_dir)
+        bundle_name = path.basename(self.dir)
+        self.makeFile(content="print 'hi'\n", basename="hi.py",
+                      dirname=self.dir)
+        bundle.zip_and_upload_bundle(
+            app_id, bundle_name, bundle_storage_engine=bundle_storage_local,
+            site_media_map={})
+
+        extract_dir = self.makeDir(dirname=self.customer_directory)
+        self.makeFile(content="", basename="stale.py",
+                      dirname=self.makeDir(path=path.join(extract_dir,
+                                                          bundle_name)))
+        utils.get_and_extract_bundle(bundle_name, extract_dir,
+                                     bundle_storage_local)
+        self.assertEqual(sorted(os.listdir(path.join(extract_dir,
+                                                     bundle_name))),
+                         ["hi.py"])
+
+        bundle_storage_local.put(
+            "bundle_corrupt.tgz",
+            self.makeFile(content="\x1f\x8b not really gzip"))
+        with self.assertRaises(utils.InfrastructureException):
+            utils.get_and_extract_bundle("bundle_corrupt", extract_dir,
+                                         bundle_storage_local)
+        self.assertEqual(os.listdir(extract_dir), [bundle_name])
+
     def test_check_repo(self):
         """
         Check repo and make guesses!
@@ -326,3 +418,95 @@ class TasksTestCase(DZTestCase):
                               bundle_storage_engine=bundle_storage_local)
 
         self.assertFalse(path.isfile(bundle_storage_file))
+
+
+class StaticBundleTestCase(DZTestCase):
+
+    def setUp(self):
+        self.customer_directory = self.makeDir()
+        self.patch(taskconfig, "NR_CUSTOMER_DIR", self.customer_directory)
+        self.app_dir = path.join(self.customer_directory, "app")
+        bundle_dir = path.join(self.app_dir, "bundle_app_1")
+
+        os.makedirs(path.join(bundle_dir, "user-src", "static", "css"))
+        open(path.join(bundle_dir, "user-src", "static", "css",
+                       "site.css"), "w").write("body {}\n")
+        open(path.join(bundle_dir, "user-src", "settings.py"), "w").write(
+            "SECRET_KEY = 'sekrit'\n")
+        os.symlink("user-src", path.join(bundle_dir, "user-repo"))
+
+        admin_media = path.join(bundle_dir,
+                                taskconfig.DZ_ADMIN_MEDIA["bundle_file_path"])
+        os.makedirs(admin_media)
+        open(path.join(admin_media, "admin.js"), "w").write("\n")
+
+    def test_make_static_bundle(self):
+        """
+        Test static bundles hold just the bundle's static media, at the
+        paths nginx is given for them.
+        """
+        static_name = bundle.make_static_bundle(
+            "app", "bundle_app_1",
+            {"/static/": "static", "/etc/": "../../../../etc"})
+        self.assertEqual(static_name, "bundle_app_1-static")
+
+        static_dir = path.join(self.app_dir, static_name)
+        entries = utils.site_media_entries(static_dir,
+                                           {"/static/": "static"})
+        self.assertEqual(
+            open(path.join(entries[0]["alias_dest"], "css",
+                           "site.css")).read(),
+            "body {}\n")
+        self.assertTrue(path.isfile(path.join(entries[1]["alias_dest"],
+                                              "admin.js")))
+
+        self.assertFalse(path.exists(path.join(static_dir, "user-src",
+                                               "settings.py")))
+        self.assertFalse(path.exists(path.join(static_dir, "etc")))
+
+    def test_static_bundle_symlinked_dirs(self):
+        """
+        Test symlinked directories within the bundle are copied into static
+        bundles, except those leading back to where they are.
+        """
+        bundle_dir = path.join(self.app_dir, "bundle_app_1")
+        vendor_dir = path.join(bundle_dir, "user-src", "vendor", "js")
+        os.makedirs(vendor_dir)
+        open(path.join(vendor_dir, "lib.js"), "w").write("lib()\n")
+        static_dir = path.join(bundle_dir, "user-src", "static")
+        os.symlink("../vendor", path.join(static_dir, "vendor"))
+        os.symlink("..", path.join(static_dir, "css", "up"))
+        os.symlink("/etc", path.join(static_dir, "etc"))
+
+        static_name = bundle.make_static_bundle("app", "bundle_app_1",
+                                                {"/static/": "static"})
+        static_media = utils.site_media_entries(
+            path.join(self.app_dir, static_name),
+            {"/static/": "static"})[0]["alias_dest"]
+
+        lib = path.join(static_media, "vendor", "js", "lib.js")
+        self.assertFalse(path.islink(path.join(static_media, "vendor")))
+        self.assertEqual(open(lib).read(), "lib()\n")
+        self.assertFalse(path.lexists(path.join(static_media, "css", "up")))
+        self.assertFalse(path.lexists(path.join(static_media, "etc")))
+
+    def test_upload_static_bundle(self):
+        """
+        Test uploading a bundle with its static media uploads and deletes
+        a static bundle too.
+        """
+        zoomdb = StubZoomDB()
+        db_bundle = zoomdb.add_bundle("bundle_app_1", "rev")
+
+        bundle.zip_and_upload_bundle(
+            "app", "bundle_app_1", bundle_storage_engine=bundle_storage_local,
+            site_media_map={"/static/": "static"})
+        self.assertTrue(bundle.has_static_bundle("bundle_app_1",
+                                                 bundle_storage_local))
+        self.assertFalse(path.exists(path.join(self.app_dir,
+                                               "bundle_app_1-static")))
+
+        bundle.delete_bundles(zoomdb, "app", [db_bundle.id],
+                              bundle_storage_engine=bundle_storage_local)
+        self.assertFalse(bundle.has_static_bundle("bundle_app_1",
+                                                  bundle_storage_local))
@@ -0,0 +1,58 @@
+import os
+from os import path
+
+from dz.tasklib import (taskconfig,
+                        bundle_cache)
+from dz.tasklib.tests.dztestcase import DZTestCase
+
+
+class FakeStorageEngine(object):
+    def __init__(self, test):
+        self.test = test
+        self.gets = []
+
+    def get(self, name):
+        self.gets.append(name)
+        if not name.endswith(".tgz"):
+            raise KeyError(name)
+        return self.test.makeFile("archive of %s" % name)
+
+
+class BundleCacheTestCase(DZTestCase):
+    def setUp(self):
+        self.cache_dir = path.join(self.makeDir(), "bundle-cache")
+        self.patch(taskconfig, "BUNDLE_ARCHIVE_CACHE_DIR", self.cache_dir)
+        self.engine = FakeStorageEngine(self)
+
+    def _get(self, bundle_name):
+        name, filename = bundle_cache.get_bundle_file(bundle_name,
+                                                      self.engine)
+        self.assertEqual(name, bundle_name + ".tgz")
+        content = open(filename).read()
+        os.remove(filename)
+        return content
+
+    def test_get_bundle_file(self):
+        """
+        Test bundles are only fetched from storage once.
+        """
+        for i in range(2):
+            self.assertEqual(self._get("bundle_app_1"),
+                             "archive of bundle_app_1.tgz")
+        self.assertEqual(self.engine.gets, ["bundle_app_1.tgz"])
+        self.assertEqual(bundle_cache.get_cache().names(),
+                         ["bundle_app_1.tgz"])
+
+    def test_eviction(self):
+        """
+        Test the least recently used bundles are evicted from the cache.
+        """
+        self.patch(taskconfig, "BUNDLE_ARCHIVE_CACHE_MAX_BYTES", 60)
+        self._get("bundle_app_1")
+        self._get("bundle_app_2")
+        cache = bundle_cache.get_cache()
+        os.utime(cache.entry_path("bundle_app_1.tgz"), (0, 0))
+        self._get("bundle_app_3")
+
+        self.assertEqual(sorted(cache.names()),
+                         ["bundle_app_2.tgz", "bundle_app_3.tgz"])
@@ -0,0 +1,54 @@
+import os
+import subprocess
+from os import path
+
+from dz.tasklib import (taskconfig,
+                        bundle_codecs)
+from dz.tasklib.tests.dztestcase import DZTestCase
+
+
+class BundleCodecsTestCase(DZTestCase):
+    def setUp(self):
+        self.dir = self.makeDir()
+        self.bundle_dir = path.join(self.dir, "bundle_app_1")
+        os.mkdir(self.bundle_dir)
+        open(path.join(self.bundle_dir, "settings.py"), "w").write("X = 1\n")
+
+    def _roundtrip(self, codec):
+        archive = path.join(self.dir, "bundle.tgz")
+        subprocess.check_call(
+            bundle_codecs.tar_create_command("bundle_app_1", archive,
+                                             codec=codec, level=1),
+            cwd=self.dir)
+        self.assertEqual(bundle_codecs.detect(archive),
+                         "gzip" if codec == "pigz" else codec)
+
+        extract_dir = self.makeDir()
+        subprocess.check_call(bundle_codecs.tar_extract_command(archive),
+                              cwd=extract_dir)
+        self.assertEqual(open(path.join(extract_dir, "bundle_app_1",
+                                        "settings.py")).read(), "X = 1\n")
+
+    def test_gzip(self):
+        """Test compressing and extracting gzip bundles."""
+        self._roundtrip("gzip")
+
+    def test_pigz(self):
+        """Test pigz bundles are gzip compatible."""
+        self._roundtrip("pigz")
+
+    def test_zstd(self):
+        """Test compressing and extracting zstd bundles."""
+        if not bundle_codecs._find_program("zstd"):
+            return
+        self._roundtrip("zstd")
+
+    def test_compress_program(self):
+        """Test compression levels and threads come from taskconfig."""
+        self.patch(taskconfig, "BUNDLE_CODEC", "zstd")
+        self.patch(taskconfig, "BUNDLE_CODEC_LEVEL", 25)
+        self.patch(taskconfig, "BUNDLE_CODEC_THREADS", 2)
+        self.assertTrue(bundle_codecs.compress_program().endswith(
+                "zstd -19 -T2"))
+        self.assertRaises(ValueError, bundle_codecs.compress_program,
+                          codec="rar")
@@ -0,0 +1,201 @@
+import os
+import shutil
+from os import path
+
+from dz.tasklib import (taskconfig,
+                        bundle,
+                        bundle_manifest,
+                        bundle_storage_local)
+from dz.tasklib.tests.dztestcase import DZTestCase
+
+
+class BundleManifestTestCase(DZTestCase):
+    def setUp(self):
+        self.customer_dir = self.makeDir()
+        self.patch(taskconfig, "NR_CUSTOMER_DIR", self.customer_dir)
+        self.patch(taskconfig, "BUNDLE_OBJECT_CACHE_DIR",
+                   path.join(self.customer_dir, ".bundle-objects"))
+        self.app_dir = path.join(self.customer_dir, "app")
+        self.storage_dir = path.join(self.customer_dir,
+                                     "bundle_storage_local")
+
+    def _make_bundle(self, bundle_name, settings):
+        bundle_dir = path.join(self.app_dir, bundle_name)
+        os.makedirs(path.join(bundle_dir, "user-src", ".hidden"))
+        open(path.join(bundle_dir, "user-src", "settings.py"), "w").write(
+            settings)
+        open(path.join(bundle_dir, "user-src", "manage.py"), "w").write(
+            "import settings\n")
+        os.chmod(path.join(bundle_dir, "user-src", "manage.py"), 0755)
+        os.symlink("user-src", path.join(bundle_dir, "user-repo"))
+        return bundle_dir
+
+    def _upload(self, bundle_name, base_bundle=None):
+        return bundle_manifest.upload_bundle(
+            self.app_dir, bundle_name, bundle_storage_local,
+            lambda name: bundle._upload_archive(self.app_dir, name,
+                                                bundle_storage_local),
+            base_bundle=base_bundle)
+
+    def _packs(self, bundle_name):
+        return bundle_manifest._get_manifest(bundle_name,
+                                             bundle_storage_local)["packs"]
+
+    def _has_pack(self, bundle_name):
+        return path.isfile(path.join(self.storage_dir,
+                                     bundle_manifest.pack_archive_name(
+                    bundle_manifest.pack_name(bundle_name))))
+
+    def _assert_downloads(self, bundle_name):
+        download_dir = self.makeDir()
+        bundle_manifest.download_bundle(bundle_name, download_dir,
+                                        bundle_storage_local)
+        self.assertEqual(
+            bundle_manifest.make_manifest(path.join(download_dir,
+                                                    bundle_name)),
+            bundle_manifest.make_manifest(path.join(self.app_dir,
+                                                    bundle_name)))
+        return path.join(download_dir, bundle_name)
+
+    def test_upload_and_download(self):
+        """
+        Test a bundle uploaded with a base bundle only packs the file
+        contents the base's packs don't hold, and downloading bundles
+        recreates them.
+        """
+        self._make_bundle("bundle_1", "DEBUG = True\n")
+        self.assertEqual(self._upload("bundle_1"),
+                         "bundle_1" + bundle_manifest.MANIFEST_SUFFIX)
+        self.assertEqual(self._packs("bundle_1").keys(), ["bundle_1.pack"])
+        self.assertEqual(len(self._packs("bundle_1")["bundle_1.pack"]), 2)
+
+        self._make_bundle("bundle_2", "DEBUG = False\n")
+        self._upload("bundle_2", base_bundle="bundle_1")
+        packs = self._packs("bundle_2")
+        self.assertEqual(sorted(packs), ["bundle_1.pack", "bundle_2.pack"])
+        self.assertEqual(len(packs["bundle_1.pack"]), 1)
+        self.assertEqual(len(packs["bundle_2.pack"]), 1)
+
+        self._assert_downloads("bundle_1")
+        bundle_dir = self._assert_downloads("bundle_2")
+        self.assertEqual(os.readlink(path.join(bundle_dir, "user-repo")),
+                         "user-src")
+        self.assertEqual(open(path.join(bundle_dir, "user-src",
+                                        "settings.py")).read(),
+                         "DEBUG = False\n")
+
+    def test_delete_collects_packs(self):
+        """
+        Test deleting bundles deletes the packs no remaining bundle uses.
+        """
+        self._make_bundle("bundle_1", "DEBUG = True\n")
+        self._upload("bundle_1")
+        self._make_bundle("bundle_2", "DEBUG = False\n")
+        self._upload("bundle_2", base_bundle="bundle_1")
+
+        bundle_manifest.delete_manifest("bundle_1", bundle_storage_local)
+        self.assertFalse(bundle_manifest.has_manifest("bundle_1",
+                                                      bundle_storage_local))
+        self.assertTrue(self._has_pack("bundle_1"))
+        self._assert_downloads("bundle_2")
+
+        bundle_manifest.delete_manifest("bundle_2", bundle_storage_local)
+        self.assertFalse(self._has_pack("bundle_1"))
+        self.assertFalse(self._has_pack("bundle_2"))
+
+    def test_max_packs(self):
+        """
+        Test a bundle doesn't use the packs of a base which uses too many.
+        """
+        self.patch(taskconfig, "BUNDLE_MAX_PACKS", 2)
+        self._make_bundle("bundle_1", "DEBUG = True\n")
+        self._upload("bundle_1")
+        self._make_bundle("bundle_2", "DEBUG = False\n")
+        self._upload("bundle_2", base_bundle="bundle_1")
+        self._make_bundle("bundle_3", "DEBUG = None\n")
+        self._upload("bundle_3", base_bundle="bundle_2")
+
+        self.assertEqual(self._packs("bundle_3").keys(), ["bundle_3.pack"])
+        self.assertEqual(len(self._packs("bundle_3")["bundle_3.pack"]), 2)
+        self._assert_downloads("bundle_3")
+
+    def test_copy_manifest(self):
+        """
+        Test a copied manifest keeps the packs it uses after the original
+        bundle is deleted.
+        """
+        self._make_bundle("bundle_1", "DEBUG = True\n")
+        self._upload("bundle_1")
+        bundle_manifest.copy_manifest("bundle_1", "bundle_2",
+                                      bundle_storage_local)
+        bundle_manifest.delete_manifest("bundle_1", bundle_storage_local)
+        self.assertTrue(self._has_pack("bundle_1"))
+
+        download_dir = self.makeDir()
+        bundle_manifest.download_bundle("bundle_2", download_dir,
+                                        bundle_storage_local)
+        self.assertEqual(
+            bundle_manifest.make_manifest(path.join(download_dir,
+                                                    "bundle_2")),
+            bundle_manifest.make_manifest(path.join(self.app_dir,
+                                                    "bundle_1")))
+
+    def test_corrupt_pack(self):
+        """
+        Test downloading a bundle fails if a pack doesn't hold valid objects
+        for it.
+        """
+        self._make_bundle("bundle_1", "DEBUG = True\n")
+        self._upload("bundle_1")
+        self._make_bundle("bundle_2", "DEBUG = False\n")
+        self._upload("bundle_2")
+
+        pack_file = path.join(self.storage_dir, "bundle_1.pack.tgz")
+        os.chmod(pack_file, 0644)
+        shutil.copyfile(path.join(self.storage_dir, "bundle_2.pack.tgz"),
+                        pack_file)
+
+        self.assertRaises(IOError, bundle_manifest.download_bundle,
+                          "bundle_1", self.makeDir(), bundle_storage_local)
+
+    def test_object_in_no_pack(self):
+        """
+        Test downloading a bundle fails at once if its manifest lists
+        objects no pack holds.
+        """
+        self._make_bundle("bundle_1", "DEBUG = True\n")
+        self._upload("bundle_1")
+        manifest = bundle_manifest._get_manifest("bundle_1",
+                                                 bundle_storage_local)
+        manifest["packs"]["bundle_1.pack"].pop()
+        bundle_manifest._put_manifest("bundle_1", manifest,
+                                      bundle_storage_local)
+
+        fetched = []
+        self.assertRaises(IOError, bundle_manifest.download_bundle,
+                          "bundle_1", self.makeDir(), bundle_storage_local,
+                          get_file=fetched.append)
+        self.assertEqual(fetched, [])
+
+    def test_objects_keep_being_evicted(self):
+        """
+        Test downloading a bundle gives up if its objects keep being evicted
+        before it can be written.
+        """
+        self._make_bundle("bundle_1", "DEBUG = True\n")
+        self._upload("bundle_1")
+
+        cache = bundle_manifest.get_object_cache()
+        self.patch(cache, "has", lambda name: False)
+        self.patch(bundle_manifest, "get_object_cache", lambda: cache)
+
+        fetched = []
+
+        def get_file(name):
+            fetched.append(name)
+            return bundle_storage_local.get(name)
+
+        self.assertRaises(IOError, bundle_manifest.download_bundle,
+                          "bundle_1", self.makeDir(), bundle_storage_local,
+                          get_file=get_file)
+        self.assertEqual(len(fetched), bundle_manifest.DOWNLOAD_ATTEMPTS)
@@ -0,0 +1,147 @@
+import httplib
+import os
+import socket
+import threading
+import time
+from os import path
+
+from dz.tasklib import (taskconfig,
+                        bundle_cache,
+                        bundle_peers)
+from dz.tasklib.tests.dztestcase import DZTestCase
+
+
+class FakeStorageEngine(object):
+    def __init__(self, test):
+        self.test = test
+        self.gets = []
+
+    def get(self, name):
+        self.gets.append(name)
+        return self.test.makeFile("storage copy of %s" % name)
+
+
+def _free_port():
+    s = socket.socket()
+    try:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+class BundlePeersTestCase(DZTestCase):
+    def setUp(self):
+        cust_dir = self.makeDir()
+        self.patch(taskconfig, "BUNDLE_ARCHIVE_CACHE_DIR",
+                   path.join(cust_dir, ".bundle-cache"))
+        self.patch(taskconfig, "BUNDLE_OBJECT_CACHE_DIR",
+                   path.join(cust_dir, ".bundle-objects"))
+        self.patch(taskconfig, "BUNDLE_PEER_SECRET", "sekrit")
+        self.patch(taskconfig, "BUNDLE_PEER_PORT", _free_port())
+        self.patch(taskconfig, "BUNDLE_PEER_WAIT", 1)
+        self.engine = FakeStorageEngine(self)
+        bundle_peers.start_server()
+        self.addCleanup(bundle_peers.stop_server)
+
+    def _cache(self, name, content):
+        cache = bundle_cache.get_cache()
+        fd, tmp = cache.mkstemp()
+        os.write(fd, content)
+        os.close(fd)
+        cache.add(name, tmp)
+
+    def _get(self, name):
+        storage = bundle_peers.PeerStorage(self.engine, ["localhost"])
+        filename = storage.get(name)
+        content = open(filename).read()
+        os.remove(filename)
+        return content
+
+    def test_get_from_peer(self):
+        """
+        Test bundles a peer has are got from it rather than storage.
+        """
+        self._cache("bundle_app_1.tgz", "peer copy")
+        self.assertEqual(self._get("bundle_app_1.tgz"), "peer copy")
+        self.assertEqual(self.engine.gets, [])
+
+    def test_fall_back_to_storage(self):
+        """
+        Test bundles a peer doesn't have are got from storage.
+        """
+        self.assertEqual(self._get("bundle_app_2.tgz"),
+                         "storage copy of bundle_app_2.tgz")
+        self.assertEqual(self.engine.gets, ["bundle_app_2.tgz"])
+
+    def test_wait_for_fetching(self):
+        """
+        Test a peer asked for a bundle it is fetching waits for it.
+        """
+        cache = bundle_cache.get_cache()
+        marker = cache.mark_fetching("bundle_app_3.tgz")
+
+        def fetched():
+            self._cache("bundle_app_3.tgz", "peer copy")
+            marker.close()
+
+        timer = threading.Timer(0.2, fetched)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual(self._get("bundle_app_3.tgz"), "peer copy")
+        self.assertEqual(self.engine.gets, [])
+
+    def test_no_wait_unless_fetching(self):
+        """
+        Test a peer answers at once for bundles it isn't fetching.
+        """
+        self.patch(taskconfig, "BUNDLE_PEER_WAIT", 10)
+        start = time.time()
+        self._get("bundle_app_2.tgz")
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(self.engine.gets, ["bundle_app_2.tgz"])
+
+    def _request_status(self, name, token):
+        conn = httplib.HTTPConnection("localhost",
+                                      taskconfig.BUNDLE_PEER_PORT)
+        try:
+            conn.request("GET", "/" + name,
+                         headers={bundle_peers.TOKEN_HEADER: token})
+            return conn.getresponse().status
+        finally:
+            conn.close()
+
+    def test_unsigned_request(self):
+        """
+        Test requests without the right token are refused.
+        """
+        self._cache("bundle_app_1.tgz", "peer copy")
+        self.assertEqual(self._request_status("bundle_app_1.tgz", "guess"),
+                         httplib.FORBIDDEN)
+        self.assertEqual(self._request_status(
+                "bundle_app_1.tgz", bundle_peers._token("bundle_app_2.tgz")),
+                         httplib.FORBIDDEN)
+        self.assertEqual(self._request_status(
+                "bundle_app_1.tgz", bundle_peers._token("bundle_app_1.tgz")),
+                         httplib.OK)
+
+    def test_expired_token(self):
+        """
+        Test requests with an expired token are refused.
+        """
+        self._cache("bundle_app_1.tgz", "peer copy")
+        token = bundle_peers._token("bundle_app_1.tgz",
+                                    expires=int(time.time()) - 1)
+        self.assertEqual(self._request_status("bundle_app_1.tgz", token),
+                         httplib.FORBIDDEN)
+
+    def test_fanout_peers(self):
+        """
+        Test appservers deploying together are arranged in a tree.
+        """
+        self.assertEqual(
+            bundle_peers.fanout_peers(["a", "b", "c", "d", "e"], fanout=2),
+            [[], ["a"], ["a"], ["b"], ["b"]])
+
+        self.patch(taskconfig, "BUNDLE_PEER_SECRET", None)
+        self.assertEqual(bundle_peers.fanout_peers(["a", "b"]), [[], []])
@@ -3,9 +3,133 @@ from dz.tasklib import (taskconfig,
                         bundle_storage_local)
 from dz.tasklib.tests.dztestcase import DZTestCase, requires_internet
 
+import hashlib
 import os
 import tempfile
 import random
+import socket
+import time
+import Queue
+from StringIO import StringIO
+
+
+class FakeS3Key(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        if name in bucket.contents:
+            self.size = len(bucket.contents[name])
+            self.etag = bucket.etags[name]
+
+    def get_metadata(self, name):
+        return self.bucket.metadata.get(self.name, {}).get(name)
+
+    def set_contents_from_file(self, f, policy=None):
+        self.set_contents_from_string(f.read())
+
+    def set_contents_from_string(self, data, policy=None):
+        self.bucket.contents[self.name] = data
+        self.bucket.etags[self.name] = '"%s"' % hashlib.md5(data).hexdigest()
+
+    def get_contents_to_file(self, f, headers=None):
+        data = self.bucket.contents[self.name]
+        if headers and "Range" in headers:
+            start, end = headers["Range"].split("=")[1].split("-")
+            data = data[int(start):int(end) + 1]
+        f.write(data)
+
+    def get_contents_to_filename(self, filename):
+        f = open(filename, "wb")
+        self.get_contents_to_file(f)
+        f.close()
+
+    def delete(self):
+        self.bucket.delete_key(self.name)
+
+
+class FakeMultiPartUpload(object):
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.key_name = None
+        self.id = None
+        self.metadata = {}
+
+    def upload_part_from_file(self, f, part_num):
+        self.bucket.uploads[self.id][part_num] = f.read()
+
+    def complete_upload(self):
+        parts = self.bucket.uploads.pop(self.id)
+        data = "".join(parts[n] for n in sorted(parts))
+        self.bucket.contents[self.key_name] = data
+        self.bucket.metadata[self.key_name] = self.metadata
+        etag = '"%s-%d"' % (
+            hashlib.md5("".join(hashlib.md5(parts[n]).digest()
+                                for n in sorted(parts))).hexdigest(),
+            len(parts))
+        self.bucket.etags[self.key_name] = etag
+        self.etag = etag
+        return self
+
+    def cancel_upload(self):
+        del self.bucket.uploads[self.id]
+
+
+class FakeS3Bucket(object):
+    def __init__(self, name):
+        self.name = name
+        self.contents = {}
+        self.etags = {}
+        self.metadata = {}
+        self.uploads = {}
+
+    def new_key(self, name):
+        return FakeS3Key(self, name)
+
+    def get_key(self, name):
+        if name in self.contents:
+            return FakeS3Key(self, name)
+        return None
+
+    def delete_key(self, name):
+        del self.contents[name]
+        del self.etags[name]
+        self.metadata.pop(name, None)
+
+    def copy_key(self, new_name, bucket_name, name, preserve_acl=False):
+        self.contents[new_name] = self.contents[name]
+        # S3 copies in one go, so the copy's ETag is its plain MD5.
+        self.etags[new_name] = '"%s"' % hashlib.md5(
+            self.contents[name]).hexdigest()
+        self.metadata[new_name] = dict(self.metadata.get(name, {}))
+
+    def list(self, prefix=""):
+        return [FakeS3Key(self, name) for name in sorted(self.contents)
+                if name.startswith(prefix)]
+
+    def initiate_multipart_upload(self, name, policy=None, metadata=None):
+        mp = FakeMultiPartUpload(self)
+        mp.key_name = name
+        mp.metadata = metadata or {}
+        mp.id = str(len(self.uploads) + 1)
+        self.uploads[mp.id] = {}
+        return mp
+
+
+class FakeS3Connection(object):
+    """In-memory stand-in for boto's S3Connection."""
+    instances = []
+    buckets = {}
+
+    def __init__(self, **kwargs):
+        self.get_bucket_calls = 0
+        FakeS3Connection.instances.append(self)
+
+    def get_bucket(self, name):
+        self.get_bucket_calls += 1
+        return self.buckets.setdefault(name, FakeS3Bucket(name))
+
+    def close(self):
+        pass
 
 
 class BundleStorageTestCase(DZTestCase):
@@ -39,6 +163,168 @@ class BundleStorageTestCase(DZTestCase):
             # Getting a deleted bundle should raise an exception.
             storage_engine.get(bundlename)
 
+    def _test_put_stream(self, storage_engine, content):
+        """Put a bundle from a stream, and get it back."""
+        bundlename = "bundle_" + str(random.randint(1000, 9999))
+
+        storage_engine.put_stream(bundlename, StringIO(content))
+
+        downloaded_bundle_filename = storage_engine.get(bundlename)
+        self.assertEqual(open(downloaded_bundle_filename).read(), content)
+        os.remove(downloaded_bundle_filename)
+
+        storage_engine.delete(bundlename)
+
+    @requires_internet
+    def test_s3_put_stream(self):
+        """Test streaming a bundle to S3 in several parts."""
+        self.patch(taskconfig, "BUNDLE_TRANSFER_PART_SIZE", 5 * 1024 * 1024)
+        content = "".join(chr(random.randint(0, 255))
+                          for i in xrange(11 * 1024 * 1024))
+        return self._test_put_stream(bundle_storage, content)
+
+    def test_local_put_stream(self):
+        """Test streaming a bundle to local storage."""
+        return self._test_put_stream(bundle_storage_local,
+                                     "This is a fake bundle stream.\n" * 1000)
+
+    def _use_fake_s3(self):
+        self.patch(bundle_storage, "S3Connection", FakeS3Connection)
+        self.patch(bundle_storage, "Key", FakeS3Key)
+        self.patch(bundle_storage, "MultiPartUpload", FakeMultiPartUpload)
+        self.patch(bundle_storage, "_idle_buckets", Queue.Queue())
+        FakeS3Connection.instances = []
+        FakeS3Connection.buckets = {}
+
+    def test_s3_connection_pool(self):
+        """Test S3 connections and buckets are reused between operations."""
+        self._use_fake_s3()
+
+        for i in range(3):
+            self._test_put_get_delete_bundle(bundle_storage)
+
+        self.assertEqual(len(FakeS3Connection.instances), 1)
+        self.assertEqual(FakeS3Connection.instances[0].get_bucket_calls, 1)
+
+    def _test_list_names(self, storage_engine):
+        """Put some bundles, and list those with a prefix."""
+        for name in ("bundle_a.pack.refs/bundle_a", "bundle_a.pack.refs/b",
+                     "bundle_a.pack.tgz", "bundle_b.pack.refs/bundle_b"):
+            storage_engine.put(name, self.makeFile(""))
+        self.assertEqual(storage_engine.list_names("bundle_a.pack.refs/"),
+                         ["bundle_a.pack.refs/b",
+                          "bundle_a.pack.refs/bundle_a"])
+        self.assertEqual(storage_engine.list_names("bundle_a.pack.refs/bu"),
+                         ["bundle_a.pack.refs/bundle_a"])
+        self.assertEqual(storage_engine.list_names("bundle_c.pack.refs/"),
+                         [])
+
+    def test_s3_list_names(self):
+        """Test listing bundles on S3."""
+        self._use_fake_s3()
+        self._test_list_names(bundle_storage)
+
+    def test_local_list_names(self):
+        """Test listing bundles in local storage."""
+        self.patch(taskconfig, "NR_CUSTOMER_DIR", self.makeDir())
+        self._test_list_names(bundle_storage_local)
+
+    def test_s3_parallel_transfers(self):
+        """Test big bundles are uploaded and downloaded in parts."""
+        self._use_fake_s3()
+        self.patch(taskconfig, "BUNDLE_TRANSFER_PART_SIZE", 1000)
+        self.patch(taskconfig, "BUNDLE_TRANSFER_CONCURRENCY", 3)
+
+        content = "".join(chr(random.randint(0, 255)) for i in xrange(9500))
+        filename = self.makeFile(content)
+        bundle_storage.put("bundle_big", filename)
+        bucket = FakeS3Connection.buckets[taskconfig.NR_BUNDLE_BUCKET]
+        self.assertTrue(bucket.etags["bundle_big"].endswith('-10"'))
+
+        downloaded = bundle_storage.get("bundle_big")
+        self.assertEqual(open(downloaded, "rb").read(), content)
+        os.remove(downloaded)
+
+        self._test_put_stream(bundle_storage, content)
+
+        # downloads are checked against the ETag, for the part size it was
+        # uploaded with, even if the same number of parts of the current
+        # part size would give a different one.
+        self.patch(taskconfig, "BUNDLE_TRANSFER_PART_SIZE", 999)
+        downloaded = bundle_storage.get("bundle_big")
+        self.assertEqual(open(downloaded, "rb").read(), content)
+        os.remove(downloaded)
+
+        bucket.contents["bundle_big"] = content[::-1]
+        self.assertRaises(IOError, bundle_storage.get, "bundle_big")
+
+    def test_s3_copy(self):
+        """
+        Test bundles copied within S3, including those uploaded in parts, can
+        be downloaded from their copy.
+        """
+        self._use_fake_s3()
+        self.patch(taskconfig, "BUNDLE_TRANSFER_PART_SIZE", 1000)
+        content = "".join(chr(random.randint(0, 255)) for i in xrange(2500))
+        bundle_storage.put("bundle_big", self.makeFile(content))
+
+        bundle_storage.copy("bundle_big", "bundle_copy")
+        downloaded = bundle_storage.get("bundle_copy")
+        self.assertEqual(open(downloaded, "rb").read(), content)
+        os.remove(downloaded)
+
+        self.assertRaises(KeyError, bundle_storage.copy, "bundle_missing",
+                          "bundle_copy")
+
+    def test_s3_parallel_transfer_connect_error(self):
+        """
+        Test transfers in parts fail, rather than hang, if the threads
+        transferring them can't connect.
+        """
+        self._use_fake_s3()
+        self.patch(taskconfig, "BUNDLE_TRANSFER_PART_SIZE", 1000)
+        self.patch(taskconfig, "BUNDLE_TRANSFER_CONCURRENCY", 2)
+
+        connect = bundle_storage._connect
+        connections = []
+
+        def connect_once():
+            if connections:
+                raise socket.error("Connection refused")
+            connections.append(connect())
+            return connections[0]
+
+        self.patch(bundle_storage, "_connect", connect_once)
+        filename = self.makeFile("x" * 9500)
+        self.assertRaises(socket.error,
+                          bundle_storage.put, "bundle_big", filename)
+        bucket = FakeS3Connection.buckets[taskconfig.NR_BUNDLE_BUCKET]
+        self.assertFalse(bucket.uploads)
+        self.assertFalse("bundle_big" in bucket.contents)
+
+    def test_read_parts_in_background_stops(self):
+        """
+        Test reading parts ahead stops once the parts are no longer wanted,
+        such as after an upload failed.
+        """
+        class EndlessFile(object):
+            reads = 0
+
+            def read(self, size):
+                self.reads += 1
+                return "x" * size
+
+        fileobj = EndlessFile()
+        parts = bundle_storage._read_parts_in_background(fileobj, 10)
+        self.assertEqual(parts.next(), "x" * 10)
+        parts.close()
+
+        reads = fileobj.reads
+        time.sleep(0.1)
+        self.assertEqual(fileobj.reads, reads)
+        # the part taken, two read ahead, and one read while stopping.
+        self.assertTrue(reads <= 4)
+
     @requires_internet
     def test_s3_storage_engine(self):
         """Test S3-based bundle storage."""
@@ -47,3 +333,20 @@ class BundleStorageTestCase(DZTestCase):
     def test_local_storage_engine(self):
         """Test local bundle storage."""
         return self._test_put_get_delete_bundle(bundle_storage_local)
+
+    def test_local_storage_links(self):
+        """
+        Test local bundle storage hands out links to its read-only bundles,
+        which stay valid when the bundle is deleted.
+        """
+        self.patch(taskconfig, "BUNDLE_STORAGE_LOCAL_LINKS", True)
+        bundle_storage_local.put("bundle_linked", self.makeFile("content"))
+        stored = bundle_storage_local.get_path("bundle_linked")
+        self.assertEqual(os.stat(stored).st_mode & 0777, 0444)
+
+        downloaded = bundle_storage_local.get("bundle_linked")
+        self.assertEqual(os.stat(downloaded).st_ino, os.stat(stored).st_ino)
+
+        bundle_storage_local.delete("bundle_linked")
+        self.assertEqual(open(downloaded).read(), "content")
+        os.remove(downloaded)
@@ -0,0 +1,99 @@
+import os
+import time
+
+from dz.tasklib.cachedir import CacheDir
+from dz.tasklib.tests.dztestcase import DZTestCase
+
+
+class CacheDirTestCase(DZTestCase):
+    def setUp(self):
+        self.dir = self.makeDir()
+
+    def _add(self, cache, name, size, age):
+        fd, tmp = cache.mkstemp()
+        os.write(fd, "x" * size)
+        os.close(fd)
+        cache.add(name, tmp)
+        then = time.time() - age
+        os.utime(cache.entry_path(name), (then, then))
+
+    def test_add(self):
+        """
+        Test adding entries, which become visible all at once.
+        """
+        cache = CacheDir(self.dir, 1000)
+        self.assertEqual(cache.names(), [])
+        self._add(cache, "entry", 10, 0)
+        self.assertTrue(cache.has("entry"))
+        self.assertEqual(cache.names(), ["entry"])
+        self.assertEqual(oct(os.stat(cache.entry_path("entry")).st_mode & 0777),
+                         "0644")
+
+    def test_evict_least_recently_used(self):
+        """
+        Test that eviction removes the oldest entries first, and only until
+        the cache is small enough.
+        """
+        cache = CacheDir(self.dir, 250)
+        self._add(cache, "old", 100, 300)
+        self._add(cache, "used", 100, 200)
+        self._add(cache, "new", 100, 100)
+        cache.touch("used")
+
+        lock = cache.lock(exclusive=True)
+        cache.evict()
+        lock.close()
+
+        self.assertEqual(sorted(cache.names()), ["new", "used"])
+
+    def test_evict_groups(self):
+        """
+        Test that grouped entries are evicted together.
+        """
+        cache = CacheDir(self.dir, 150,
+                         group=lambda name: name.split(".")[0])
+        self._add(cache, "a", 100, 300)
+        self._add(cache, "a.meta", 10, 0)
+        self._add(cache, "b", 100, 200)
+        self._add(cache, "b.meta", 10, 200)
+
+        cache.evict()
+        self.assertEqual(sorted(cache.names()), ["a", "a.meta"])
+
+    def test_stale_temp_files(self):
+        """
+        Test that eviction cleans up abandoned temp files.
+        """
+        cache = CacheDir(self.dir, 1000)
+        fd, stale = cache.mkstemp()
+        os.close(fd)
+        then = time.time() - 2 * 60 * 60
+        os.utime(stale, (then, then))
+        fd, fresh = cache.mkstemp()
+        os.close(fd)
+
+        cache.evict()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_fetching(self):
+        """
+        Test entries are marked as being fetched until their marker is
+        closed, and eviction cleans up markers no longer held.
+        """
+        cache = CacheDir(self.dir, 1000)
+        self.assertFalse(cache.is_fetching("entry"))
+
+        marker = cache.mark_fetching("entry")
+        other = cache.mark_fetching("entry")
+        self.assertTrue(cache.is_fetching("entry"))
+        marker.close()
+        self.assertTrue(cache.is_fetching("entry"))
+        cache.evict()
+        self.assertTrue(cache.is_fetching("entry"))
+        other.close()
+        self.assertFalse(cache.is_fetching("entry"))
+
+        self.assertEqual(cache.names(), [])
+        cache.evict()
+        self.assertEqual(os.listdir(self.dir), [])
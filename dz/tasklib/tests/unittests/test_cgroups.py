@@ -0,0 +1,81 @@
+import os
+from os import path
+
+from dz.tasklib import (taskconfig,
+                        cgroups)
+from dz.tasklib.tests.dztestcase import DZTestCase
+
+
+class CgroupsTestCase(DZTestCase):
+    def setUp(self):
+        self.cgroup_root = self.makeDir()
+        self.patch(cgroups, "CGROUP_ROOT", self.cgroup_root)
+
+    def _write(self, relpath, content):
+        filename = path.join(self.cgroup_root, relpath)
+        if not path.isdir(path.dirname(filename)):
+            os.makedirs(path.dirname(filename))
+        open(filename, "w").write(content)
+
+    def test_wrap_privileged(self):
+        """Test commands are only put in cgroups if enabled."""
+        cmd = ["run_in_container", "app", "/tmp/ctr", "whoami"]
+        self.patch(taskconfig, "CGROUPS_ENABLED", False)
+        self.assertEqual(cgroups.wrap_privileged("app", "build", cmd), cmd)
+
+        self.patch(taskconfig, "CGROUPS_ENABLED", True)
+        self.patch(taskconfig, "CGROUP_CPU_SHARES", 512)
+        self.patch(taskconfig, "CGROUP_MEMORY_LIMIT", None)
+        self.patch(taskconfig, "CGROUP_IO_WEIGHT", 100)
+        self.assertEqual(cgroups.wrap_privileged("app", "build", cmd),
+                         ["run_in_cgroup", "app", "build", "512", "0",
+                          "100"] + cmd)
+
+    def test_remove_privileged(self):
+        """Test cgroups are only removed if enabled."""
+        self.patch(taskconfig, "CGROUPS_ENABLED", False)
+        self.assertEqual(cgroups.remove_privileged("app", "bundle_app_1"),
+                         None)
+
+        self.patch(taskconfig, "CGROUPS_ENABLED", True)
+        self.assertEqual(cgroups.remove_privileged("app", "bundle_app_1"),
+                         ["remove_cgroup", "app", "bundle_app_1"])
+
+    def test_usage_v1(self):
+        """Test reading usage from per-controller hierarchies."""
+        self._write("cpu/dz/app/bundle_app_1/cpu.shares", "1024\n")
+        self._write("cpuacct/dz/app/cpuacct.usage", "2500000000\n")
+        self._write("memory/dz/app/memory.usage_in_bytes", "1000\n")
+        self._write("memory/dz/app/memory.max_usage_in_bytes", "2000\n")
+        self._write("blkio/dz/app/blkio.throttle.io_service_bytes_recursive",
+                    "8:0 Read 100\n8:0 Write 20\n8:16 Read 1\n"
+                    "8:16 Write 2\nTotal 123\n")
+
+        self.assertEqual(cgroups.get_app_groups(), {"app": ["bundle_app_1"]})
+        self.assertEqual(cgroups.usage("app"),
+                         dict(cpu_time=2.5,
+                              memory_bytes=1000,
+                              max_memory_bytes=2000,
+                              read_bytes=101,
+                              write_bytes=22))
+        self.assertEqual(cgroups.usage("app", "bundle_app_1")["cpu_time"],
+                         None)
+        self.assertEqual(cgroups.usage("otherapp"), None)
+
+    def test_usage_v2(self):
+        """Test reading usage from the unified hierarchy."""
+        self._write("cgroup.controllers", "cpu io memory\n")
+        self._write("dz/app/build/cpu.stat",
+                    "usage_usec 1500000\nuser_usec 1000000\n")
+        self._write("dz/app/build/memory.current", "1000\n")
+        self._write("dz/app/build/io.stat",
+                    "8:0 rbytes=100 wbytes=20 rios=1 wios=1\n"
+                    "8:16 rbytes=1 wbytes=2 rios=1 wios=1\n")
+
+        self.assertEqual(cgroups.get_app_groups(), {"app": ["build"]})
+        self.assertEqual(cgroups.usage("app", "build"),
+                         dict(cpu_time=1.5,
+                              memory_bytes=1000,
+                              max_memory_bytes=None,
+                              read_bytes=101,
+                              write_bytes=22))
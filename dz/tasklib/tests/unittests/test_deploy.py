@@ -188,6 +188,32 @@ class DeployTestCase(AbstractDeployTestCase):
         self.assertTrue("<module 'polls' from " in try_installed_apps)
         self.assertTrue("error" not in try_installed_apps.lower())
 
+    def test_prefetch_bundle(self):
+        """
+        Test installing a prefetched bundle uses it rather than getting it
+        again.
+        """
+        bundle_dir = os.path.join(self.customer_directory,
+                                  self.app_id,
+                                  self.bundle_name)
+
+        if os.path.isdir(bundle_dir):
+            self.chown_to_me(bundle_dir)
+            shutil.rmtree(bundle_dir)
+
+        deploy.prefetch_app_bundle(self.app_id, self.bundle_name,
+                                   bundle_storage_engine=bundle_storage_local)
+        self.assertTrue(os.path.isfile(os.path.join(
+                    bundle_dir, "noderabbit_requirements.txt")))
+
+        def get_and_extract_bundle(*args):
+            self.fail("Prefetched bundle was fetched again.")
+
+        self.patch(utils, "get_and_extract_bundle", get_and_extract_bundle)
+        self.install_my_bundle()
+        self.assertTrue(os.path.isfile(os.path.join(bundle_dir,
+                                                    "thisbundle.py")))
+
     def test_deploy_to_wrong_server_fails(self):
         """
         Ensure that all hell breaks loose if a deploy gets routed to the
@@ -267,6 +293,25 @@ class DeployTestCase(AbstractDeployTestCase):
         with self.assertRaises(IOError):
             urllib.urlopen(app_url).read()
 
+    def test_stop_serving_bundle_removes_cgroup(self):
+        """
+        Test a bundle's cgroup is removed when it stops being served, if
+        cgroups are enabled.
+        """
+        privileged_cmds = []
+        self.patch(taskconfig, "SUPERVISOR_APP_CONF_DIR", self.makeDir())
+        self.patch(deploy, "_kick_supervisor", lambda: None)
+        self.patch(utils, "local_privileged", privileged_cmds.append)
+
+        self.patch(taskconfig, "CGROUPS_ENABLED", False)
+        deploy.stop_serving_bundle(self.app_id, self.bundle_name)
+        self.assertEqual(privileged_cmds, [])
+
+        self.patch(taskconfig, "CGROUPS_ENABLED", True)
+        deploy.stop_serving_bundle(self.app_id, self.bundle_name)
+        self.assertEqual(privileged_cmds,
+                         [["remove_cgroup", self.app_id, self.bundle_name]])
+
     def test_is_port_open(self):
         """
         Test our portscanner.
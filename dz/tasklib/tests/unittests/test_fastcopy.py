@@ -0,0 +1,85 @@
+import os
+import shutil
+from os import path
+
+from dz.tasklib import fastcopy
+from dz.tasklib.tests.dztestcase import DZTestCase
+
+
+class FastCopyTestCase(DZTestCase):
+    def setUp(self):
+        self.src = self.makeDir()
+        self.dst = path.join(self.makeDir(), "copy")
+
+        os.makedirs(path.join(self.src, "media", "img"))
+        os.mkdir(path.join(self.src, ".git"))
+        open(path.join(self.src, "settings.py"), "w").write("DEBUG = True\n")
+        open(path.join(self.src, "media", "img", "big.bin"), "wb").write(
+            "".join(chr(i % 251) for i in xrange(100000)))
+        os.symlink("settings.py", path.join(self.src, "link.py"))
+
+    def _ignore_git(self, srcdir, names):
+        return [n for n in names if n == ".git"]
+
+    def _check_copy(self):
+        self.assertFalse(path.exists(path.join(self.dst, ".git")))
+        for name in ("settings.py", "link.py",
+                     path.join("media", "img", "big.bin")):
+            self.assertEqual(open(path.join(self.src, name), "rb").read(),
+                             open(path.join(self.dst, name), "rb").read())
+        self.assertFalse(path.islink(path.join(self.dst, "link.py")))
+
+    def test_copytree(self):
+        """
+        Test copying a tree, with big files copied in chunks.
+        """
+        self.patch(fastcopy, "CHUNK_SIZE", 4096)
+        fastcopy.copytree(self.src, self.dst, ignore=self._ignore_git)
+        self._check_copy()
+
+    def test_copytree_hardlink(self):
+        """
+        Test copying a tree with hard links.
+        """
+        fastcopy.copytree(self.src, self.dst, ignore=self._ignore_git,
+                          hardlink=True)
+        self._check_copy()
+        self.assertEqual(os.stat(path.join(self.src, "settings.py")).st_ino,
+                         os.stat(path.join(self.dst, "settings.py")).st_ino)
+
+    def test_dangling_symlink(self):
+        """
+        Test dangling symlinks are reported after copying everything else.
+        """
+        os.symlink("missing.py", path.join(self.src, "broken.py"))
+
+        try:
+            fastcopy.copytree(self.src, self.dst, ignore=self._ignore_git)
+        except shutil.Error, e:
+            errors = e.args[0]
+        else:
+            self.fail("Expected shutil.Error")
+
+        self.assertEqual([(src, dst) for src, dst, why in errors],
+                         [(path.join(self.src, "broken.py"),
+                           path.join(self.dst, "broken.py"))])
+        self._check_copy()
+
+    def test_special_file(self):
+        """
+        Test named pipes are reported as errors rather than opened, which
+        would block, after copying everything else.
+        """
+        os.mkfifo(path.join(self.src, "pipe"))
+
+        try:
+            fastcopy.copytree(self.src, self.dst, ignore=self._ignore_git)
+        except shutil.Error, e:
+            errors = e.args[0]
+        else:
+            self.fail("Expected shutil.Error")
+
+        self.assertEqual([(src, dst) for src, dst, why in errors],
+                         [(path.join(self.src, "pipe"),
+                           path.join(self.dst, "pipe"))])
+        self._check_copy()
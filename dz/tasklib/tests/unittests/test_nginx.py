@@ -1,11 +1,15 @@
 from dz.tasklib import (nginx,
+                        bundle,
                         bundle_storage_local,
+                        deploy,
+                        static_assets,
                         taskconfig,
                         utils)
 from dz.tasklib.tests.dztestcase import DZTestCase
 from dz.tasklib.tests.stub_zoomdb import StubZoomDB
 
 import os
+import re
 
 
 class NginxTestCase(DZTestCase):
@@ -181,6 +185,59 @@ class NginxTestCase(DZTestCase):
                              taskconfig.DZ_ADMIN_MEDIA["bundle_file_path"]))
                         in flattened_contents)
 
+    def test_static_bundle(self):
+        """
+        Test static bundles' media are served precompressed, with expiry
+        headers, and far-future ones for fingerprinted files only if there
+        are any.
+        """
+        self.patch(taskconfig, "NR_CUSTOMER_DIR", self.makeDir())
+        self._mock_local_privileged()
+        self.patch(bundle, "has_static_bundle", lambda *args: True)
+        self.patch(deploy, "install_app_bundle_static",
+                   lambda *args, **kwargs: None)
+
+        nginx.update_local_proxy_config(
+            self.app_id,
+            self.bundle_name,
+            self.appservers,
+            self.virtual_hostnames,
+            self.site_media_map,
+            bundle_storage_engine=bundle_storage_local)
+
+        file_content = file(os.path.join(taskconfig.NGINX_SITES_ENABLED_DIR,
+                                         self.app_id)).read()
+        flattened_contents = [" ".join(x.strip().split())
+                              for x in file_content.split('}\n')]
+        static_dir = os.path.join(taskconfig.NR_CUSTOMER_DIR, self.app_id,
+                                  self.bundle_name + "-static")
+
+        self.assertTrue("location /static/ { alias %s/; expires %s; "
+                        "gzip_static on;" % (
+                os.path.join(static_dir, "user-repo", "path/to/static"),
+                taskconfig.NGINX_STATIC_EXPIRES)
+                        in flattened_contents)
+        self.assertFalse("expires max;" in file_content)
+
+        media_dir = os.path.join(static_dir, "user-repo", "path/to/static")
+        os.makedirs(media_dir)
+        open(os.path.join(media_dir, static_assets.FINGERPRINTS_FILENAME),
+             "w").write('{"site.css": "site.0123456789ab.css"}')
+        nginx.update_local_proxy_config(
+            self.app_id,
+            self.bundle_name,
+            self.appservers,
+            self.virtual_hostnames,
+            self.site_media_map,
+            bundle_storage_engine=bundle_storage_local)
+
+        file_content = file(os.path.join(taskconfig.NGINX_SITES_ENABLED_DIR,
+                                         self.app_id)).read()
+        self.assertEqual(file_content.count("expires max;"), 1)
+        self.assertTrue('location ~ "^%s(.+%s)$"' % (
+                re.escape("/static/"), static_assets.FINGERPRINTED_PATTERN)
+                        in file_content)
+
     def test_fail_when_no_appservers(self):
         """
         Test that >0 appservers must be provided.
@@ -0,0 +1,54 @@
+import os
+import urllib
+
+from dz.tasklib import (pip_cache,
+                        taskconfig)
+from dz.tasklib.tests.dztestcase import DZTestCase
+
+
+class PipCacheTestCase(DZTestCase):
+    def setUp(self):
+        self.shared_dir = self.makeDir()
+        self.build_parent_dir = self.makeDir()
+        self.patch(taskconfig, "PIP_DOWNLOAD_CACHE_DIR", self.shared_dir)
+
+    def _write(self, filename, content):
+        f = open(filename, "w")
+        f.write(content)
+        f.close()
+
+    def test_build_cache_seeding(self):
+        """
+        Test that a build's private cache is seeded with the complete
+        entries of the shared cache.
+        """
+        complete = urllib.quote("http://pypi.python.org/a/South-0.7.tar.gz",
+                                "")
+        partial = urllib.quote("http://pypi.python.org/a/PIL-1.1.tar.gz", "")
+        self._write(os.path.join(self.shared_dir, complete), "south")
+        self._write(os.path.join(self.shared_dir, complete + ".content-type"),
+                    "application/x-tar")
+        self._write(os.path.join(self.shared_dir, partial), "pil")
+
+        build_cache_dir = pip_cache.make_build_cache(self.build_parent_dir)
+        self.assertEqual(os.path.dirname(build_cache_dir),
+                         self.build_parent_dir)
+        self.assertEqual(sorted(os.listdir(build_cache_dir)),
+                         [complete, complete + ".content-type"])
+        self.assertEqual(open(os.path.join(build_cache_dir,
+                                           complete)).read(), "south")
+
+        # a download from an untrusted host isn't added to the shared cache
+        untrusted = urllib.quote("http://example.com/evil-1.0.tar.gz", "")
+        self._write(os.path.join(build_cache_dir, untrusted), "evil")
+        self._write(os.path.join(build_cache_dir,
+                                 untrusted + ".content-type"), "text/plain")
+
+        pip_cache.finish_build_cache(
+            build_cache_dir,
+            "Using download cache from %s/%s" % (build_cache_dir, complete))
+
+        self.assertFalse(os.path.exists(build_cache_dir))
+        self.assertEqual(sorted(os.listdir(self.shared_dir)),
+                         [".lock", complete, complete + ".content-type",
+                          partial])
@@ -0,0 +1,72 @@
+import json
+import os
+import pwd
+import socket
+import threading
+
+from dz.tasklib import (taskconfig,
+                        privileged_helper,
+                        utils,
+                        utils_essentials)
+from dz.tasklib.tests.dztestcase import DZTestCase
+
+
+class PrivilegedHelperTestCase(DZTestCase):
+    def setUp(self):
+        # the helper runs as whoever runs the tests here, rather than root.
+        socket_path = os.path.join(self.makeDir(), "helper.sock")
+        self.server = privileged_helper._HelperServer(socket_path,
+                                                      os.getuid())
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+        self.patch(taskconfig, "PRIVILEGED_HELPER_SOCKET", socket_path)
+
+    def test_local_privileged(self):
+        """Test privileged programs are run by the helper, if it's running."""
+        self.assertEqual(utils.local_privileged(["whoami"]),
+                         pwd.getpwuid(os.getuid()).pw_name + "\n")
+
+        test_string = "Hello, \xff\x00privileged world!"
+        self.assertEqual(
+            utils.local_privileged(["test_cat"], stdin_string=test_string),
+            test_string)
+
+        with self.assertRaises(ValueError):
+            utils.local_privileged(["cat"])
+
+    def test_refuses_paths(self):
+        """Test the helper refuses to run anything but privileged programs."""
+        for program in ("/bin/sh", "../x", "/bin/../bin/sh"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(taskconfig.PRIVILEGED_HELPER_SOCKET)
+            utils_essentials.send_message(
+                sock, dict(commands=[dict(args=[program, "-c", "id"])]))
+            f = sock.makefile("rb")
+            response = json.loads(f.readline())
+            f.close()
+            sock.close()
+            self.assertTrue("error" in response, response)
+            self.assertFalse("stdout" in response)
+
+            self.assertRaises(ValueError, utils.local_privileged, [program])
+
+    def test_local_privileged_batch(self):
+        """Test running several privileged programs in one request."""
+        username = pwd.getpwuid(os.getuid()).pw_name + "\n"
+        self.assertEqual(utils.local_privileged_batch([["whoami"],
+                                                       ["whoami"]]),
+                         [username, username])
+
+        with self.assertRaises(utils.ExternalServiceException):
+            utils.local_privileged_batch([
+                    ["whoami"],
+                    ["umount", "/nonexistent/dz/privileged_helper/test"],
+                    ["whoami"]])
+
+    def test_fallback_to_sudo(self):
+        """Test privileged programs are run with sudo without the helper."""
+        self.patch(taskconfig, "PRIVILEGED_HELPER_SOCKET",
+                   os.path.join(self.makeDir(), "not-running.sock"))
+        self.assertEqual(utils.local_privileged(["whoami"]), "root\n")
@@ -0,0 +1,101 @@
+import os
+from os import path
+
+from dz.tasklib import (taskconfig,
+                        reqs_layer,
+                        utils)
+from dz.tasklib.tests.dztestcase import DZTestCase
+from dz.tasklib.tests.stub_zoomdb import StubZoomDB
+
+
+class ReqsLayerTestCase(DZTestCase):
+    def setUp(self):
+        self.customer_dir = self.makeDir()
+        self.app_id = "p00000001"
+        self.app_dir = path.join(self.customer_dir, self.app_id)
+        os.mkdir(self.app_dir)
+        self.patch(taskconfig, "NR_CUSTOMER_DIR", self.customer_dir)
+        self.django_version = sorted(taskconfig.DJANGO_VERSIONS.keys())[0]
+
+    def _make_bundle(self, name):
+        bundle_dir = path.join(self.app_dir, name)
+        site_packages = utils.get_site_packages(bundle_dir)
+        os.makedirs(site_packages)
+        os.makedirs(path.join(bundle_dir, "user-src"))
+        # saving gives the bundle to the project's user.
+        self.addCleanup(utils.chown_to_me, bundle_dir)
+        open(path.join(site_packages, "foo.egg-link"), "w").write(
+            path.join(bundle_dir, "src", "foo") + "\n.")
+        open(path.join(site_packages, taskconfig.NR_PTH_FILENAME),
+             "w").write("user-src\n")
+        return bundle_dir
+
+    def test_key(self):
+        """
+        Test the layer key depends on the requirements, and local files
+        can't be reused.
+        """
+        key = reqs_layer.layer_key(self.django_version, ["Foo==1.0"])
+        self.assertEqual(key, reqs_layer.layer_key(self.django_version,
+                                                   ["Foo==1.0"]))
+        self.assertNotEqual(key, reqs_layer.layer_key(self.django_version,
+                                                      ["Foo==1.1"]))
+        self.assertEqual(reqs_layer.layer_key(self.django_version,
+                                              ["file:///cust/foo"]), None)
+
+    def test_save_and_restore(self):
+        """
+        Test saving a bundle's requirements and making a new bundle from
+        them.
+        """
+        old_bundle = self._make_bundle("bundle_old")
+        reqs_layer.save(self.app_id, "abc", old_bundle)
+
+        new_bundle = path.join(self.app_dir, "bundle_new")
+        self.assertFalse(reqs_layer.restore(self.app_id, "def", new_bundle))
+        self.assertFalse(path.exists(new_bundle))
+        self.assertTrue(reqs_layer.restore(self.app_id, "abc", new_bundle))
+
+        site_packages = utils.get_site_packages(new_bundle)
+        self.assertEqual(open(path.join(site_packages,
+                                        "foo.egg-link")).read(),
+                         path.join(new_bundle, "src", "foo") + "\n.")
+        self.assertFalse(path.exists(path.join(site_packages,
+                                               taskconfig.NR_PTH_FILENAME)))
+        self.assertFalse(path.exists(path.join(new_bundle, "user-src")))
+
+    def test_save_unreadable_files(self):
+        """
+        Test saving a bundle whose files only the project's user can read,
+        as pip leaves them, and that the requirements file isn't saved.
+        """
+        old_bundle = self._make_bundle("bundle_old")
+        reqs_file = path.join(old_bundle,
+                              taskconfig.NR_PIP_REQUIREMENTS_FILENAME)
+        secret_file = path.join(old_bundle, "secret.txt")
+        for filename in (reqs_file, secret_file):
+            open(filename, "w").write("Foo==1.0\n")
+            os.chmod(filename, 0600)
+        utils.local_privileged(["project_chown", self.app_id, old_bundle])
+
+        zoomdb = StubZoomDB()
+        reqs_layer.save(self.app_id, "abc", old_bundle, zoomdb=zoomdb)
+        self.assertEqual(zoomdb.logs, [])
+
+        new_bundle = path.join(self.app_dir, "bundle_new")
+        self.assertTrue(reqs_layer.restore(self.app_id, "abc", new_bundle))
+        self.assertEqual(open(path.join(new_bundle, "secret.txt")).read(),
+                         "Foo==1.0\n")
+        self.assertFalse(path.exists(
+                path.join(new_bundle,
+                          taskconfig.NR_PIP_REQUIREMENTS_FILENAME)))
+
+    def test_save_failure_logged(self):
+        """Test failing to save a layer is logged as a warning."""
+        zoomdb = StubZoomDB()
+        reqs_layer.save(self.app_id, "abc",
+                        path.join(self.app_dir, "nonexistent"), zoomdb=zoomdb)
+        self.assertEqual(len(zoomdb.logs), 1)
+        self.assertEqual(zoomdb.logs[0][1], zoomdb.LOG_WARN)
+        self.assertFalse(reqs_layer.restore(
+                self.app_id, "abc", path.join(self.app_dir, "bundle_new")))
@@ -0,0 +1,62 @@
+import json
+import os
+from os import path
+
+from dz.tasklib import (taskconfig,
+                        static_assets)
+from dz.tasklib.tests.dztestcase import DZTestCase
+
+
+class StaticAssetsTestCase(DZTestCase):
+    def setUp(self):
+        self.media_dir = self.makeDir()
+        os.mkdir(path.join(self.media_dir, "css"))
+        self.css = "body { color: red; }\n" * 100
+        open(path.join(self.media_dir, "css", "site.css"), "w").write(
+            self.css)
+        open(path.join(self.media_dir, "small.js"), "w").write("x = 1;\n")
+        open(path.join(self.media_dir, "logo.png"), "w").write("\x89PNG" * 500)
+
+    def test_precompress(self):
+        """
+        Test big enough text files get gzipped siblings, and others don't.
+        """
+        static_assets.precompress(self.media_dir)
+
+        import gzip
+        self.assertEqual(
+            gzip.open(path.join(self.media_dir, "css", "site.css.gz")).read(),
+            self.css)
+        self.assertFalse(path.exists(path.join(self.media_dir,
+                                               "small.js.gz")))
+        self.assertFalse(path.exists(path.join(self.media_dir,
+                                               "logo.png.gz")))
+
+    def test_fingerprint(self):
+        """
+        Test files get copies named after their content, which are listed
+        and precompressed too.
+        """
+        self.assertFalse(static_assets.has_fingerprints(self.media_dir))
+        self.patch(taskconfig, "STATIC_FINGERPRINTS_ENABLED", True)
+        static_assets.process(self.media_dir)
+        self.assertTrue(static_assets.has_fingerprints(self.media_dir))
+
+        fingerprints = json.load(open(path.join(
+                    self.media_dir, static_assets.FINGERPRINTS_FILENAME)))
+        self.assertEqual(sorted(fingerprints),
+                         ["css/site.css", "logo.png", "small.js"])
+
+        fingerprinted = fingerprints["css/site.css"]
+        self.assertTrue(fingerprinted.startswith("css/site."))
+        self.assertTrue(fingerprinted.endswith(".css"))
+        self.assertEqual(open(path.join(self.media_dir, fingerprinted)).read(),
+                         self.css)
+        self.assertTrue(path.isfile(path.join(self.media_dir,
+                                              fingerprinted + ".gz")))
+
+        # a changed file gets a different name.
+        open(path.join(self.media_dir, "css", "site.css"), "w").write("p {}")
+        self.assertNotEqual(
+            static_assets.fingerprint(self.media_dir)["css/site.css"],
+            fingerprinted)
@@ -192,3 +192,143 @@ class UtilsTestCase(DZTestCase):
 
         self.ue.subproc(["rm", some_crap_filename])
         # note that we can't read the file, it's owned by app
+
+    def test_pool(self):
+        """Test released envs are reused by the same user, if still sound."""
+        self.addCleanup(userenv.clear_pool)
+        self.patch(taskconfig, "USERENV_POOL_MAX_IDLE", 1)
+
+        ue = userenv.get_userenv(self.project_sysid)
+        self.assertTrue(ue.is_healthy())
+        userenv.release_userenv(ue)
+        self.assertFalse(ue.destroyed)
+        self.assertTrue(userenv.get_userenv(self.project_sysid) is ue)
+
+        # envs left changed aren't reused.
+        ue.write_string_to_file("hello world", "/test_pool.txt")
+        self.assertFalse(ue.is_healthy())
+        userenv.release_userenv(ue)
+        self.assertTrue(ue.destroyed)
+
+        # nor are those idle for too long, or beyond the limit.
+        first = userenv.get_userenv(self.project_sysid)
+        second = userenv.get_userenv(self.project_sysid)
+        userenv.release_userenv(first)
+        userenv.release_userenv(second)
+        self.assertTrue(first.destroyed)
+        self.assertFalse(second.destroyed)
+
+        self.patch(taskconfig, "USERENV_POOL_IDLE_TIMEOUT", -1)
+        third = userenv.get_userenv(self.project_sysid)
+        self.assertTrue(second.destroyed)
+        self.assertFalse(third is second)
+        userenv.release_userenv(third)
+
+    def test_reap_pool(self):
+        """Test idle envs past their timeout are destroyed on request."""
+        self.addCleanup(userenv.clear_pool)
+        ue = userenv.get_userenv(self.project_sysid)
+        userenv.release_userenv(ue)
+        userenv.reap_pool()
+        self.assertFalse(ue.destroyed)
+
+        self.patch(taskconfig, "USERENV_POOL_IDLE_TIMEOUT", -1)
+        userenv.reap_pool()
+        self.assertTrue(ue.destroyed)
+
+    def test_mount_points(self):
+        """Test reading mount points, including escaped ones."""
+        mountinfo = self.makeFile(
+            "22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n"
+            "40 22 8:1 /usr /tmp/ctr-app-x/usr ro - ext4 /dev/sda1 ro\n"
+            "41 22 8:1 /srv/a\\040b /tmp/a\\040b rw - ext4 /dev/sda1 rw\n")
+        self.patch(userenv, "MOUNTINFO_FILE", mountinfo)
+        self.assertEqual(userenv._mount_points(),
+                         set(["/", "/tmp/ctr-app-x/usr", "/tmp/a b"]))
+
+    def _make_app_dir(self):
+        app_dir = path.join(taskconfig.NR_CUSTOMER_DIR, self.project_sysid,
+                            "test_transfers")
+        if not path.isdir(app_dir):
+            os.mkdir(app_dir)
+        utils.local_privileged(["project_chown", self.project_sysid, app_dir])
+        return app_dir
+
+    def test_put_files(self):
+        """Test writing several files into the env at once."""
+        app_dir = self._make_app_dir()
+        one = path.join(app_dir, "one.txt")
+        two = path.join(app_dir, "sub", "two.sh")
+        self.ue.put_files([(one, "hello world"),
+                           (two, u"#!/bin/sh\necho \u2603\n", 0700)])
+
+        self.assertEqual(self.ue.open(one).read(), "hello world")
+        out, _1, _2 = self.ue.subproc([two])
+        self.assertEqual(out, u"\u2603\n".encode("utf8"))
+        out, _1, _2 = self.ue.subproc(["stat", "-c", "%U %a", one])
+        self.assertEqual(out.split(), [self.project_sysid, "600"])
+
+    def test_put_get_tree(self):
+        """Test copying directory trees into and out of the env."""
+        app_dir = self._make_app_dir()
+        src_dir = self.makeDir()
+        os.mkdir(path.join(src_dir, "sub"))
+        open(path.join(src_dir, "sub", "file.txt"), "w").write("content")
+
+        self.ue.put_tree(src_dir, path.join(app_dir, "tree"))
+        self.ue.subproc(["ln", "-s", "/etc/passwd",
+                         path.join(app_dir, "tree", "link")])
+
+        dest_dir = self.makeDir()
+        self.ue.get_tree(path.join(app_dir, "tree"), dest_dir)
+        self.assertEqual(
+            open(path.join(dest_dir, "sub", "file.txt")).read(), "content")
+        # links aren't copied out.
+        self.assertFalse(path.lexists(path.join(dest_dir, "link")))
+
+    def test_open_stream(self):
+        """Test reading a file from the env as it's streamed out."""
+        f = self.ue.open_stream("/bin/uncompress")
+        self.assertEqual(f.readline(), "#!/bin/bash\n")
+        self.assertTrue(len(f.read(10)) == 10)
+        f.read()
+        f.close()
+
+        f = self.ue.open_stream("/nonexistent")
+        self.assertEqual(f.read(), "")
+        with self.assertRaises(userenv.ErrorInsideEnvironment):
+            f.close()
+
+
+class NamespaceUserEnvTestCase(DZTestCase):
+    def setUp(self):
+        self.project_sysid = "app"
+        self.patch(taskconfig, "USERENV_BACKEND", "namespace")
+        self.ue = userenv.make_userenv(self.project_sysid)
+
+    def test_subproc(self):
+        """Test commands run as the env's user, chrooted, in private mounts."""
+        self.assertTrue(isinstance(self.ue, userenv.NamespaceUserEnv))
+        mounts = open("/proc/mounts").read()
+
+        stdout, stderr, p = self.ue.subproc(["whoami"])
+        self.assertEqual(stdout.strip(), self.project_sysid)
+        ls, _1, _2 = self.ue.subproc(["ls", "/"])
+        self.assertTrue(set(ls.splitlines()) <=
+                        set(['bin', 'dev', 'etc', 'lib', 'lib64', 'usr',
+                             taskconfig.NR_CUSTOMER_DIR.strip("/").split(
+                        "/")[0]]))
+        with self.assertRaises(userenv.ErrorInsideEnvironment):
+            self.ue.subproc(["touch", "/usr/test_namespace_userenv"])
+
+        self.assertEqual(open("/proc/mounts").read(), mounts)
+
+    def test_write_string_to_file(self):
+        """Test files in the customer's dir persist between commands."""
+        filename = path.join(self.ue.cust_dir, "test_namespace_userenv.txt")
+        self.ue.write_string_to_file("hello world", filename)
+        self.assertEqual(self.ue.open(filename).read(), "hello world")
+        self.ue.remove(filename)
+
+        with self.assertRaises(AssertionError):
+            self.ue.write_string_to_file("hello world", "/test.txt")
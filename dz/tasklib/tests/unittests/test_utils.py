@@ -1,12 +1,16 @@
+import os
 import random
 import re
 import shutil
 import tempfile
+import threading
 from os import path
 
 from dz.tasklib import taskconfig
+from dz.tasklib import timing
 from dz.tasklib import utils
 from dz.tasklib.tests.dztestcase import DZTestCase
+from dz.tasklib.tests.stub_zoomdb import StubZoomDB
 
 
 class UtilsTestCase(DZTestCase):
@@ -165,7 +169,7 @@ class UtilsTestCase(DZTestCase):
         Test trying to run a program that doesn't actually exist in the
         privileged-bin directory.
         """
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(ValueError):
             utils.local_privileged(["cat"])
 
     def test_local_privileged_stdin_string(self):
@@ -361,3 +365,202 @@ class UtilsTestCase(DZTestCase):
         self.assertFileOwnedBy(test_file, me)
 
         utils.local("rm %s" % test_file)
+
+    def test_relocate_tree(self):
+        """
+        Test fixing up absolute paths in a bundle that has been moved.
+        """
+        old_dir = "/cust/app/bundle_app_old"
+        new_dir = path.join(self.dir, "bundle_app_new")
+        site_packages = path.join(new_dir, "lib", "site-packages")
+        utils.local("mkdir -p %s %s/bin %s/src/pkg" % (
+                site_packages, new_dir, new_dir))
+
+        def write(filename, content):
+            f = open(filename, "w")
+            f.write(content)
+            f.close()
+
+        def read(filename):
+            return open(filename).read()
+
+        write(path.join(site_packages, "easy-install.pth"),
+              "%s/src/pkg\n./setuptools.egg\n" % old_dir)
+        write(path.join(site_packages, "pkg.egg-link"),
+              "%s/src/pkg\n." % old_dir)
+        write(path.join(new_dir, "bin", "pip"),
+              "#!%s/bin/python\n" % old_dir)
+        write(path.join(new_dir, "src", "pkg", "notes.txt"), old_dir)
+        utils.local("ln -s %s/src/pkg %s/static" % (old_dir, new_dir))
+        utils.local("ln -s /etc/hosts %s/hosts" % new_dir)
+
+        self.assertTrue(utils.relocate_tree(new_dir, old_dir, new_dir))
+
+        self.assertEqual(read(path.join(site_packages, "easy-install.pth")),
+                         "%s/src/pkg\n./setuptools.egg\n" % new_dir)
+        self.assertEqual(read(path.join(site_packages, "pkg.egg-link")),
+                         "%s/src/pkg\n." % new_dir)
+        self.assertEqual(read(path.join(new_dir, "bin", "pip")),
+                         "#!%s/bin/python\n" % new_dir)
+        # other files are left alone
+        self.assertEqual(read(path.join(new_dir, "src", "pkg", "notes.txt")),
+                         old_dir)
+        self.assertEqual(os.readlink(path.join(new_dir, "static")),
+                         "%s/src/pkg" % new_dir)
+        self.assertEqual(os.readlink(path.join(new_dir, "hosts")),
+                         "/etc/hosts")
+
+        # nothing left to fix
+        self.assertFalse(utils.relocate_tree(new_dir, old_dir, new_dir))
+
+    def test_run_steps_parallel(self):
+        """
+        Test that run_steps runs independent declared steps concurrently.
+        """
+        zoomdb = StubZoomDB()
+        first_started = threading.Event()
+        second_started = threading.Event()
+
+        @utils.step(writes=("A",))
+        def first_step(zoomdb, opts):
+            first_started.set()
+            second_started.wait(10)
+            opts["A"] = second_started.isSet()
+
+        @utils.step(writes=("B",))
+        def second_step(zoomdb, opts):
+            second_started.set()
+            first_started.wait(10)
+            zoomdb.log("in second step")
+            opts["B"] = first_started.isSet()
+
+        @utils.step(reads=("A", "B"), writes=("C",))
+        def third_step(zoomdb, opts):
+            opts["C"] = opts["A"] and opts["B"]
+
+        opts = {}
+        utils.run_steps(zoomdb, opts, (first_step, second_step, third_step),
+                        max_parallel=2)
+        self.assertEqual(opts, {"A": True, "B": True, "C": True})
+
+        self.assertTrue(("in second step", "i") in zoomdb.logs)
+        for name in ("First Step", "Second Step", "Third Step"):
+            self.assertTrue((name, zoomdb.LOG_STEP_BEGIN) in zoomdb.logs)
+            self.assertTrue((name, zoomdb.LOG_STEP_END) in zoomdb.logs)
+        # the dependent step only starts after both others have finished.
+        self.assertEqual(zoomdb.logs[-2:],
+                         [("Third Step", zoomdb.LOG_STEP_BEGIN),
+                          ("Third Step", zoomdb.LOG_STEP_END)])
+
+    def test_run_steps_parallel_barrier(self):
+        """
+        Test that undeclared steps run alone, after all earlier steps.
+        """
+        zoomdb = StubZoomDB()
+        order = []
+
+        @utils.step(writes=("A",))
+        def declared_step(zoomdb, opts):
+            order.append("declared")
+
+        def barrier_step(zoomdb, opts):
+            order.append("barrier")
+
+        @utils.step(writes=("B",))
+        def later_step(zoomdb, opts):
+            order.append("later")
+
+        utils.run_steps(zoomdb, {}, (declared_step, barrier_step, later_step),
+                        max_parallel=4)
+        self.assertEqual(order, ["declared", "barrier", "later"])
+
+    def test_run_steps_done_callback(self):
+        """
+        Test that step_done_callback is called after each successful step.
+        """
+        done = []
+
+        def first_step(zoomdb, opts):
+            pass
+
+        @utils.step(writes=("A",))
+        def second_step(zoomdb, opts):
+            pass
+
+        for max_parallel in (1, 2):
+            utils.run_steps(StubZoomDB(), {}, (first_step, second_step),
+                            max_parallel=max_parallel,
+                            step_done_callback=done.append)
+            self.assertEqual(done, [first_step, second_step])
+            done[:] = []
+
+    def test_run_steps_parallel_error(self):
+        """
+        Test that a failing step stops further steps and its error is
+        re-raised by run_steps.
+        """
+        zoomdb = StubZoomDB()
+        ran = []
+
+        @utils.step(writes=("A",))
+        def failing_step(zoomdb, opts):
+            raise utils.InfrastructureException("step failed")
+
+        @utils.step(reads=("A",))
+        def dependent_step(zoomdb, opts):
+            ran.append(True)
+
+        self.assertRaises(utils.InfrastructureException,
+                          utils.run_steps, zoomdb, {},
+                          (failing_step, dependent_step), max_parallel=2)
+        self.assertEqual(ran, [])
+        self.assertFalse(("Failing Step", zoomdb.LOG_STEP_END) in zoomdb.logs)
+
+    def test_subproc_timing(self):
+        """
+        Test that subprocesses run during a step are timed against it.
+        """
+        timer = timing.StepTimer("Test Step")
+        timer.start()
+        stdout, stderr, p = utils.subproc(["sh", "-c", "echo foo; exit 3"])
+        timer.stop()
+
+        self.assertEqual(stdout, "foo\n")
+        self.assertEqual(p.returncode, 3)
+        self.assertEqual(len(timer.processes), 1)
+
+        process = timer.processes[0]
+        self.assertEqual(process["kind"], timing.PROCESS)
+        self.assertEqual(process["name"], "sh -c echo foo; exit 3")
+        self.assertTrue(process["wall_time"] >= 0)
+        self.assertTrue(process["max_rss"] > 0)
+
+        self.assertEqual(timer.sample["kind"], timing.STEP)
+        self.assertTrue(timer.sample["cpu_time"] >= process["cpu_time"])
+        self.assertEqual(timer.sample["max_rss"], process["max_rss"])
+
+        # nothing is recorded with no timer running.
+        utils.subproc("true")
+        self.assertEqual(len(timer.processes), 1)
+
+    def test_run_steps_records_timing(self):
+        """
+        Test that run_steps stores timings for each step.
+        """
+        self.patch(taskconfig, "RECORD_JOB_TIMING", True)
+        zoomdb = StubZoomDB()
+
+        def quiet_step(zoomdb, opts):
+            pass
+
+        def busy_step(zoomdb, opts):
+            utils.subproc("true")
+            utils.subproc("true")
+
+        utils.run_steps(zoomdb, {}, (quiet_step, busy_step))
+
+        tree = zoomdb.get_timing_tree()
+        self.assertEqual([t["name"] for t in tree],
+                         ["Quiet Step", "Busy Step"])
+        self.assertEqual(len(tree[0]["children"]), 0)
+        self.assertEqual(len(tree[1]["children"]), 2)
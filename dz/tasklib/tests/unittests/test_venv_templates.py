@@ -0,0 +1,37 @@
+import os
+from os import path
+
+from dz.tasklib import (taskconfig,
+                        utils,
+                        venv_templates)
+from dz.tasklib.tests.dztestcase import DZTestCase
+
+
+class VenvTemplatesTestCase(DZTestCase):
+    def setUp(self):
+        self.templates_dir = self.makeDir()
+        self.dir = self.makeDir()
+        self.patch(taskconfig, "VENV_TEMPLATES_DIR", self.templates_dir)
+        self.django_version = sorted(taskconfig.DJANGO_VERSIONS.keys())[0]
+
+    def test_clone_template(self):
+        """
+        Test cloning bundle virtualenvs from a Django version's template.
+        """
+        for name in ("first", "second"):
+            venv_dir = path.join(self.dir, name)
+            venv_templates.clone_template(self.django_version, venv_dir)
+
+            self.assertTrue(path.isdir(path.join(
+                        utils.get_site_packages(venv_dir), "django")))
+            pip_script = open(path.join(venv_dir, "bin", "pip")).read()
+            self.assertTrue(pip_script.startswith("#!%s/bin/python" %
+                                                  venv_dir))
+
+        # the template was built once, and is unchanged by cloning.
+        template_dir = venv_templates.template_path(self.django_version)
+        self.assertEqual(os.listdir(self.templates_dir),
+                         [path.basename(template_dir)])
+        pip_script = open(path.join(template_dir, "bin", "pip")).read()
+        self.assertTrue(pip_script.startswith("#!%s/bin/python" %
+                                              template_dir))
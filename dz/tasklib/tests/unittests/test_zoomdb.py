@@ -87,6 +87,54 @@ class ZoomDatabaseTest(MockerTestCase):
                          bundle_from_db.creation_date)
                         < datetime.timedelta(seconds=1))
 
+    def test_find_bundle_by_build_key(self):
+        """Find a reusable bundle by its build cache key."""
+        build_key = "a" * 40
+
+        self.assertEqual(self.zoom_db.find_bundle_by_build_key(build_key),
+                         None)
+
+        self.zoom_db.add_bundle("bundle_old", "rev", build_key=build_key)
+        self.zoom_db.add_bundle("bundle_other", "rev2", build_key="b" * 40)
+        self.zoom_db.add_bundle("bundle_uncached", "rev")
+
+        found = self.zoom_db.find_bundle_by_build_key(build_key)
+        self.assertEqual(found.bundle_name, "bundle_old")
+
+        # too old
+        found.creation_date = (datetime.datetime.utcnow() -
+                               datetime.timedelta(days=2))
+        self.soup.session.commit()
+        self.assertEqual(self.zoom_db.find_bundle_by_build_key(
+                build_key, max_age=datetime.timedelta(days=1)), None)
+        self.assertEqual(self.zoom_db.find_bundle_by_build_key(
+                build_key).bundle_name, "bundle_old")
+
+        # deleted bundles can't be reused
+        found.deletion_date = datetime.datetime.utcnow()
+        self.soup.session.commit()
+        self.assertEqual(self.zoom_db.find_bundle_by_build_key(build_key),
+                         None)
+
+    def test_get_latest_bundle(self):
+        """Find the project's latest bundle."""
+        self.assertEqual(self.zoom_db.get_latest_bundle(), None)
+
+        old = self.zoom_db.add_bundle("bundle_old", "rev")
+        old.creation_date = (datetime.datetime.utcnow() -
+                             datetime.timedelta(days=1))
+        latest = self.zoom_db.add_bundle("bundle_new", "rev2")
+        self.assertEqual(self.zoom_db.get_latest_bundle().bundle_name,
+                         "bundle_new")
+        self.assertEqual(self.zoom_db.get_latest_bundle(
+                exclude_name="bundle_new").bundle_name, "bundle_old")
+
+        # deleted bundles are ignored
+        latest.deletion_date = datetime.datetime.utcnow()
+        self.soup.session.commit()
+        self.assertEqual(self.zoom_db.get_latest_bundle().bundle_name,
+                         "bundle_old")
+
     def test_get_bundle(self):
         """Get bundle by ID"""
         bundle_id = 100
@@ -362,3 +410,58 @@ class ZoomDatabaseTest(MockerTestCase):
         p2 = self.soup.dz2_project.filter(
             self.soup.dz2_project.id == pid).one()
         self.assertEqual(p2.database_type, "postgresql-gis")
+
+    def test_step_timing(self):
+        """
+        Test storing step timings and reading them back as a tree.
+        """
+        now = datetime.datetime.utcnow()
+
+        def sample(kind, name, offset):
+            return dict(kind=kind, name=name,
+                        started_at=now + datetime.timedelta(seconds=offset),
+                        wall_time=1.5, cpu_time=0.5, max_rss=1024,
+                        read_bytes=512, write_bytes=0)
+
+        self.zoom_db.add_step_timing(sample("step", "First Step", 0),
+                                     [sample("process", "pip install", 1),
+                                      sample("process", "tar czf", 2)])
+        self.zoom_db.add_step_timing(sample("step", "Second Step", 3))
+
+        self.assertEqual(self.soup.dz2_jobtiming.count(), 4)
+
+        tree = self.zoom_db.get_timing_tree()
+        self.assertEqual([t["name"] for t in tree],
+                         ["First Step", "Second Step"])
+        self.assertEqual([c["name"] for c in tree[0]["children"]],
+                         ["pip install", "tar czf"])
+        self.assertEqual(tree[1]["children"], [])
+        self.assertEqual(tree[0]["wall_time"], 1.5)
+
+        self.assertEqual(self.zoom_db.get_timing_tree(job_id=2), [])
+
+    def test_build_checkpoint(self):
+        """
+        Test saving, replacing and clearing a project's build checkpoint.
+        """
+        self.assertEqual(self.zoom_db.get_build_checkpoint("fp1"), None)
+
+        self.zoom_db.save_build_checkpoint("fp1", {"completed": ["a"]})
+        self.assertEqual(self.zoom_db.get_build_checkpoint("fp1"),
+                         (1, {"completed": ["a"]}))
+        self.assertEqual(self.zoom_db.get_build_checkpoint("fp2"), None)
+
+        self.zoom_db.save_build_checkpoint("fp2", {"completed": ["a", "b"]})
+        self.assertEqual(self.soup.dz2_jobcheckpoint.count(), 1)
+        self.assertEqual(self.zoom_db.get_build_checkpoint("fp1"), None)
+        self.assertEqual(self.zoom_db.get_build_checkpoint("fp2"),
+                         (1, {"completed": ["a", "b"]}))
+
+        cp = self.soup.dz2_jobcheckpoint.one()
+        cp.updated_at = datetime.datetime.utcnow() - datetime.timedelta(2)
+        self.soup.session.commit()
+        self.assertEqual(self.zoom_db.get_build_checkpoint(
+                "fp2", max_age=datetime.timedelta(1)), None)
+
+        self.zoom_db.clear_build_checkpoint()
+        self.assertEqual(self.soup.dz2_jobcheckpoint.count(), 0)
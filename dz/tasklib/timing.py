@@ -0,0 +1,193 @@
+"""
+Timing and resource accounting for job steps and the subprocesses they run.
+
+``utils.run_steps`` wraps each step in a :class:`StepTimer`; while a timer is
+running, every subprocess started through ``subproc`` (and so
+``local_privileged`` and ``UserEnv.subproc``) or ``UserEnv.call`` on the same
+thread is recorded against it. The samples are then stored with
+``ZoomDatabase.add_step_timing``.
+
+This module only depends on the standard library, as it is used by
+utils_essentials.
+"""
+
+import datetime
+import errno
+import os
+import resource
+import threading
+import time
+
+STEP = "step"
+PROCESS = "process"
+
+# not exposed by the resource module in python 2; this is the Linux value.
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", 1)
+
+# ru_inblock/ru_oublock count 512-byte blocks.
+BLOCK_SIZE = 512
+
+MAX_NAME_LENGTH = 255
+
+_local = threading.local()
+
+
+def _sample(kind, name, started_at, wall_time, cpu_time=None, max_rss=None,
+            read_bytes=None, write_bytes=None):
+    if len(name) > MAX_NAME_LENGTH:
+        name = name[:MAX_NAME_LENGTH - 3] + "..."
+    return dict(kind=kind,
+                name=name,
+                started_at=started_at,
+                wall_time=wall_time,
+                cpu_time=cpu_time,
+                max_rss=max_rss,
+                read_bytes=read_bytes,
+                write_bytes=write_bytes)
+
+
+def _thread_rusage():
+    try:
+        return resource.getrusage(RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        # not Linux; fall back to the whole process.
+        return resource.getrusage(resource.RUSAGE_SELF)
+
+
+def _sum_samples(samples, key):
+    values = [s[key] for s in samples if s[key] is not None]
+    return sum(values)
+
+
+class StepTimer(object):
+    """
+    Measures one step, collecting samples for the subprocesses run on this
+    thread between :meth:`start` and :meth:`stop`.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.processes = []
+        self.sample = None
+
+    def start(self):
+        self._outer = getattr(_local, "timer", None)
+        _local.timer = self
+        self._started_at = datetime.datetime.utcnow()
+        self._start_time = time.time()
+        self._start_usage = _thread_rusage()
+
+    def stop(self):
+        """
+        Stop timing. The step's CPU time and I/O include that of its
+        subprocesses; its peak RSS is the largest of theirs.
+
+        :returns: the step's sample dict (also available as ``sample``).
+        """
+        end_usage = _thread_rusage()
+        wall_time = time.time() - self._start_time
+        _local.timer = self._outer
+
+        cpu_time = ((end_usage.ru_utime - self._start_usage.ru_utime) +
+                    (end_usage.ru_stime - self._start_usage.ru_stime) +
+                    _sum_samples(self.processes, "cpu_time"))
+        read_bytes = ((end_usage.ru_inblock - self._start_usage.ru_inblock) *
+                      BLOCK_SIZE + _sum_samples(self.processes, "read_bytes"))
+        write_bytes = ((end_usage.ru_oublock - self._start_usage.ru_oublock) *
+                       BLOCK_SIZE + _sum_samples(self.processes,
+                                                 "write_bytes"))
+        max_rss = max([p["max_rss"] for p in self.processes] or [None])
+
+        self.sample = _sample(STEP, self.name, self._started_at, wall_time,
+                              cpu_time, max_rss, read_bytes, write_bytes)
+        return self.sample
+
+
+def current_timer():
+    """Get the StepTimer running on this thread, or None."""
+    return getattr(_local, "timer", None)
+
+
+def record_process(command, started_at, wall_time, rusage):
+    """
+    Record a finished subprocess against the current thread's StepTimer,
+    if there is one.
+
+    :param command: the command run, as a list or string.
+    :param rusage: resource usage of the process, as returned by os.wait4.
+    """
+    timer = current_timer()
+    if timer is None:
+        return
+
+    if not isinstance(command, basestring):
+        command = " ".join(command)
+
+    timer.processes.append(_sample(
+        PROCESS, command, started_at, wall_time,
+        cpu_time=rusage.ru_utime + rusage.ru_stime,
+        max_rss=rusage.ru_maxrss * 1024,  # reported in kilobytes
+        read_bytes=rusage.ru_inblock * BLOCK_SIZE,
+        write_bytes=rusage.ru_oublock * BLOCK_SIZE))
+
+
+def _wait4(p):
+    while True:
+        try:
+            _pid, status, rusage = os.wait4(p.pid, 0)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+
+def wait(p, command, started_at, start_time):
+    """
+    Like ``p.wait()``, but also records the process' resource usage.
+
+    :param started_at: datetime (UTC) the process was started at.
+    :param start_time: time.time() when the process was started.
+    """
+    rusage = _wait4(p)
+    # kept for code passing it on, such as the privileged helper.
+    p.rusage = rusage
+    record_process(command, started_at, time.time() - start_time, rusage)
+    return p.returncode
+
+
+def communicate(p, command, started_at, start_time):
+    """
+    Like ``p.communicate()`` for a process whose stdin is not a pipe, but
+    also records the process' resource usage.
+
+    :returns: (stdout, stderr)
+    """
+    stderr_chunks = []
+
+    if p.stderr:
+        def read_stderr():
+            stderr_chunks.append(p.stderr.read())
+
+        stderr_thread = threading.Thread(target=read_stderr)
+        stderr_thread.daemon = True
+        stderr_thread.start()
+
+    stdout = None
+    if p.stdout:
+        stdout = p.stdout.read()
+        p.stdout.close()
+
+    stderr = None
+    if p.stderr:
+        stderr_thread.join()
+        stderr = stderr_chunks[0]
+        p.stderr.close()
+
+    wait(p, command, started_at, start_time)
+    return stdout, stderr
@@ -1,16 +1,25 @@
+from dz.tasklib import cgroups
 from dz.tasklib import taskconfig
+from dz.tasklib import timing
 from dz.tasklib import utils_essentials as utils
 import atexit
+import datetime
+import multiprocessing.util
 import os
 import pwd
+import re
 import shutil
 import subprocess
+import tarfile
 import tempfile
+import threading
 import time
 from cStringIO import StringIO
 
 CONTAINER_BIND_DIRS = ('/usr', '/bin', '/lib', '/lib64', '/etc', '/dev')
 
+MOUNTINFO_FILE = "/proc/self/mountinfo"
+
 
 class AlreadyDestroyed(Exception):
     """Indicates that this UE has already been destroyed and cannot be
@@ -55,13 +64,63 @@ class UserEnvFile(object):
         self.stringio.close()
 
 
+class UserEnvStream(object):
+    """
+    A file-like object reading a file inside a UserEnv as it's streamed out,
+    for files too big to read in one go. Check for errors by closing it,
+    which raises ErrorInsideEnvironment if the file couldn't be read.
+    """
+
+    def __init__(self, userenv, p, transfer):
+        self.userenv = userenv
+        self.p = p
+        self.transfer = transfer
+
+    def read(self, *args):
+        return self.p.stdout.read(*args)
+
+    def readline(self, *args):
+        return self.p.stdout.readline(*args)
+
+    def __iter__(self):
+        return iter(self.p.stdout.readline, "")
+
+    def close(self):
+        if self.p:
+            self.p.stdout.close()
+            self.userenv._finish_transfer(self.p, self.transfer)
+            self.p = None
+
+
+def _mount_points():
+    """Get the set of this process's mount points, from MOUNTINFO_FILE."""
+    mount_points = set()
+    f = open(MOUNTINFO_FILE)
+    try:
+        for line in f:
+            # the mount point is the fifth field, with spaces and the like
+            # escaped in octal.
+            mount_point = line.split()[4]
+            mount_points.add(re.sub(r"\\([0-7]{3})",
+                                    lambda m: chr(int(m.group(1), 8)),
+                                    mount_point))
+    finally:
+        f.close()
+    return mount_points
+
+
 class UserEnv(object):
     """
     Represents an instance of a runtime environment for a specific user.
     """
 
-    def __init__(self, username):
+    def __init__(self, username, cgroup=cgroups.BUILD_GROUP):
+        """
+        :param cgroup: the group of the user's cgroup to run commands in,
+            if cgroups are enabled (see the cgroups module).
+        """
         self.username = username
+        self.cgroup = cgroup
         self.cust_dir = os.path.join(taskconfig.NR_CUSTOMER_DIR, username)
         self.container_dir = None
         self.destroyed = False
@@ -109,21 +168,42 @@ class UserEnv(object):
         os.chmod(self.container_dir, 0755)
 
         # chown to username
-        utils.local_privileged(["project_chown", self.username,
-                                self.container_dir])
+        cmds = [["project_chown", self.username, self.container_dir]]
 
         # bind standard directories
         for dirname in CONTAINER_BIND_DIRS:
-            utils.local_privileged(["mount_bind_readonly", dirname,
-                                    os.path.join(self.container_dir,
-                                                 dirname.lstrip("/"))])
+            cmds.append(["mount_bind_readonly", dirname,
+                         os.path.join(self.container_dir,
+                                      dirname.lstrip("/"))])
 
         # bind this customer's dir in READ-WRITE mode; ensuring it exists
         if not os.path.isdir(self.cust_dir):
             os.makedirs(self.cust_dir)
-        utils.local_privileged(["mount_bind_readwrite", self.cust_dir,
-                                os.path.join(self.container_dir,
-                                             self.cust_dir.lstrip("/"))])
+        cmds.append(["mount_bind_readwrite", self.cust_dir,
+                     os.path.join(self.container_dir,
+                                  self.cust_dir.lstrip("/"))])
+
+        utils.local_privileged_batch(cmds)
+
+    def is_healthy(self):
+        """
+        Check this UserEnv is still as :meth:`initialize` left it: its
+        directories are mounted and nothing else has been put in its root.
+        """
+        if self.destroyed or not os.path.isdir(self.cust_dir):
+            return False
+
+        # not os.path.ismount, which misses bind mounts of directories on
+        # the same filesystem as the container.
+        mounted = _mount_points()
+        container_dir = os.path.realpath(self.container_dir)
+        for d in CONTAINER_BIND_DIRS + (self.cust_dir,):
+            if os.path.join(container_dir, d.lstrip("/")) not in mounted:
+                return False
+
+        expected = set(d.lstrip("/").split("/")[0]
+                       for d in CONTAINER_BIND_DIRS + (self.cust_dir,))
+        return set(os.listdir(self.container_dir)) == expected
 
     def destroy(self):
         if self.destroyed:
@@ -131,20 +211,35 @@ class UserEnv(object):
 
         self.destroyed = True
 
-        for dirname in CONTAINER_BIND_DIRS:
-            utils.local_privileged(["umount",
-                                    os.path.join(self.container_dir,
-                                                 dirname.lstrip("/"))])
+        cmds = [["umount", os.path.join(self.container_dir,
+                                        dirname.lstrip("/"))]
+                for dirname in CONTAINER_BIND_DIRS]
         # and unbind cust dir
-        utils.local_privileged(["umount",
-                                os.path.join(self.container_dir,
-                                             self.cust_dir.lstrip("/"))])
+        cmds.append(["umount", os.path.join(self.container_dir,
+                                            self.cust_dir.lstrip("/"))])
         # chown to me
-        utils.local_privileged(["project_chown",
-                                pwd.getpwuid(os.geteuid()).pw_name,
-                                self.container_dir])
+        cmds.append(["project_chown", pwd.getpwuid(os.geteuid()).pw_name,
+                     self.container_dir])
+
+        utils.local_privileged_batch(cmds)
         shutil.rmtree(self.container_dir)
 
+    def container_cmd(self, command_list):
+        """
+        Get the privileged command running ``command_list`` chrooted to this
+        env.
+        """
+        return ["run_in_container", self.username,
+                self.container_dir] + command_list
+
+    def privileged_cmd(self, command_list):
+        """
+        Get the privileged command running ``command_list`` in this env, and
+        in its cgroup.
+        """
+        return cgroups.wrap_privileged(self.username, self.cgroup,
+                                       self.container_cmd(command_list))
+
     def subproc(self, command_list, nonzero_exit_ok=False, stdin_string=None):
         """
         Run a subprocess under this userenv, and return the output.
@@ -154,11 +249,10 @@ class UserEnv(object):
         assert type(command_list) == list, ("UserEnv.subproc's command_list "
                                             "argument must be a list.")
 
-        (stdout, stderr, p) = utils.local_privileged([
-            "run_in_container", self.username, self.container_dir,
-            ] + command_list,
-                                                     return_details=True,
-                                                     stdin_string=stdin_string)
+        (stdout, stderr, p) = utils.local_privileged(
+            self.privileged_cmd(command_list),
+            return_details=True,
+            stdin_string=stdin_string)
 
         if p.returncode != 0 and not(nonzero_exit_ok):
             raise ErrorInsideEnvironment(("Command %r returned non-zero exit "
@@ -174,15 +268,16 @@ class UserEnv(object):
         Run a subprocess under this userenv, using this existing process'
         STDOUT and STDERR (and null STDIN).
         """
-        fullcmd = utils.privileged_program_cmd([
-            "run_in_container", self.username, self.container_dir,
-            ] + command_list)
+        fullcmd = utils.privileged_program_cmd(
+            self.privileged_cmd(command_list))
 
+        started_at = datetime.datetime.utcnow()
+        start_time = time.time()
         p = subprocess.Popen(fullcmd)
 
         # add p to self.subprocess_popens so it gets cleaned up if we exit
         self.subprocess_popens.add(p)
-        result = p.wait()
+        result = timing.wait(p, command_list, started_at, start_time)
         self.subprocess_popens.remove(p)
 
         return result
@@ -191,14 +286,130 @@ class UserEnv(object):
         """
         Like the above, but does not wait for the process to exit.
         """
-        fullcmd = utils.privileged_program_cmd([
-            "run_in_container", self.username, self.container_dir,
-            ] + command_list)
+        fullcmd = utils.privileged_program_cmd(
+            self.privileged_cmd(command_list))
 
         # print "Popening: %r" % fullcmd
 
         return subprocess.Popen(fullcmd)
 
+    def _start_transfer(self, command_list, **popen_args):
+        """
+        Start a command in this env which files are streamed into or out
+        of, through its stdin or stdout.
+
+        :returns: (Popen object, transfer details for _finish_transfer)
+        """
+        stderr_file = tempfile.TemporaryFile(prefix="ctr-transfer-")
+        started_at = datetime.datetime.utcnow()
+        start_time = time.time()
+        p = subprocess.Popen(
+            utils.privileged_program_cmd(self.privileged_cmd(command_list)),
+            stderr=stderr_file, **popen_args)
+        self.subprocess_popens.add(p)
+        return p, (command_list, stderr_file, started_at, start_time)
+
+    def _finish_transfer(self, p, transfer):
+        command_list, stderr_file, started_at, start_time = transfer
+        timing.wait(p, command_list, started_at, start_time)
+        self.subprocess_popens.remove(p)
+
+        stderr_file.seek(0)
+        stderr = stderr_file.read()
+        stderr_file.close()
+        if p.returncode != 0:
+            raise ErrorInsideEnvironment(
+                "Command %r returned non-zero exit code %r.\nSTDERR:\n%s" % (
+                    command_list, p.returncode, stderr))
+
+    def _put_archive(self, add_to_archive):
+        """
+        Stream a tar archive into this env, extracted at its root by the
+        env's user. ``add_to_archive`` is called with the tarfile to add the
+        archive's contents.
+        """
+        p, transfer = self._start_transfer(
+            ["tar", "-x", "-p", "--no-same-owner", "-C", "/", "-f", "-"],
+            stdin=subprocess.PIPE)
+        try:
+            tar = tarfile.open(fileobj=p.stdin, mode="w|")
+            add_to_archive(tar)
+            tar.close()
+        finally:
+            p.stdin.close()
+            self._finish_transfer(p, transfer)
+
+    def put_files(self, files):
+        """
+        Write several files inside this env in one operation. Unlike
+        :meth:`write_string_to_file`, the files are written by the env's
+        user, so their directories must be writable by it.
+
+        :param files: a list of (filename, content) or (filename, content,
+            mode) tuples, where filenames are absolute paths inside the env.
+            Files are made with mode 0600 unless given one.
+        """
+        def add_files(tar):
+            now = time.time()
+            for entry in files:
+                filename, content = entry[:2]
+                if isinstance(content, unicode):
+                    content = content.encode("utf8")
+                info = tarfile.TarInfo(filename.lstrip("/"))
+                info.size = len(content)
+                info.mtime = now
+                info.mode = 0600
+                if len(entry) > 2:
+                    info.mode = entry[2]
+                tar.addfile(info, StringIO(content))
+
+        self._put_archive(add_files)
+
+    def put_tree(self, src_dir, dest_dir):
+        """
+        Copy the directory tree ``src_dir`` (outside the env) to
+        ``dest_dir`` inside it, in one operation; as with :meth:`put_files`,
+        the copy is made by the env's user.
+        """
+        self._put_archive(lambda tar: tar.add(src_dir,
+                                              arcname=dest_dir.lstrip("/")))
+
+    def get_tree(self, src_dir, dest_dir):
+        """
+        Copy the directory tree ``src_dir`` inside the env to ``dest_dir``
+        outside it, in one operation. The env's user decides what the tree
+        holds, so only its regular files and directories are copied, and
+        only to within ``dest_dir``.
+        """
+        p, transfer = self._start_transfer(
+            ["tar", "-c", "-C", src_dir, "-f", "-", "."],
+            stdout=subprocess.PIPE)
+        try:
+            tar = tarfile.open(fileobj=p.stdout, mode="r|")
+            for member in tar:
+                name = os.path.normpath(member.name)
+                if (os.path.isabs(name) or name.split(os.sep)[0] == ".." or
+                    not (member.isfile() or member.isdir())):
+                    continue
+                member.name = name
+                member.mode &= 0777
+                tar.extract(member, dest_dir)
+            tar.close()
+        finally:
+            p.stdout.close()
+            self._finish_transfer(p, transfer)
+
+    def open_stream(self, filename):
+        """
+        Open a file inside this env for reading as it's streamed out, rather
+        than all at once as :meth:`open` does.
+
+        :returns: a :class:`UserEnvStream`.
+        """
+        p, transfer = self._start_transfer(["cat", filename],
+                                           stdout=subprocess.PIPE)
+        return UserEnvStream(self, p, transfer)
+
     def open(self, filename, mode="r"):
         """
         Work-alike function for the builtin python open(), but running
@@ -213,10 +424,9 @@ class UserEnv(object):
 
         elif mode == "r":
             # open the file as the env's user
-            (stdout, stderr, p) = utils.local_privileged([
-                "run_in_container", self.username, self.container_dir,
-                "cat", filename],
-                                                         return_details=True)
+            (stdout, stderr, p) = utils.local_privileged(
+                self.privileged_cmd(["cat", filename]),
+                return_details=True)
             if p.returncode != 0:
                 raise OSError(stderr)
 
@@ -247,8 +457,7 @@ class UserEnv(object):
         Remove a file inside of the userenv.
         """
         (stdout, stderr, p) = utils.local_privileged(
-            ["run_in_container", self.username, self.container_dir,
-             "rm", filename], return_details=True)
+            self.privileged_cmd(["rm", filename]), return_details=True)
 
         if p.returncode != 0:
             raise OSError(stdout + "\n" + stderr)
@@ -312,3 +521,180 @@ class UserEnv(object):
 
         pip.util.get_file_content = pip.util._ORIGINAL_get_file_content
         del pip.util._ORIGINAL_get_file_content
+
+
+class NamespaceUserEnv(UserEnv):
+    """
+    A UserEnv which sets nothing up in advance: each command run in it gets
+    a root of its own, in a private mount namespace, which disappears with
+    it (see privileged-bin/run_in_namespace). There are no mounts to make or
+    clean up in the host's namespace, but only the customer's directory
+    persists between commands.
+    """
+
+    def initialize(self):
+        # the customer's directory is at the same path inside and out.
+        self.container_dir = ""
+        if not os.path.isdir(self.cust_dir):
+            os.makedirs(self.cust_dir)
+
+    def is_healthy(self):
+        return not self.destroyed and os.path.isdir(self.cust_dir)
+
+    def destroy(self):
+        if self.destroyed:
+            raise AlreadyDestroyed()
+        self.destroyed = True
+
+    def container_cmd(self, command_list):
+        return ["run_in_namespace", self.username,
+                self.cust_dir] + command_list
+
+    def write_string_to_file(self, content, filename):
+        assert filename.startswith(self.cust_dir + "/"), (
+            "Files outside %s aren't kept between commands in a "
+            "NamespaceUserEnv." % self.cust_dir)
+        UserEnv.write_string_to_file(self, content, filename)
+
+
+USERENV_BACKENDS = {
+    "mounts": UserEnv,
+    "namespace": NamespaceUserEnv,
+    }
+
+
+def make_userenv(username, cgroup=cgroups.BUILD_GROUP):
+    """
+    Make a new UserEnv for ``username`` with the backend configured in
+    taskconfig.USERENV_BACKEND.
+    """
+    return USERENV_BACKENDS[taskconfig.USERENV_BACKEND](username,
+                                                        cgroup=cgroup)
+
+
+# Idle UserEnvs kept for reuse by get_userenv, as lists of (idle since,
+# UserEnv) by username, least recently used first; and the process they
+# belong to, as a forked child can't use (or destroy) its parent's. Each
+# process destroys its own when it exits (see _take_expired_or_excess).
+_pool = {}
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _take_expired_or_excess():
+    """
+    Remove idle UserEnvs past taskconfig.USERENV_POOL_IDLE_TIMEOUT, and the
+    least recently used beyond USERENV_POOL_MAX_IDLE, from the pool.
+
+    :returns: a list of the UserEnvs removed, to be destroyed.
+    """
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        # the parent's UserEnvs are its own to destroy, so ours mustn't
+        # (see UserEnv.__del__).
+        for idle in _pool.values():
+            for idle_since, ue in idle:
+                ue.destroyed = True
+        _pool = {}
+        _pool_pid = os.getpid()
+        # not atexit, which multiprocessing's child processes, such as
+        # celeryd's pool workers, don't run; its finalizers run in them
+        # and, through atexit, in the main process.
+        multiprocessing.util.Finalize(None, clear_pool, exitpriority=10)
+
+    removed = []
+    expired_before = time.time() - taskconfig.USERENV_POOL_IDLE_TIMEOUT
+    for username, idle in _pool.items():
+        removed += [ue for idle_since, ue in idle
+                    if idle_since < expired_before]
+        idle[:] = [(idle_since, ue) for idle_since, ue in idle
+                   if idle_since >= expired_before]
+
+    entries = sorted((idle_since, username)
+                     for username, idle in _pool.items()
+                     for idle_since, ue in idle)
+    for idle_since, username in entries[:max(
+            0, len(entries) - taskconfig.USERENV_POOL_MAX_IDLE)]:
+        removed.append(_pool[username].pop(0)[1])
+
+    for username in [u for u, idle in _pool.items() if not idle]:
+        del _pool[username]
+    return removed
+
+
+def _destroy_all(ues):
+    for ue in ues:
+        if not ue.destroyed:
+            ue.destroy()
+
+
+def get_userenv(username):
+    """
+    Get a UserEnv for ``username``: an idle one from the pool if there is a
+    healthy one, otherwise a new one. Pass it to :func:`release_userenv`
+    when done with it, rather than destroying it.
+    """
+    while True:
+        _pool_lock.acquire()
+        try:
+            expired = _take_expired_or_excess()
+            idle = _pool.get(username)
+            ue = idle and idle.pop()[1]
+        finally:
+            _pool_lock.release()
+        _destroy_all(expired)
+
+        if not ue:
+            return make_userenv(username)
+        if ue.is_healthy():
+            return ue
+        _destroy_all([ue])
+
+
+def release_userenv(ue):
+    """
+    Return a UserEnv got from :func:`get_userenv` to the pool, for reuse by
+    the same user, or destroy it if pooling is disabled (with a
+    USERENV_POOL_MAX_IDLE of 0) or it's no longer usable.
+    """
+    if ue.destroyed:
+        return
+    if not (taskconfig.USERENV_POOL_MAX_IDLE and ue.is_healthy()):
+        ue.destroy()
+        return
+
+    _pool_lock.acquire()
+    try:
+        expired = _take_expired_or_excess()
+        _pool.setdefault(ue.username, []).append((time.time(), ue))
+        expired += _take_expired_or_excess()
+    finally:
+        _pool_lock.release()
+    _destroy_all(expired)
+
+
+def reap_pool():
+    """
+    Destroy the idle UserEnvs in the pool past their idle timeout, or beyond
+    the most to keep; e.g. when a task finishes, as the pool is otherwise
+    only checked when it's used.
+    """
+    _pool_lock.acquire()
+    try:
+        expired = _take_expired_or_excess()
+    finally:
+        _pool_lock.release()
+    _destroy_all(expired)
+
+
+def clear_pool():
+    """Destroy all the idle UserEnvs in the pool."""
+    _pool_lock.acquire()
+    try:
+        idle = _take_expired_or_excess()
+        for ues in _pool.values():
+            idle += [ue for idle_since, ue in ues]
+        _pool.clear()
+    finally:
+        _pool_lock.release()
+    _destroy_all(idle)
@@ -4,12 +4,21 @@ from jinja2 import PackageLoader, Environment
 from StringIO import StringIO  # important: cStringIO causes weird parse errors
 import os
 import pwd
+import shutil
 import socket
 import subprocess
 import sys
+import tempfile
+import threading
 import ConfigParser
+import Queue
 
+import bundle_cache
+import bundle_codecs
+import bundle_manifest
+import pip_cache
 import taskconfig
+import timing
 
 from pip.req import parse_requirements, InstallRequirement, RequirementSet
 from pip.exceptions import InstallationError
@@ -19,7 +28,8 @@ from pip.locations import build_prefix, src_prefix
 # to be used with no dependencies outside stdlib.
 from utils_essentials import (ExternalServiceException,
                               subproc,
-                              local_privileged)
+                              local_privileged,
+                              local_privileged_batch)
 
 tpl_env = Environment(loader=PackageLoader('dz.tasklib'))
 
@@ -88,15 +98,18 @@ def install_requirements(reqs, path, logsuffix=None, env=None):
     :param reqs: A list of pip requirements
     :param path: A path to a virtualenv
     :param env: A UserEnv object
+
+    If taskconfig.PIP_DOWNLOAD_CACHE_DIR is set, pip uses the node's shared
+    download cache (see the pip_cache module).
     """
     fname = os.path.join(path, taskconfig.NR_PIP_REQUIREMENTS_FILENAME)
+    reqs_content = "".join([r.strip() + "\n" for r in reqs])
     if env:
-        reqfile = env.open(fname, "w")
+        env.put_files([(fname, reqs_content)])
     else:
         reqfile = open(fname, "w")
-
-    reqfile.writelines([r.strip() + "\n" for r in reqs])
-    reqfile.close()
+        reqfile.write(reqs_content)
+        reqfile.close()
     pip = os.path.join(path, 'bin', 'pip')
 
     logfile = os.path.join(path, "dz-pip%s.log" % (logsuffix or ""))
@@ -110,11 +123,22 @@ def install_requirements(reqs, path, logsuffix=None, env=None):
 
     pipcmd = [pip, "install", "--log=%s" % logfile, "-r", fname]
 
-    # USERENV NEEDS TO INCLUDE /cust/appid dir
-    if env:
-        output, stderr, p = env.subproc(pipcmd)
-    else:
-        output, stderr, p = subproc(pipcmd)
+    build_cache_dir = None
+    if pip_cache.is_enabled():
+        # the cache must be inside the app dir, so the userenv can see it.
+        build_cache_dir = pip_cache.make_build_cache(os.path.dirname(path))
+        pipcmd.insert(2, "--download-cache=%s" % build_cache_dir)
+
+    output = None
+    try:
+        # USERENV NEEDS TO INCLUDE /cust/appid dir
+        if env:
+            output, stderr, p = env.subproc(pipcmd)
+        else:
+            output, stderr, p = subproc(pipcmd)
+    finally:
+        if build_cache_dir:
+            pip_cache.finish_build_cache(build_cache_dir, output)
 
     if p.returncode != 0:
         raise ExternalServiceException((
@@ -263,49 +287,288 @@ def add_to_pth(paths, vpath, relative=False):
     pthfile.writelines([p.rstrip("\n") + "\n" for p in paths])
 
 
+# files in a virtualenv that may contain absolute paths to it.
+RELOCATABLE_SUFFIXES = (".pth", ".egg-link")
+
+
+def relocate_tree(root, old_path, new_path):
+    """
+    Fix up a virtualenv (or bundle) that was built at ``old_path`` but now
+    lives at ``root``, by replacing ``old_path`` with ``new_path`` in .pth
+    and .egg-link files, in text files under bin/, and in the targets of
+    absolute symlinks.
+
+    :returns: whether anything needed fixing.
+    """
+    old_path = old_path.rstrip("/")
+    new_path = new_path.rstrip("/")
+    bindir = os.path.join(root, "bin")
+    changed = False
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            fullname = os.path.join(dirpath, name)
+
+            if os.path.islink(fullname):
+                target = os.readlink(fullname)
+                if target == old_path or target.startswith(old_path + "/"):
+                    os.remove(fullname)
+                    os.symlink(new_path + target[len(old_path):], fullname)
+                    changed = True
+                continue
+
+            if name in dirnames:
+                continue
+
+            if not (name.endswith(RELOCATABLE_SUFFIXES) or
+                    dirpath == bindir):
+                continue
+
+            f = open(fullname)
+            content = f.read()
+            f.close()
+
+            if old_path not in content or "\0" in content:
+                continue  # nothing to do, or binary
+
+            f = open(fullname, "w")
+            f.write(content.replace(old_path, new_path))
+            f.close()
+            changed = True
+
+    return changed
+
+
 def render_tpl_to_file(template, path, **kwargs):
     """
     Render a ``template`` to a file at ``path`` with context ``**kwargs``.
 
     :param template: Template name; relative path
     :param path: Absolute path to file
-    :param env: A UserEnv object to use if not calling open() directly
+    :param env: A UserEnv object to write the file with, as its user, if not
+        calling open() directly
+    :param mode: Optional permissions for the file
     """
     tpl = tpl_env.get_template(template)
 
-    if "env" in kwargs:
-        env = kwargs.pop("env")
-    else:
-        env = None
+    env = kwargs.pop("env", None)
+    mode = kwargs.pop("mode", None)
 
     content = tpl.render(**kwargs)
 
     if env:
-        f = env.open(path, 'w')
+        env.put_files([(path, content, mode or 0600)])
     else:
         f = open(path, 'w')
-
-    f.write(content)
-    f.close()
+        f.write(content)
+        f.close()
+        if mode:
+            os.chmod(path, mode)
 
     return content
 
 
-def run_steps(zoomdb, opts, steps):
-    cur_dir = os.getcwd()
+def step(reads=(), writes=()):
+    """
+    Decorator declaring which ``opts`` keys a step function reads and which
+    it writes (sets or deletes). ``run_steps`` uses these declarations to
+    work out which steps may run concurrently. Steps without a declaration
+    are barriers: they run alone, after everything before them.
+    """
+    def decorator(stepfn):
+        stepfn.reads = frozenset(reads)
+        stepfn.writes = frozenset(writes)
+        return stepfn
 
-    for i, stepfn in enumerate(steps):
-        nicename = " ".join(stepfn.__name__.split("_")).title()
+    return decorator
 
-        zoomdb.log(nicename, zoomdb.LOG_STEP_BEGIN)
 
+def step_nicename(stepfn):
+    """Get the title a step is logged under."""
+    return " ".join(stepfn.__name__.split("_")).title()
+
+
+def _is_declared_step(stepfn):
+    return hasattr(stepfn, "reads") and hasattr(stepfn, "writes")
+
+
+def _step_depends_on(later, earlier):
+    """Must step ``later`` wait until step ``earlier`` has finished?"""
+    if not (_is_declared_step(later) and _is_declared_step(earlier)):
+        return True
+
+    return bool(earlier.writes & (later.reads | later.writes) or
+                earlier.reads & later.writes)
+
+
+class _StepThreadZoomDB(object):
+    """
+    Stands in for the zoomdb given to steps running on worker threads.
+    Method calls are sent back to the thread running ``run_steps`` and
+    executed there, as sqlsoup sessions are thread-local.
+    """
+
+    def __init__(self, zoomdb, events):
+        self._zoomdb = zoomdb
+        self._events = events
+
+    def __getattr__(self, name):
+        attr = getattr(self._zoomdb, name)
+        if not callable(attr):
+            return attr
+
+        def call_on_main_thread(*args, **kwargs):
+            reply = Queue.Queue(1)
+            self._events.put(("call", (attr, args, kwargs, reply)))
+            ok, result = reply.get()
+            if not ok:
+                raise result[0], result[1], result[2]
+            return result
+
+        return call_on_main_thread
+
+
+def _record_step_timing(zoomdb, timer):
+    if not taskconfig.RECORD_JOB_TIMING:
+        return
+
+    try:
+        zoomdb.add_step_timing(timer.sample, timer.processes)
+    except Exception, e:
+        # timing is informational only; never fail a job over it.
+        print "Warning: couldn't record timing for step %s: %s" % (
+            timer.name, e)
+
+
+def _run_timed_step(zoomdb, opts, stepfn, cur_dir):
+    timer = timing.StepTimer(step_nicename(stepfn))
+    timer.start()
+    try:
+        stepfn(zoomdb, opts)
+    finally:
+        timer.stop()
+        os.chdir(cur_dir)
+        _record_step_timing(zoomdb, timer)
+
+
+def _run_steps_parallel(zoomdb, opts, steps, max_parallel,
+                        step_done_callback):
+    cur_dir = os.getcwd()
+    events = Queue.Queue()
+    step_zoomdb = _StepThreadZoomDB(zoomdb, events)
+
+    pending = list(enumerate(steps))
+    running = set()
+    finished = set()
+    failure = None
+
+    def run_in_thread(stepfn):
+        timer = timing.StepTimer(step_nicename(stepfn))
+        timer.start()
         try:
-            stepfn(zoomdb, opts)
-        finally:
-            os.chdir(cur_dir)
+            stepfn(step_zoomdb, opts)
+        except:
+            timer.stop()
+            events.put(("done", (stepfn, timer, sys.exc_info())))
+        else:
+            timer.stop()
+            events.put(("done", (stepfn, timer, None)))
+
+    def is_ready(index, stepfn):
+        return not any(s not in finished and _step_depends_on(stepfn, s)
+                       for s in steps[:index])
+
+    try:
+        while pending or running:
+            for index, stepfn in list(pending):
+                if failure or len(running) >= max_parallel:
+                    break
+                if not is_ready(index, stepfn):
+                    continue
+
+                pending.remove((index, stepfn))
+                zoomdb.log(step_nicename(stepfn), zoomdb.LOG_STEP_BEGIN)
+
+                if not _is_declared_step(stepfn):
+                    # a barrier runs alone, so it may as well run here.
+                    _run_timed_step(zoomdb, opts, stepfn, cur_dir)
+                    zoomdb.log(step_nicename(stepfn), zoomdb.LOG_STEP_END)
+                    finished.add(stepfn)
+                    if step_done_callback:
+                        step_done_callback(stepfn)
+                    continue
+
+                running.add(stepfn)
+                t = threading.Thread(target=run_in_thread, args=(stepfn,),
+                                     name="step-" + stepfn.__name__)
+                t.daemon = True
+                t.start()
+
+            if not running:
+                break
+
+            kind, payload = events.get()
+
+            if kind == "call":
+                method, args, kwargs, reply = payload
+                try:
+                    reply.put((True, method(*args, **kwargs)))
+                except:
+                    reply.put((False, sys.exc_info()))
+
+            else:
+                stepfn, timer, exc_info = payload
+                running.remove(stepfn)
+                _record_step_timing(zoomdb, timer)
+                if exc_info:
+                    # let the other running steps finish, then re-raise
+                    # the first error.
+                    failure = failure or exc_info
+                else:
+                    zoomdb.log(step_nicename(stepfn), zoomdb.LOG_STEP_END)
+                    finished.add(stepfn)
+                    if step_done_callback:
+                        step_done_callback(stepfn)
+    finally:
+        os.chdir(cur_dir)
+
+    if failure:
+        raise failure[0], failure[1], failure[2]
+
 
+def run_steps(zoomdb, opts, steps, max_parallel=1, step_done_callback=None):
+    """
+    Run each function in ``steps`` as ``stepfn(zoomdb, opts)``, logging step
+    begin and end events to ``zoomdb``.
+
+    :param max_parallel: If greater than 1, steps declared with :func:`step`
+        run on up to this many threads at once; each step starts as soon as
+        all earlier steps it shares ``opts`` keys with have finished. If a
+        step fails, no further steps are started and the first error is
+        re-raised once the running steps have finished.
+    :param step_done_callback: If given, called as
+        ``step_done_callback(stepfn)`` after each step finishes successfully,
+        from the thread running ``run_steps``.
+
+    The wall time and resource usage of each step, and of the subprocesses
+    it runs, are stored with ``zoomdb.add_step_timing``.
+    """
+    if max_parallel > 1:
+        return _run_steps_parallel(zoomdb, opts, steps, max_parallel,
+                                   step_done_callback)
+
+    cur_dir = os.getcwd()
+
+    for i, stepfn in enumerate(steps):
+        nicename = step_nicename(stepfn)
+
+        zoomdb.log(nicename, zoomdb.LOG_STEP_BEGIN)
+        _run_timed_step(zoomdb, opts, stepfn, cur_dir)
         zoomdb.log(nicename, zoomdb.LOG_STEP_END)
 
+        if step_done_callback:
+            step_done_callback(stepfn)
+
 
 def _is_running_on_ec2():
     """Make a guess at whether we're running on ec2."""
@@ -399,22 +662,54 @@ def parse_zoombuild_string(buildcfg_string):
 
 def get_and_extract_bundle(bundle_name, app_dir, bundle_storage_engine):
     """
-    Get a bundle from the provided bundle_storage_engine, and extract it
-    into app_dir (creating if neccessary).
+    Get a bundle from the node's bundle cache or else the provided
+    bundle_storage_engine, and extract it into app_dir (creating if
+    neccessary). The bundle is extracted into a temp dir and then moved into
+    place, replacing any left behind there, so it's never seen half done.
+
+    :raises InfrastructureException: if the archive can't be extracted.
     """
-    bundletgz = bundle_storage_engine.get(bundle_name + ".tgz")
     if not os.path.isdir(app_dir):
         os.makedirs(app_dir)
-    current_dir = os.getcwd()
-    os.chdir(app_dir)
 
+    bundle_dir = os.path.join(app_dir, bundle_name)
+    tmp_dir = tempfile.mkdtemp(prefix=".extract-%s-" % bundle_name,
+                               dir=app_dir)
     try:
-        p = subprocess.Popen(["tar", "xzf", bundletgz], close_fds=True)
-        os.waitpid(p.pid, 0)
-    finally:
-        os.chdir(current_dir)
+        name, bundle_file = bundle_cache.get_bundle_file(
+            bundle_name, bundle_storage_engine)
+        try:
+            if name == bundle_manifest.manifest_name(bundle_name):
+                bundle_manifest.download_bundle(
+                    bundle_name, tmp_dir, bundle_storage_engine,
+                    manifest_file=bundle_file,
+                    get_file=lambda name: bundle_cache.get_file(
+                        name, bundle_storage_engine))
+            else:
+                # into the bundle's own directory, whatever the archive
+                # calls it: a reused build's archive may be a copy of
+                # another bundle's (see bundle.restore_cached_bundle).
+                os.mkdir(os.path.join(tmp_dir, bundle_name))
+
+                # pass cwd rather than chdir-ing, as steps may run on
+                # several threads.
+                p = subprocess.Popen(
+                    bundle_codecs.tar_extract_command(bundle_file,
+                                                      strip_components=1),
+                    cwd=os.path.join(tmp_dir, bundle_name), close_fds=True)
+                if p.wait() != 0:
+                    raise InfrastructureException(
+                        "Couldn't extract bundle %s: tar exited with "
+                        "status %d." % (bundle_name, p.returncode))
+        finally:
+            os.remove(bundle_file)
+
+        if os.path.isdir(bundle_dir):
+            shutil.rmtree(bundle_dir)
+        os.rename(os.path.join(tmp_dir, bundle_name), bundle_dir)
 
-    os.remove(bundletgz)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
 def app_and_bundle_dirs(app_id, bundle_name=None):
@@ -452,6 +747,43 @@ def parse_site_media_map(site_media_map_text):
     return result
 
 
+def site_media_entries(bundle_dir, site_media_map):
+    """
+    Get the directories nginx serves a bundle's static media from: those in
+    its site_media_map, which are relative to the bundle's user-repo unless
+    they start with {SITE_PACKAGES} or {SRC_PACKAGES}, plus Django's admin
+    media.
+
+    :returns: a list of dicts with url_path and alias_dest (the directory
+        within ``bundle_dir``) keys.
+    """
+    file_path_vars = {
+        "{SITE_PACKAGES}": os.path.join(bundle_dir,
+                                        "lib/python2.6/site-packages"),
+        "{SRC_PACKAGES}": os.path.join(bundle_dir, "src"),
+        }
+    default_file_path_base = os.path.join(bundle_dir, "user-repo")
+
+    def _make_full_path(original_file_path):
+        for varname, pathbase in file_path_vars.items():
+            if original_file_path.startswith(varname):
+                rest = original_file_path[len(varname):]
+                rest = rest.lstrip("/")
+                return os.path.join(pathbase, rest)
+
+        return os.path.join(default_file_path_base,
+                            original_file_path)
+
+    sme = [dict(url_path=url_path,
+                alias_dest=_make_full_path(file_path.strip('/')),
+                ) for url_path, file_path in site_media_map.items()]
+    sme.append(dict(url_path=taskconfig.DZ_ADMIN_MEDIA["url_path"],
+                    alias_dest=os.path.join(
+                bundle_dir,
+                taskconfig.DZ_ADMIN_MEDIA["bundle_file_path"])))
+    return sme
+
+
 def chown_to_me(path):
     username = pwd.getpwuid(os.geteuid()).pw_name
     local_privileged(["project_chown", username, path])
@@ -1,8 +1,14 @@
+import datetime
+import errno
+import json
 import os
+import socket
 import subprocess
 import tempfile
+import time
 
 import taskconfig
+import timing
 
 
 class ExternalServiceException(Exception):
@@ -23,6 +29,9 @@ def subproc(command, null_stdin=True, stdin_string=None,
     error if the underlying command fails. Therefore, you probably want to
     use check p.returncode to verify the command exited successfully.
 
+    The command's wall time and resource usage are recorded against the
+    current step, if any (see the timing module).
+
     :param stdin_string: if provided, sends the given string on stdin to the
     subprocess.
 
@@ -51,8 +60,10 @@ def subproc(command, null_stdin=True, stdin_string=None,
         p_args["stderr"] = subprocess.STDOUT
 
     #print "subprocess.Popen(%r, %r)" % (command, p_args)
+    started_at = datetime.datetime.utcnow()
+    start_time = time.time()
     p = subprocess.Popen(command, **p_args)
-    (stdout, stderr) = p.communicate()
+    (stdout, stderr) = timing.communicate(p, command, started_at, start_time)
 
     if tempfile_name:
         os.remove(tempfile_name)
@@ -60,33 +71,187 @@ def subproc(command, null_stdin=True, stdin_string=None,
     return stdout, stderr, p
 
 
-def privileged_program_cmd(cmdargs):
-    assert isinstance(cmdargs, list)
-    privileged_program = cmdargs[0]
-    cmdargs = cmdargs[1:]
-    assert "/" not in privileged_program, ("Privileged programs can only "
-                                           "be run from the designated "
-                                           "directory. Paths are not allowed.")
+def privileged_program_path(privileged_program):
+    """
+    Get the path of ``privileged_program``, which must be the name of a file
+    directly in taskconfig.PRIVILEGED_PROGRAMS_PATH.
+
+    :raises ValueError: if it isn't. These are explicit checks rather than
+        asserts, as the privileged helper relies on them even under -O.
+    """
+    if "/" in privileged_program or privileged_program in ("", ".", ".."):
+        raise ValueError("Privileged programs can only be run from the "
+                         "designated directory. Paths are not allowed.")
+    programs_dir = os.path.realpath(taskconfig.PRIVILEGED_PROGRAMS_PATH)
     privileged_program_path = os.path.join(taskconfig.PRIVILEGED_PROGRAMS_PATH,
                                            privileged_program)
-    assert os.path.isfile(privileged_program_path), (
-        ("Command %r is not available as a privileged program "
-         "(no privileged file found).") % privileged_program)
-    fullcmd = ["sudo", privileged_program_path] + cmdargs
+    if (os.path.dirname(os.path.realpath(privileged_program_path)) !=
+        programs_dir or not os.path.isfile(privileged_program_path)):
+        raise ValueError(
+            ("Command %r is not available as a privileged program "
+             "(no privileged file found).") % privileged_program)
+    return privileged_program_path
+
+
+def privileged_program_cmd(cmdargs):
+    assert isinstance(cmdargs, list)
+    fullcmd = (["sudo", privileged_program_path(cmdargs[0])] +
+               cmdargs[1:])
     return fullcmd
 
 
+class PrivilegedResult(object):
+    """
+    The outcome of a privileged command run by the privileged helper,
+    standing in for the Popen object of one run with sudo.
+    """
+
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+
+class _HelperRusage(object):
+    """Resource usage reported by the privileged helper, for timing."""
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+
+RUSAGE_FIELDS = ("ru_utime", "ru_stime", "ru_maxrss",
+                 "ru_inblock", "ru_oublock")
+
+
+def send_message(sock, message):
+    """
+    Send a message to or from the privileged helper: a line of JSON. Command
+    input and output, which may be binary, is sent latin-1 decoded.
+    """
+    sock.sendall(json.dumps(message) + "\n")
+
+
+_helper_missing_warned = []
+
+
+def _connect_to_helper():
+    """
+    Connect to the privileged helper (see privileged_helper), if one is
+    configured.
+
+    :returns: a connected socket, or None if the helper isn't available, in
+        which case privileged commands are run with sudo.
+    """
+    if not taskconfig.PRIVILEGED_HELPER_SOCKET:
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(taskconfig.PRIVILEGED_HELPER_SOCKET)
+    except socket.error, e:
+        sock.close()
+        if e.args[0] in (errno.ENOENT, errno.ECONNREFUSED):
+            # only said once per process, as it applies to every command.
+            if not _helper_missing_warned:
+                _helper_missing_warned.append(True)
+                print ("Privileged helper not running at %s; using sudo." %
+                       taskconfig.PRIVILEGED_HELPER_SOCKET)
+            return None
+        raise
+    return sock
+
+
+def _run_with_helper(sock, commands):
+    """
+    Run ``commands``, a list of (cmdargs, stdin_string) pairs, with the
+    privileged helper connected to on ``sock``. The helper stops at the
+    first command that fails.
+
+    :returns: a list of (stdout, stderr, result) for the commands run, in
+        order.
+    """
+    started_at = datetime.datetime.utcnow()
+    try:
+        send_message(sock, dict(commands=[
+                    dict(args=cmdargs,
+                         stdin=(stdin_string and
+                                stdin_string.decode("latin-1")))
+                    for cmdargs, stdin_string in commands]))
+
+        results = []
+        f = sock.makefile("rb")
+        try:
+            for (cmdargs, stdin_string), line in zip(commands, f):
+                response = json.loads(line)
+                if "error" in response:
+                    raise ExternalServiceException(
+                        "Privileged helper refused command %r: %s" % (
+                            cmdargs, response["error"]))
+                timing.record_process(
+                    ["sudo"] + cmdargs, started_at, response["wall_time"],
+                    _HelperRusage(response["rusage"]))
+                results.append((
+                        response["stdout"].encode("latin-1"),
+                        response["stderr"].encode("latin-1"),
+                        PrivilegedResult(response["returncode"])))
+                started_at = datetime.datetime.utcnow()
+        finally:
+            f.close()
+    finally:
+        sock.close()
+
+    if len(results) < len(commands) and (not results or
+                                         results[-1][2].returncode == 0):
+        raise ExternalServiceException(
+            "Privileged helper stopped responding after %d of %d "
+            "commands." % (len(results), len(commands)))
+    return results
+
+
+def _check_privileged_result(cmdargs, stdout, stderr, p):
+    if p.returncode != 0:
+        raise ExternalServiceException((
+            "Error attempting to run LP command %r. "
+            "Output:\n %s\n%s") % (cmdargs, stdout, stderr))
+
+
 def local_privileged(cmdargs, return_details=False, stdin_string=None):
-    fullcmd = privileged_program_cmd(cmdargs)
-    #print "Running local_privileged command: %r" % fullcmd
-    stdout, stderr, p = subproc(fullcmd, null_stdin=True,
-                                stdin_string=stdin_string)
+    sock = _connect_to_helper()
+    if sock:
+        assert isinstance(cmdargs, list)
+        privileged_program_path(cmdargs[0])
+        stdout, stderr, p = _run_with_helper(sock,
+                                             [(cmdargs, stdin_string)])[0]
+    else:
+        fullcmd = privileged_program_cmd(cmdargs)
+        #print "Running local_privileged command: %r" % fullcmd
+        stdout, stderr, p = subproc(fullcmd, null_stdin=True,
+                                    stdin_string=stdin_string)
     if return_details:
         return stdout, stderr, p
     else:
-        if p.returncode != 0:
-            raise ExternalServiceException((
-                "Error attempting to run LP command %r. "
-                "Output:\n %s\n%s") % (cmdargs, stdout, stderr))
-
+        _check_privileged_result(cmdargs, stdout, stderr, p)
         return stdout
+
+
+def local_privileged_batch(cmdargs_list):
+    """
+    Run several privileged commands in order, as ``local_privileged`` does,
+    stopping at the first which fails. With the privileged helper, they are
+    all sent in a single request.
+
+    :returns: a list of the commands' outputs.
+    """
+    sock = _connect_to_helper()
+    if not sock:
+        return [local_privileged(cmdargs) for cmdargs in cmdargs_list]
+
+    for cmdargs in cmdargs_list:
+        assert isinstance(cmdargs, list)
+        privileged_program_path(cmdargs[0])
+    outputs = []
+    for cmdargs, (stdout, stderr, p) in zip(
+        cmdargs_list,
+        _run_with_helper(sock, [(cmdargs, None)
+                                for cmdargs in cmdargs_list])):
+        _check_privileged_result(cmdargs, stdout, stderr, p)
+        outputs.append(stdout)
+    return outputs
@@ -0,0 +1,103 @@
+"""
+Ready-made virtualenvs with Django installed, one per entry in
+taskconfig.DJANGO_VERSIONS. New bundles are cloned from these rather than
+running virtualenv and pip from scratch each time.
+
+Clones are full (reflinked, where the filesystem supports it) copies,
+never hard links: bundles are chowned to the project's user and have their
+.pth files appended to, neither of which may affect the template.
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+
+from dz.tasklib import (taskconfig,
+                        utils)
+
+# bump this to rebuild all templates, e.g. after changing make_virtualenv.
+TEMPLATE_FORMAT_VERSION = "1"
+
+
+def django_requirement(django_version):
+    """
+    Get the pip requirement for a Django version: a local tarball if
+    possible, otherwise a pip line.
+    """
+    djver = taskconfig.DJANGO_VERSIONS[django_version]
+    ver_tarball = os.path.join(taskconfig.DJANGO_TARBALLS_DIR,
+                               djver["tarball"])
+
+    if os.path.isfile(ver_tarball):
+        return ver_tarball
+    else:
+        return djver["pip_line"]
+
+
+def is_enabled():
+    return bool(taskconfig.VENV_TEMPLATES_DIR)
+
+
+def template_path(django_version):
+    djver = taskconfig.DJANGO_VERSIONS[django_version]
+    key = hashlib.sha1("\0".join([TEMPLATE_FORMAT_VERSION,
+                                  sys.version,
+                                  djver["tarball"],
+                                  djver["pip_line"]])).hexdigest()
+    return os.path.join(taskconfig.VENV_TEMPLATES_DIR,
+                        "django-%s-%s" % (django_version, key[:12]))
+
+
+def build_template(django_version):
+    """
+    Build the template virtualenv for ``django_version``, unless it
+    already exists. Concurrent builds are safe: the template is built
+    under a temporary name and renamed into place.
+
+    :returns: the template's path.
+    """
+    path = template_path(django_version)
+    if os.path.isdir(path):
+        return path
+
+    if not os.path.isdir(taskconfig.VENV_TEMPLATES_DIR):
+        os.makedirs(taskconfig.VENV_TEMPLATES_DIR)
+
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-",
+                               dir=taskconfig.VENV_TEMPLATES_DIR)
+    try:
+        venv_dir = os.path.join(tmp_dir, "venv")
+        utils.make_virtualenv(venv_dir)
+        utils.install_requirements([django_requirement(django_version)],
+                                   venv_dir, logsuffix="-django")
+        utils.relocate_tree(venv_dir, venv_dir, path)
+
+        try:
+            os.rename(venv_dir, path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+            # someone else built it first; use theirs.
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return path
+
+
+def clone_template(django_version, dest_dir):
+    """
+    Create a virtualenv at ``dest_dir`` (which must not exist yet) with
+    ``django_version`` installed, by copying its template.
+    """
+    template_dir = build_template(django_version)
+
+    stdout, stderr, p = utils.subproc(["cp", "-a", "--reflink=auto",
+                                       template_dir, dest_dir])
+    if p.returncode != 0:
+        raise utils.InfrastructureException(
+            "Error copying virtualenv template %s: %s" % (template_dir,
+                                                          stdout + stderr))
+
+    utils.relocate_tree(dest_dir, template_dir, dest_dir)
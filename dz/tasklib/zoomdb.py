@@ -1,4 +1,6 @@
 from datetime import datetime
+import json
+from sqlalchemy import desc
 from sqlalchemy.ext.sqlsoup import SqlSoup
 from dz.tasklib import (utils,
                         taskconfig)
@@ -47,13 +49,15 @@ class ZoomDatabase(object):
         """
         self._soup.flush()
 
-    def add_bundle(self, bundle_name, code_revision=None):
+    def add_bundle(self, bundle_name, code_revision=None, build_key=None):
         """
         Store the app's bundle location (assuming this zoomdb's job has an
         associated project).
 
         :param bundle_name: The name of the application bundle.
         :param code_revision: The code revision the bundle was created from.
+        :param build_key: The bundle's build cache key, if any (see
+            bundle.build_cache_key).
         """
 
         if code_revision is None:
@@ -64,14 +68,55 @@ class ZoomDatabase(object):
             code_revision = (code_revision[0:(CODE_REVISION_FIELD_LENGTH - 3)]
                              + "...")
 
-        bundle = self._soup.dz2_appbundle.insert(
-            project_id=self.get_project_id(),
-            bundle_name=bundle_name,
-            code_revision=code_revision,
-            creation_date=datetime.utcnow())
+        fields = dict(project_id=self.get_project_id(),
+                      bundle_name=bundle_name,
+                      code_revision=code_revision,
+                      creation_date=datetime.utcnow())
+        if build_key is not None:
+            fields["build_key"] = build_key
+
+        bundle = self._soup.dz2_appbundle.insert(**fields)
         self._soup.session.commit()
         return bundle
 
+    def find_bundle_by_build_key(self, build_key, max_age=None):
+        """
+        Find the most recent undeleted bundle of this job's project that was
+        built with the given build cache key, or None if there isn't one.
+
+        :param max_age: If given, a timedelta; ignore older bundles.
+        """
+        ab = self._soup.dz2_appbundle
+        qs = ab.filter(ab.project_id == self.get_project_id()).filter(
+            ab.build_key == build_key).filter(ab.deletion_date == None)
+
+        if max_age is not None:
+            qs = qs.filter(ab.creation_date >= datetime.utcnow() - max_age)
+
+        try:
+            return qs.order_by(desc(ab.creation_date)).first()
+        except:
+            # e.g. the database has no build_key column yet: don't leave the
+            # session's transaction failed for the rest of the job.
+            self._soup.session.rollback()
+            raise
+
+    def get_latest_bundle(self, exclude_name=None):
+        """
+        Find the most recent undeleted bundle of this job's project, or None
+        if there isn't one.
+
+        :param exclude_name: If given, ignore the bundle with this name.
+        """
+        ab = self._soup.dz2_appbundle
+        qs = ab.filter(ab.project_id == self.get_project_id()).filter(
+            ab.deletion_date == None)
+
+        if exclude_name is not None:
+            qs = qs.filter(ab.bundle_name != exclude_name)
+
+        return qs.order_by(desc(ab.creation_date)).first()
+
     def get_bundle(self, bundle_id):
         """Retrieve a bundle by database id.
         """
@@ -239,6 +284,105 @@ class ZoomDatabase(object):
 
         return result
 
+    def add_step_timing(self, step, processes=()):
+        """
+        Store timing for a step of this job, and for the subprocesses it ran.
+
+        :param step: sample dict for the step, as made by timing.StepTimer.
+        :param processes: sample dicts for the step's subprocesses.
+        :returns: the dz2_jobtiming row for the step.
+        """
+        timing = self._soup.dz2_jobtiming
+        step_row = timing.insert(job_id=self._job_id, **step)
+        self._soup.session.flush()
+
+        for process in processes:
+            timing.insert(job_id=self._job_id, parent_id=step_row.id,
+                          **process)
+
+        self._soup.session.commit()
+        return step_row
+
+    def get_timing_tree(self, job_id=None):
+        """
+        Get the recorded timings of a job, as a list of dicts (one per step,
+        in the order they started). Each has the stored fields plus a
+        ``children`` list holding the dicts for the step's subprocesses.
+
+        :param job_id: the job to get timings for; defaults to this job.
+        """
+        if job_id is None:
+            job_id = self._job_id
+
+        timing = self._soup.dz2_jobtiming
+        rows = timing.filter(timing.job_id == job_id).order_by(
+            timing.started_at, timing.id)
+
+        fields = ("id", "kind", "name", "started_at", "wall_time",
+                  "cpu_time", "max_rss", "read_bytes", "write_bytes")
+        nodes = {}
+        result = []
+
+        for row in rows:
+            node = dict((f, getattr(row, f)) for f in fields)
+            node["children"] = []
+            nodes[row.id] = node
+
+            if row.parent_id is None:
+                result.append(node)
+            else:
+                nodes[row.parent_id]["children"].append(node)
+
+        return result
+
+    def save_build_checkpoint(self, fingerprint, state):
+        """
+        Save a checkpoint of a build_and_deploy job for this job's project,
+        replacing any previous checkpoint of the project.
+
+        :param fingerprint: identifies the job's inputs; the checkpoint will
+            only be returned by get_build_checkpoint for this fingerprint.
+        :param state: JSON-serializable data to store.
+        """
+        cp = self._soup.dz2_jobcheckpoint
+        checkpoint = cp.filter(cp.project_id == self.get_project_id()).first()
+
+        if checkpoint is None:
+            checkpoint = cp.insert(project_id=self.get_project_id())
+
+        checkpoint.job_id = self._job_id
+        checkpoint.fingerprint = fingerprint
+        checkpoint.state = json.dumps(state)
+        checkpoint.updated_at = datetime.utcnow()
+        self._soup.session.commit()
+
+    def get_build_checkpoint(self, fingerprint, max_age=None):
+        """
+        Get the state saved in this project's build checkpoint, as a
+        (job_id, state) tuple; or None if there isn't one for this
+        fingerprint.
+
+        :param max_age: If given, a timedelta; ignore older checkpoints.
+        """
+        cp = self._soup.dz2_jobcheckpoint
+        qs = cp.filter(cp.project_id == self.get_project_id()).filter(
+            cp.fingerprint == fingerprint)
+
+        if max_age is not None:
+            qs = qs.filter(cp.updated_at >= datetime.utcnow() - max_age)
+
+        checkpoint = qs.first()
+        if checkpoint is None:
+            return None
+        return checkpoint.job_id, json.loads(checkpoint.state)
+
+    def clear_build_checkpoint(self):
+        """Remove this project's build checkpoint, if any."""
+        cp = self._soup.dz2_jobcheckpoint
+        for checkpoint in cp.filter(cp.project_id == self.get_project_id()):
+            self._soup.delete(checkpoint)
+        self._soup.session.commit()
+
     def mark_postgis_enabled(self):
         project = self.get_project()
         project.database_type = "postgresql-gis"
@@ -12,6 +12,29 @@ import dz.tasks.management
 import dz.tasks.logs
 from recovery import recover_appserver  # not used directly, but just to register tasks
 
+from celery.signals import task_postrun, worker_shutdown
+
+from dz.tasklib import userenv
+
+
+def reap_userenv_pool(**kwargs):
+    """
+    Destroy the UserEnvs the finished task's process has kept idle for too
+    long, since pool processes may go on running tasks for a long time.
+    """
+    userenv.reap_pool()
+
+
+def clear_userenv_pool(**kwargs):
+    """
+    Destroy all the idle UserEnvs the worker's process keeps.
+    """
+    userenv.clear_pool()
+
+
+task_postrun.connect(reap_userenv_pool)
+worker_shutdown.connect(clear_userenv_pool)
+
 
 def monkey_patch_celery_db_models_Task():
     """
@@ -10,9 +10,16 @@ from dz.tasks.decorators import task_inject_zoomdb
 @task(name="deploy_to_appserver",
       queue="__QUEUE_MUST_BE_SPECIFIED_DYNAMICALLY__")
 def deploy_to_appserver(app_id, bundle_name, appserver_name, dbinfo,
-                        num_workers=1):
+                        num_workers=1, peers=None):
     return deploy.deploy_app_bundle(app_id, bundle_name, appserver_name,
-                                    dbinfo, num_workers=num_workers)
+                                    dbinfo, num_workers=num_workers,
+                                    peers=peers)
+
+
+@task(name="prefetch_bundle",
+      queue="__QUEUE_MUST_BE_SPECIFIED_DYNAMICALLY__")
+def prefetch_bundle(app_id, bundle_name, peers=None):
+    return deploy.prefetch_app_bundle(app_id, bundle_name, peers=peers)
 
 
 @task(name="managepy_command",
@@ -55,7 +55,9 @@ for mgmt_fun in ("get_df",
                  ):
     Panel.register(make_mgmt_fun(mgmt_fun))
 
-for mgmt_list_fun in ("get_installed_bundles",):
+for mgmt_list_fun in ("get_installed_bundles",
+                      "get_app_usage",
+                      ):
     Panel.register(make_mgmt_fun(mgmt_list_fun, list))
 
 